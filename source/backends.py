@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+from metrics import ParseMetrics
+from scanner import Box, PdfScanner, displayedBox
+from sources import ByteSource, SourceStream
+
+from typing import Any, BinaryIO, Dict, FrozenSet, Iterator, List, Optional, Set, Union, TYPE_CHECKING
+
+import importlib
+import importlib.util
+import io
+import json
+
+if TYPE_CHECKING:
+    from settings import Settings
+
+
+# File features that not every backend can read; the native scanner tells them
+# from the xref, "damaged" is set when a backend fails on the file.
+FEATURES = ["xref-streams", "object-streams", "encrypted", "damaged"]
+# Fastest first; used until the benchmark has measured the backends on this machine.
+DEFAULT_ORDER = ["native", "recovery", "pikepdf", "pypdf", "pypdf2"]
+RANKING_FILE = "backend-ranking.json"
+
+
+class LibraryScanner:
+    # Page boxes through a PDF library, with the interface of PdfScanner.
+    def __enter__(self) -> LibraryScanner:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def pageCount(self) -> int:
+        raise NotImplementedError()
+
+    def pageBoxes(self) -> Iterator[Box]:
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PyPDF2Scanner(LibraryScanner):
+    module = "PyPDF2"
+
+    def __init__(self, file:BinaryIO):
+        # Imported on first use, it is the slowest import of the application.
+        reader = importlib.import_module(self.module).PdfReader
+        file.seek(0)
+        self.reader = reader(file)
+        if self.reader.is_encrypted:
+            # Files with only an owner password open with the empty user password.
+            self.reader.decrypt("")
+
+    def pageCount(self) -> int:
+        return len(self.reader.pages)
+
+    def pageBoxes(self) -> Iterator[Box]:
+        for page in self.reader.pages:
+            size = page.cropbox
+            yield displayedBox((float(size[0]), float(size[1]), float(size[2]), float(size[3])),
+                               page.rotation, page.user_unit)
+
+
+class PypdfScanner(PyPDF2Scanner):
+    # pypdf is the maintained successor of PyPDF2, with the same interface.
+    module = "pypdf"
+
+
+class PikepdfScanner(LibraryScanner):
+    def __init__(self, file:Union[str, BinaryIO]):
+        import pikepdf
+        self.pdf = pikepdf.open(file)
+
+    def pageCount(self) -> int:
+        return len(self.pdf.pages)
+
+    def pageBoxes(self) -> Iterator[Box]:
+        # qpdf copies the inherited attributes to the pages when they are listed.
+        for page in self.pdf.pages:
+            box = tuple(float(value) for value in page.cropbox)
+            rotate = page.obj.get("/Rotate")
+            userUnit = page.obj.get("/UserUnit")
+            yield displayedBox(box, None if rotate is None else int(rotate),
+                               None if userUnit is None else float(userUnit))
+
+    def close(self):
+        self.pdf.close()
+
+
+Scanner = Union[PdfScanner, LibraryScanner]
+
+
+class Backend:
+    name = ""
+    # Python module it needs, looked up without importing it.
+    module:Optional[str] = None
+    features:FrozenSet[str] = frozenset(FEATURES)
+    # Pages it cannot size are yielded as None and reported as unsized.
+    recovers = False
+
+    def available(self) -> bool:
+        return self.module is None or importlib.util.find_spec(self.module) is not None
+
+    def supports(self, features:Set[str]) -> bool:
+        return features <= self.features
+
+    def open(self, source:ByteSource, path:str, metrics:ParseMetrics) -> Scanner:
+        raise NotImplementedError()
+
+
+class NativeBackend(Backend):
+    name = "native"
+    features = frozenset(["xref-streams", "object-streams", "encrypted"])
+
+    def supports(self, features:Set[str]) -> bool:
+        # Object streams of encrypted files cannot be read without decrypting.
+        return super().supports(features) and not {"encrypted", "object-streams"} <= features
+
+    def open(self, source:ByteSource, path:str, metrics:ParseMetrics) -> Scanner:
+        return PdfScanner(source, metrics)
+
+
+class RecoveryBackend(NativeBackend):
+    # Only for files the native scanner failed on, it scans the whole file.
+    name = "recovery"
+    features = frozenset(FEATURES)
+    recovers = True
+
+    def supports(self, features:Set[str]) -> bool:
+        return "damaged" in features and super().supports(features)
+
+    def open(self, source:ByteSource, path:str, metrics:ParseMetrics) -> Scanner:
+        from recovery import RecoveringScanner
+        return RecoveringScanner(source, metrics, path)
+
+
+class PyPDF2Backend(Backend):
+    name = "pypdf2"
+    module = "PyPDF2"
+    scanner = PyPDF2Scanner
+
+    def open(self, source:ByteSource, path:str, metrics:ParseMetrics) -> Scanner:
+        with metrics.timer("xref"):
+            return self.scanner(io.BufferedReader(SourceStream(source)))
+
+
+class PypdfBackend(PyPDF2Backend):
+    name = "pypdf"
+    module = "pypdf"
+    scanner = PypdfScanner
+
+
+class PikepdfBackend(Backend):
+    name = "pikepdf"
+    module = "pikepdf"
+
+    def open(self, source:ByteSource, path:str, metrics:ParseMetrics) -> Scanner:
+        # Mapped sources are local files, qpdf reads them itself.
+        with metrics.timer("xref"):
+            return PikepdfScanner(path if source.buffer is not None else io.BufferedReader(SourceStream(source)))
+
+
+BACKENDS:Dict[str, Backend] = {backend.name: backend for backend in
+                               [NativeBackend(), RecoveryBackend(), PikepdfBackend(), PypdfBackend(), PyPDF2Backend()]}
+
+
+class BackendSelector:
+    # The available backends in order of preference. Only names are kept, so
+    # that it can be passed to worker processes.
+    def __init__(self, order:Optional[List[str]]=None):
+        self.order = [name for name in (order or DEFAULT_ORDER) if name in BACKENDS and BACKENDS[name].available()]
+
+    def next(self, features:Set[str], tried:Set[str]) -> Optional[Backend]:
+        # The first backend not tried yet that can read a file with these features.
+        for name in self.order:
+            if name not in tried and BACKENDS[name].supports(features):
+                return BACKENDS[name]
+        return None
+
+
+def readRanking(path:str) -> List[str]:
+    # Backends by the pages/s the benchmark measured, the unmeasured ones after
+    # them in the default order. Recovery comes first: it only takes damaged
+    # files, and reports the pages it cannot size instead of dropping them.
+    try:
+        with open(path, encoding="utf-8") as file:
+            speeds:Dict[str, Any] = json.load(file)["pages-per-second"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return DEFAULT_ORDER
+    order = sorted((name for name in speeds if name in BACKENDS and name != "recovery"),
+                   key=lambda name: speeds[name], reverse=True)
+    order += [name for name in DEFAULT_ORDER if name not in order and name != "recovery"]
+    return ["recovery"] + order
+
+
+def backendSelector(settings:Settings) -> BackendSelector:
+    # The backends of the settings, or the measured ranking next to settings.yaml.
+    return BackendSelector(settings.backends or readRanking(settings.backendRanking))
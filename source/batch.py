@@ -0,0 +1,286 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from functools import partial
+
+from backends import BACKENDS, BackendSelector, backendSelector
+from cache import ResultCache, openCache
+from export import EXPORT_FORMATS, PAGE_COLUMNS, CsvWriter, RecordWriter, openWriter, pageRows
+from filters import DimensionTable, FilterEngine
+from metrics import ParseMetrics, enableLogging, logEvent, profiled
+from pdf import PdfReader, PageDimension, PageSet, PageStat, formatPages
+from settings import Settings, loadSettings
+from sources import READ_MODES, SourceOpener, openSource, sourceOpener
+
+from typing import Dict, Iterable, List, Optional, TextIO
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+
+CSV_COLUMNS = ["file", "page-count", "short", "long", "paper-size", "paper-size-distance", "surface-mm2", "filters", "pages", "error"]
+
+
+@dataclass
+class FileReport:
+    path: str
+    stats: List[PageStat] = field(default_factory=list)
+    error: Optional[str] = None
+    metrics: Optional[ParseMetrics] = None
+    recovered: bool = False
+    unsizedPages: PageSet = field(default_factory=PageSet)
+    # The parsing backend that read the pages, None for cached results.
+    backend: Optional[str] = None
+
+    @classmethod
+    def fromReader(cls, reader:PdfReader) -> FileReport:
+        return cls(reader.path, list(reader.getStats()), reader.error, reader.metrics,
+                   reader.recovered, reader.unsizedPages, reader.backend)
+
+    def notices(self) -> List[str]:
+        notices = [] if self.error is None else [self.error]
+        if self.recovered:
+            notices.append("Damaged file, the page tree was recovered" if len(self.unsizedPages) == 0 else
+                           f"Damaged file, {len(self.unsizedPages)} page(s) could not be sized")
+        return notices
+
+
+def parseFile(path:str, cache:Optional[ResultCache]=None, opener:SourceOpener=openSource, workers:int=1,
+              backends:Optional[BackendSelector]=None) -> FileReport:
+    return FileReport.fromReader(PdfReader(path, cache=cache, opener=opener, workers=workers, backends=backends))
+
+
+def collectFiles(patterns:Iterable[str]) -> List[str]:
+    files:List[str] = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, names in os.walk(pattern):
+                files.extend(os.path.join(root, name) for name in names if name.lower().endswith(".pdf"))
+        elif os.path.isfile(pattern):
+            files.append(pattern)
+        else:
+            files.extend(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(set(files))
+
+
+def parseFiles(files:List[str], workers:Optional[int], cache:Optional[ResultCache]=None,
+               opener:SourceOpener=openSource, backends:Optional[BackendSelector]=None) -> Iterable[FileReport]:
+    workers = workers or os.cpu_count() or 1
+    parse = partial(parseFile, cache=cache, opener=opener, backends=backends)
+    if workers == 1 or len(files) == 1:
+        # A single large file is split into page tree shards instead.
+        yield from map(partial(parse, workers=workers), files)
+        return
+    chunksize = max(1, min(16, len(files) // (4 * workers)))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(parse, files, chunksize=chunksize)
+
+
+def collectMetrics(reports:Iterable[FileReport], total:ParseMetrics) -> Iterable[FileReport]:
+    # Logged by the parent process, workers do not share its logging setup.
+    for report in reports:
+        if report.metrics is not None:
+            logEvent("parse", file=report.path, error=report.error, backend=report.backend, **report.metrics.asDict())
+            total.merge(report.metrics)
+        yield report
+
+
+def sortedStats(stats:Iterable[PageStat]) -> List[PageStat]:
+    return sorted(stats, key=lambda x: (
+        min(x.dimension.width, x.dimension.height), max(x.dimension.width, x.dimension.height)))
+
+
+def statRow(dimension:PageDimension, count:int, area:float, settings:Settings) -> Dict[str, object]:
+    short = min(dimension.width, dimension.height)
+    long = max(dimension.width, dimension.height)
+    match = settings.paperSizes.classify(dimension)
+    return {
+        "page-count": count,
+        "short": short,
+        "long": long,
+        "paper-size": "" if match is None else match.name,
+        "paper-size-distance": None if match is None else match.distance,
+        # From the page boxes, not the rounded sides.
+        "surface-mm2": round(area),
+    }
+
+
+class Report:
+    def __init__(self, settings:Settings):
+        self.settings = settings
+        self.files:List[Dict[str, object]] = []
+        self.total:Dict[PageDimension, int] = {}
+        self.totalAreas:Dict[PageDimension, float] = {}
+        self.engine = FilterEngine(settings.filters)
+
+    def add(self, report:FileReport) -> List[Dict[str, object]]:
+        stats = sortedStats(report.stats)
+        table = DimensionTable.fromStats(stats)
+        mask = self.engine.matchTable(table)
+        rows = self.statRows(report.path, stats, mask)
+        self.addTotal(report)
+        self.files.append({
+            "file": report.path,
+            "page-count": sum(len(stat.pages) for stat in report.stats),
+            "error": report.error,
+            "recovered": report.recovered,
+            "backend": report.backend,
+            "unsized-pages": formatPages(report.unsizedPages, self.settings.groupPages) if report.unsizedPages else "",
+            "dimensions": rows,
+            "filters": self.filterSummary(table, mask),
+        })
+        return rows
+
+    def addTotal(self, report:FileReport):
+        for stat in report.stats:
+            self.total[stat.dimension] = self.total.get(stat.dimension, 0) + len(stat.pages)
+            self.totalAreas[stat.dimension] = self.totalAreas.get(stat.dimension, 0.0) + stat.area
+
+    def rows(self, report:FileReport) -> List[Dict[str, object]]:
+        # Rows of a single file without adding it to the report.
+        stats = sortedStats(report.stats)
+        return self.statRows(report.path, stats, self.engine.matchTable(DimensionTable.fromStats(stats)))
+
+    def statRows(self, path:str, stats:List[PageStat], mask) -> List[Dict[str, object]]:
+        return [{"file": path, **statRow(stat.dimension, len(stat.pages), stat.area, self.settings),
+                 "filters": ";".join(filters), "pages": formatPages(stat.pages, self.settings.groupPages)}
+                for stat, filters in zip(stats, self.engine.matchedTexts(mask))]
+
+    def noticeRows(self, report:FileReport) -> List[Dict[str, object]]:
+        # Error and recovery rows that follow the rows of a file in CSV reports.
+        rows:List[Dict[str, object]] = []
+        if report.error is not None:
+            rows.append({"file": report.path, "error": report.error})
+        if report.recovered:
+            rows.append({"file": report.path, "page-count": len(report.unsizedPages),
+                         "pages": formatPages(report.unsizedPages, self.settings.groupPages) if report.unsizedPages else "",
+                         "error": report.notices()[-1]})
+        return rows
+
+    def totalDimensions(self) -> List[PageDimension]:
+        return sorted(self.total.keys(), key=lambda x: (min(x.width, x.height), max(x.width, x.height)))
+
+    def totalTable(self) -> DimensionTable:
+        return DimensionTable((min(d.width, d.height), max(d.width, d.height), self.total[d], self.totalAreas[d])
+                              for d in self.totalDimensions())
+
+    def totalRows(self) -> List[Dict[str, object]]:
+        matched = self.engine.matchedTexts(self.engine.matchTable(self.totalTable()))
+        return [{**statRow(dimension, self.total[dimension], self.totalAreas[dimension], self.settings),
+                 "filters": ";".join(filters)}
+                for dimension, filters in zip(self.totalDimensions(), matched)]
+
+    def filterSummary(self, table:DimensionTable, mask=None) -> List[Dict[str, object]]:
+        return [{"text": summary.filter.text, "page-count": summary.pageCount, "surface-mm2": summary.surface}
+                for summary in self.engine.summarize(table, mask)]
+
+
+def writeCsv(reports:Iterable[FileReport], report:Report, output:TextIO):
+    writeRows(reports, report, CsvWriter(output, CSV_COLUMNS))
+
+
+def writeRows(reports:Iterable[FileReport], report:Report, writer:RecordWriter):
+    # Only the totals are kept, unlike Report.add, so any number of files can be written.
+    for fileReport in reports:
+        writer.writeRows(report.rows(fileReport))
+        writer.writeRows(report.noticeRows(fileReport))
+        report.addTotal(fileReport)
+    for row in report.totalRows():
+        writer.write({"file": "", **row, "pages": ""})
+
+
+def writePages(reports:Iterable[FileReport], report:Report, writer:RecordWriter):
+    # One row per page; errors and unsized pages are reported like in writeRows.
+    for fileReport in reports:
+        writer.writeRows(pageRows(fileReport, report.settings, report.engine))
+        if fileReport.error is not None:
+            writer.write({"file": fileReport.path, "error": fileReport.error})
+
+
+def writeJson(reports:Iterable[FileReport], report:Report, output:TextIO):
+    for fileReport in reports:
+        report.add(fileReport)
+    json.dump({"files": report.files, "total": report.totalRows(),
+               "filters": report.filterSummary(report.totalTable())}, output, indent=2, ensure_ascii=False)
+    output.write("\n")
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Read page size information from PDF files")
+    parser.add_argument("paths", nargs="+", help="PDF files, glob patterns or directories")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("-f", "--format", choices=["json"] + EXPORT_FORMATS, default="csv",
+                        help="jsonl writes one JSON object per row, columnar a directory of numpy column files")
+    parser.add_argument("-o", "--output", help="output file or columnar directory (default: standard output)")
+    parser.add_argument("--pages", action="store_true",
+                        help="one row per page instead of per page size (not with -f json)")
+    parser.add_argument("--settings", help="path of settings.yaml")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the result cache")
+    parser.add_argument("--read-mode", choices=READ_MODES,
+                        help="how files are read (default: file-access mode of the settings); use blocks for network shares")
+    parser.add_argument("--backend", metavar="NAMES",
+                        help=f"comma separated parsing backends to try in this order (default: parsing backends of the "
+                             f"settings): {', '.join(BACKENDS)}")
+    parser.add_argument("--stats", action="store_true",
+                        help="log per file phase timings and counters as JSON lines to standard error")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write a cProfile dump of the run to FILE (parses in this process, as with -j 1)")
+    args = parser.parse_args(argv)
+    if args.stats:
+        enableLogging()
+
+    settings = Settings(args.settings) if args.settings else loadSettings()
+    if settings.error is not None:
+        print(settings.error, file=sys.stderr)
+        return 2
+    if args.read_mode is not None:
+        settings.readMode = args.read_mode
+    if args.backend is not None:
+        settings.backends = [name.strip() for name in args.backend.split(",")]
+        unknown = [name for name in settings.backends if name not in BACKENDS]
+        if unknown:
+            print(f"Unknown backend {', '.join(unknown)}, expected some of {', '.join(BACKENDS)}", file=sys.stderr)
+            return 2
+        if set(settings.backends) == {"recovery"}:
+            print("The recovery backend only reads damaged files, add native or a library backend", file=sys.stderr)
+            return 2
+
+    if args.pages and args.format == "json":
+        print("--pages needs a streaming format: csv, jsonl or columnar", file=sys.stderr)
+        return 2
+    if args.format == "columnar" and not args.output:
+        print("The columnar format needs an output directory (-o)", file=sys.stderr)
+        return 2
+
+    files = collectFiles(args.paths)
+    if not files:
+        print("No PDF files found", file=sys.stderr)
+        return 1
+
+    cache = None if args.no_cache else openCache(settings)
+    # Workers are not profiled, so profiling keeps the parsing in this process.
+    workers = 1 if args.profile else args.workers
+    total = ParseMetrics()
+    with profiled(args.profile), total.timer("total"):
+        reports = collectMetrics(parseFiles(files, workers, cache, sourceOpener(settings), backendSelector(settings)), total)
+        if args.format == "json":
+            output = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+            try:
+                writeJson(reports, Report(settings), output)
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+        else:
+            columns = PAGE_COLUMNS + ["error"] if args.pages else CSV_COLUMNS
+            with openWriter(args.format, args.output or sys.stdout, columns) as writer:
+                (writePages if args.pages else writeRows)(reports, Report(settings), writer)
+    logEvent("batch", files=len(files), **total.asDict())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
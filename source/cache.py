@@ -0,0 +1,161 @@
+from __future__ import annotations
+from contextlib import contextmanager
+
+from metrics import logger
+from pdf import PageDimension, PageSet, PageStat
+from settings import Settings, getScriptDir, loadSettings
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import zlib
+
+
+TAIL_BYTES = 64 * 1024
+SCHEMA_VERSION = 5
+
+_TRAILER_ID = re.compile(rb"/ID\s*\[\s*<([0-9A-Fa-f\s]*)>")
+
+
+class FileIdentity:
+    def __init__(self, path:str):
+        self.path = os.path.abspath(path)
+        info = os.stat(self.path)
+        self.size = info.st_size
+        self.mtime = info.st_mtime_ns
+        with open(self.path, 'rb') as file:
+            file.seek(max(0, self.size - TAIL_BYTES))
+            tail = file.read()
+        ids = _TRAILER_ID.findall(tail)
+        trailerId = ids[-1].decode("latin-1").replace(" ", "").lower() if ids else ""
+        self.fingerprint = f"{trailerId}:{hashlib.sha1(tail).hexdigest()}"
+
+
+class ResultCache:
+    def __init__(self, path:str, maxSize:int):
+        self.path = path
+        self.maxSize = maxSize
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                    connection.execute("DROP TABLE IF EXISTS results")
+                    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                                        path TEXT PRIMARY KEY,
+                                        size INTEGER NOT NULL,
+                                        mtime INTEGER NOT NULL,
+                                        fingerprint TEXT NOT NULL,
+                                        data BLOB NOT NULL,
+                                        used REAL NOT NULL)""")
+                connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+                yield connection
+        finally:
+            connection.close()
+
+    def identify(self, path:str) -> FileIdentity:
+        return FileIdentity(path)
+
+    def get(self, identity:FileIdentity) -> Optional[Dict[PageDimension, PageStat]]:
+        try:
+            with self.connect() as connection:
+                row = connection.execute("SELECT data FROM results WHERE path = ? AND size = ? AND mtime = ? AND fingerprint = ?",
+                                         (identity.path, identity.size, identity.mtime, identity.fingerprint)).fetchone()
+                if row is None:
+                    return None
+                connection.execute("UPDATE results SET used = ? WHERE path = ?", (time.time(), identity.path))
+            return decodeStats(row[0])
+        except sqlite3.Error as e:
+            logger.warning("Result cache: %s", e)
+            return None
+
+    def put(self, identity:FileIdentity, stats:Iterable[PageStat]):
+        data = encodeStats(stats)
+        if len(data) > self.maxSize:
+            return
+        try:
+            with self.connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                                   (identity.path, identity.size, identity.mtime, identity.fingerprint, data, time.time()))
+                self.evict(connection)
+        except sqlite3.Error as e:
+            logger.warning("Result cache: %s", e)
+
+    def evict(self, connection:sqlite3.Connection):
+        total = connection.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM results").fetchone()[0]
+        if total <= self.maxSize:
+            return
+        rows = connection.execute("SELECT path, LENGTH(data) FROM results ORDER BY used").fetchall()
+        expired:List[Tuple[str]] = []
+        for path, size in rows:
+            if total <= self.maxSize:
+                break
+            expired.append((path,))
+            total -= size
+        connection.executemany("DELETE FROM results WHERE path = ?", expired)
+
+    def invalidate(self, paths:Optional[Iterable[str]]=None) -> int:
+        with self.connect() as connection:
+            if paths is None:
+                return connection.execute("DELETE FROM results").rowcount
+            return connection.executemany("DELETE FROM results WHERE path = ?",
+                                          [(os.path.abspath(path),) for path in paths]).rowcount
+
+    def info(self) -> Tuple[int, int]:
+        with self.connect() as connection:
+            return connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM results").fetchone()
+
+
+def encodeStats(stats:Iterable[PageStat]) -> bytes:
+    data = [[stat.dimension.width, stat.dimension.height, [page for pageRange in stat.pages.ranges() for page in pageRange],
+             stat.area] for stat in stats]
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode("ascii"))
+
+
+def decodeStats(data:bytes) -> Dict[PageDimension, PageStat]:
+    stats:Dict[PageDimension, PageStat] = {}
+    for width, height, ranges, area in json.loads(zlib.decompress(data)):
+        dimension = PageDimension(width, height)
+        stats[dimension] = PageStat(dimension, PageSet.fromRanges(zip(ranges[::2], ranges[1::2])), area)
+    return stats
+
+
+def openCache(settings:Settings) -> Optional[ResultCache]:
+    if not settings.cache:
+        return None
+    return ResultCache(os.path.join(getScriptDir(), "cache.sqlite"), settings.cacheSize * 1024 * 1024)
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Manage the page size result cache")
+    parser.add_argument("command", choices=["info", "clear"])
+    parser.add_argument("paths", nargs="*", help="files to invalidate (default: all)")
+    args = parser.parse_args(argv)
+
+    settings = loadSettings()
+    cache = openCache(settings)
+    if cache is None:
+        print("Cache is disabled in settings.yaml", file=sys.stderr)
+        return 1
+    if args.command == "clear":
+        removed = cache.invalidate(args.paths or None)
+        print(f"Removed {removed} cached result(s)")
+    else:
+        count, size = cache.info()
+        print(f"{cache.path}: {count} file(s), {size / 1024:.1f} KiB of {cache.maxSize / 1024:.1f} KiB")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
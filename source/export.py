@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import numpy as np
+
+from filters import DimensionTable, FilterEngine
+from pdf import PageDimension, pageRecords
+from settings import Settings
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Union, TYPE_CHECKING
+
+import csv
+import json
+import os
+
+if TYPE_CHECKING:
+    from batch import FileReport
+
+
+EXPORT_FORMATS = ["csv", "jsonl", "columnar"]
+# Rows buffered per column before the columnar writer appends them to its files.
+CHUNK_ROWS = 64 * 1024
+NPY_HEADER_SIZE = 128
+# Stored for missing values in integer columns of the columnar format.
+INT_NULL = -1
+
+INT = "int64"
+FLOAT = "float64"
+TEXT = "text"
+COLUMN_TYPES:Dict[str, str] = {
+    "file": TEXT,
+    "page": INT,
+    "width": INT,
+    "height": INT,
+    "page-count": INT,
+    "short": INT,
+    "long": INT,
+    "paper-size": TEXT,
+    "paper-size-distance": FLOAT,
+    "surface-mm2": INT,
+    "filters": TEXT,
+    "pages": TEXT,
+    "error": TEXT,
+}
+PAGE_COLUMNS = ["file", "page", "width", "height", "short", "long", "paper-size", "filters"]
+
+Row = Dict[str, Any]
+
+
+class RecordWriter:
+    # Writes rows with the given columns as they come; missing keys are empty.
+    def __init__(self, columns:List[str]):
+        self.columns = columns
+        self.rows = 0
+
+    def __enter__(self) -> RecordWriter:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, row:Row):
+        raise NotImplementedError()
+
+    def writeRows(self, rows:Iterable[Row]):
+        for row in rows:
+            self.write(row)
+
+    def close(self):
+        pass
+
+
+class CsvWriter(RecordWriter):
+    def __init__(self, output:TextIO, columns:List[str], owned:bool=False, delimiter:str=","):
+        super().__init__(columns)
+        self.output = output
+        self.owned = owned
+        self.writer = csv.DictWriter(output, columns, extrasaction="ignore", lineterminator="\n", delimiter=delimiter)
+        self.writer.writeheader()
+
+    def write(self, row:Row):
+        self.writer.writerow(row)
+        self.rows += 1
+
+    def close(self):
+        if self.owned:
+            self.output.close()
+
+
+class JsonLinesWriter(RecordWriter):
+    def __init__(self, output:TextIO, columns:List[str], owned:bool=False):
+        super().__init__(columns)
+        self.output = output
+        self.owned = owned
+
+    def write(self, row:Row):
+        self.output.write(json.dumps({column: row.get(column) for column in self.columns}, ensure_ascii=False))
+        self.output.write("\n")
+        self.rows += 1
+
+    def close(self):
+        if self.owned:
+            self.output.close()
+
+
+class ColumnarWriter(RecordWriter):
+    # A directory with one .npy file per numeric column; a text column is its
+    # UTF-8 values back to back in <column>.txt with the value boundaries in
+    # <column>.offsets.npy. schema.json lists the columns and the row count.
+    # Rows are buffered in chunks, so memory does not grow with the row count.
+    def __init__(self, directory:str, columns:List[str], chunkRows:int=CHUNK_ROWS):
+        super().__init__(columns)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunkRows = chunkRows
+        self.types = [COLUMN_TYPES.get(column, TEXT) for column in columns]
+        self.buffers:List[List[Any]] = [[] for _ in columns]
+        self.files = []
+        self.textSizes = [0] * len(columns)
+        for column, type in zip(columns, self.types):
+            if type == TEXT:
+                file = open(self.path(column + ".offsets.npy"), "wb")
+                file.write(npyHeader(np.int64, 0))
+                np.zeros(1, dtype=np.int64).tofile(file)
+                self.files.append((file, open(self.path(column + ".txt"), "wb")))
+            else:
+                file = open(self.path(column + ".npy"), "wb")
+                file.write(npyHeader(type, 0))
+                self.files.append((file, None))
+
+    def path(self, name:str) -> str:
+        return os.path.join(self.directory, name)
+
+    def write(self, row:Row):
+        for column, buffer in zip(self.columns, self.buffers):
+            buffer.append(row.get(column))
+        self.rows += 1
+        if len(self.buffers[0]) >= self.chunkRows:
+            self.flush()
+
+    def flush(self):
+        for i, (buffer, type, (file, textFile)) in enumerate(zip(self.buffers, self.types, self.files)):
+            if type == TEXT:
+                values = [b"" if value is None else str(value).encode("utf-8") for value in buffer]
+                offsets = np.cumsum([len(value) for value in values], dtype=np.int64) + self.textSizes[i]
+                textFile.write(b"".join(values))
+                offsets.tofile(file)
+                if len(offsets):
+                    self.textSizes[i] = int(offsets[-1])
+            else:
+                null = np.nan if type == FLOAT else INT_NULL
+                np.array([null if value is None else value for value in buffer], dtype=type).tofile(file)
+            buffer.clear()
+
+    def close(self):
+        if not self.files:
+            return
+        self.flush()
+        for column, type, (file, textFile) in zip(self.columns, self.types, self.files):
+            # The headers were written with no rows, the sizes are known now.
+            file.seek(0)
+            file.write(npyHeader(np.int64 if type == TEXT else type, self.rows + 1 if type == TEXT else self.rows))
+            file.close()
+            if textFile is not None:
+                textFile.close()
+        self.files = []
+        with open(self.path("schema.json"), "w", encoding="utf-8") as schema:
+            json.dump({"rows": self.rows, "int-null": INT_NULL,
+                       "columns": [{"name": column, "type": type} for column, type in zip(self.columns, self.types)]},
+                      schema, indent=2)
+
+
+def npyHeader(dtype:Any, rows:int) -> bytes:
+    # Fixed size, so that the row count can be filled in when the file is complete.
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": (rows,)})
+    header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+    return b"\x93NUMPY\x01\x00" + (NPY_HEADER_SIZE - 10).to_bytes(2, "little") + header.encode("latin-1")
+
+
+def readColumnar(directory:str, columns:Optional[List[str]]=None) -> Dict[str, Union[np.ndarray, List[str]]]:
+    # Numeric columns are memory mapped; text columns are decoded into lists.
+    with open(os.path.join(directory, "schema.json"), encoding="utf-8") as file:
+        schema = json.load(file)
+    result:Dict[str, Union[np.ndarray, List[str]]] = {}
+    for column in schema["columns"]:
+        name = column["name"]
+        if columns is not None and name not in columns:
+            continue
+        if column["type"] != TEXT:
+            result[name] = np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+            continue
+        offsets = np.load(os.path.join(directory, name + ".offsets.npy"))
+        with open(os.path.join(directory, name + ".txt"), "rb") as file:
+            data = file.read()
+        result[name] = [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+    return result
+
+
+def openWriter(format:str, target:Union[str, TextIO], columns:List[str]) -> RecordWriter:
+    # `target` is a path, or a text stream for csv and jsonl; columnar output
+    # is a directory.
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {format}")
+    if format == "columnar":
+        if not isinstance(target, str):
+            raise ValueError("The columnar format is written to a directory")
+        return ColumnarWriter(target, columns)
+    owned = isinstance(target, str)
+    output = open(target, "w", encoding="utf-8", newline="") if isinstance(target, str) else target
+    if format == "csv":
+        return CsvWriter(output, columns, owned)
+    return JsonLinesWriter(output, columns, owned)
+
+
+def pageRows(report:FileReport, settings:Settings, engine:FilterEngine) -> Iterator[Row]:
+    # One row per page of a file in page order, generated from its page sets.
+    stats = list(report.stats)
+    filters = engine.matchedTexts(engine.matchTable(DimensionTable.fromStats(stats)))
+    sizes:Dict[Optional[PageDimension], Row] = {None: {"file": report.path}}
+    for stat, matched in zip(stats, filters):
+        dimension = stat.dimension
+        match = settings.paperSizes.classify(dimension)
+        sizes[dimension] = {
+            "file": report.path,
+            "width": dimension.width,
+            "height": dimension.height,
+            "short": min(dimension.width, dimension.height),
+            "long": max(dimension.width, dimension.height),
+            "paper-size": "" if match is None else match.name,
+            "filters": ";".join(matched),
+        }
+    for page, dimension in pageRecords(stats, report.unsizedPages):
+        yield {**sizes[dimension], "page": page}
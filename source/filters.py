@@ -0,0 +1,95 @@
+from __future__ import annotations
+from dataclasses import dataclass
+
+import numpy as np
+
+from pdf import PageStat
+from settings import Filter
+
+from typing import Iterable, List, Optional, Tuple
+
+
+NO_MIN = np.iinfo(np.int64).min
+NO_MAX = np.iinfo(np.int64).max
+
+
+@dataclass
+class FilterSummary:
+    filter: Filter
+    pageCount: int
+    surface: int
+    rows: np.ndarray
+
+
+class DimensionTable:
+    # Rows of (short side, long side, page count, exact surface in mm²).
+    def __init__(self, rows:Iterable[Tuple[int, int, int, float]]):
+        rows = list(rows)
+        data = np.array([row[:3] for row in rows], dtype=np.int64).reshape(-1, 3)
+        self.shorts = data[:, 0]
+        self.longs = data[:, 1]
+        self.counts = data[:, 2]
+        self.areas = np.array([row[3] for row in rows], dtype=np.float64)
+
+    @classmethod
+    def fromStats(cls, stats:Iterable[PageStat]) -> DimensionTable:
+        return cls((min(s.dimension.width, s.dimension.height), max(s.dimension.width, s.dimension.height),
+                    len(s.pages), s.area) for s in stats)
+
+    def __len__(self) -> int:
+        return len(self.shorts)
+
+    def surfaces(self) -> np.ndarray:
+        return self.areas
+
+
+class FilterEngine:
+    def __init__(self, filters:List[Filter]):
+        self.filters = filters
+        bounds:List[Tuple[int, int, int, int]] = []
+        self.ruleFilters:List[int] = []
+        for index, filter in enumerate(filters):
+            for rule in filter.rules:
+                bounds.append((
+                    NO_MIN if rule.minShort is None else rule.minShort,
+                    NO_MAX if rule.maxShort is None else rule.maxShort,
+                    NO_MIN if rule.minLong is None else rule.minLong,
+                    NO_MAX if rule.maxLong is None else rule.maxLong,
+                ))
+                self.ruleFilters.append(index)
+        data = np.array(bounds, dtype=np.int64).reshape(-1, 4)
+        self.minShort = data[:, 0:1]
+        self.maxShort = data[:, 1:2]
+        self.minLong = data[:, 2:3]
+        self.maxLong = data[:, 3:4]
+        # Rules are grouped by filter, reduceat ORs each group.
+        self.groupStarts = np.searchsorted(self.ruleFilters, np.arange(len(filters)))
+        self.hasRules = np.array([len(f.rules) > 0 for f in filters], dtype=bool)
+
+    def match(self, shorts:np.ndarray, longs:np.ndarray) -> np.ndarray:
+        # Returns a (filters x dimensions) boolean matrix.
+        result = np.zeros((len(self.filters), len(shorts)), dtype=bool)
+        if len(self.ruleFilters) == 0 or len(shorts) == 0:
+            return result
+        ruleMask = ((shorts >= self.minShort) & (shorts <= self.maxShort)
+                    & (longs >= self.minLong) & (longs <= self.maxLong))
+        result[self.hasRules] = np.logical_or.reduceat(ruleMask, self.groupStarts[self.hasRules], axis=0)
+        return result
+
+    def matchTable(self, table:DimensionTable) -> np.ndarray:
+        return self.match(table.shorts, table.longs)
+
+    def matchFilter(self, filter:Filter, table:DimensionTable) -> np.ndarray:
+        return self.matchTable(table)[self.filters.index(filter)]
+
+    def summarize(self, table:DimensionTable, mask:Optional[np.ndarray]=None) -> List[FilterSummary]:
+        if mask is None:
+            mask = self.matchTable(table)
+        pageCounts = mask @ table.counts
+        surfaces = mask @ table.surfaces()
+        return [FilterSummary(filter, int(pageCounts[i]), round(surfaces[i]), np.flatnonzero(mask[i]))
+                for i, filter in enumerate(self.filters)]
+
+    def matchedTexts(self, mask:np.ndarray) -> List[List[str]]:
+        # Texts of the matching filters for every dimension of a match() mask.
+        return [[self.filters[i].text for i in np.flatnonzero(column)] for column in mask.T]
@@ -1,33 +1,53 @@
+# Imported first: with --startup-profile the imports below are timed.
+import startup
+startup.startProfile()
+
 from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QPushButton,
-                               QFileDialog, QTableWidgetItem, QHeaderView,
+                               QFileDialog, QHeaderView,
                                QAbstractItemView, QMessageBox, QHBoxLayout, QLabel,
-                               QTableWidgetSelectionRange, QMenu, QRadioButton, QButtonGroup,
-                               QGridLayout)
-from PySide6.QtGui import QContextMenuEvent, QBrush, QColor
-
+                               QMenu, QRadioButton, QButtonGroup,
+                               QGridLayout, QProgressDialog)
+from PySide6.QtGui import QContextMenuEvent, QCloseEvent, QDragEnterEvent, QDropEvent
+from PySide6.QtCore import Qt, QThread, QTimer, Signal, QItemSelection, QItemSelectionModel
+
+from backends import BackendSelector, backendSelector
+from batch import FileReport, Report, collectFiles, parseFile, writePages, writeRows, CSV_COLUMNS
+from cache import ResultCache, openCache
+from export import PAGE_COLUMNS, openWriter
+from filters import FilterEngine
+from metrics import ParseMetrics, dumpProfile, enableLogging, logEvent
 from pdf import PdfReader
-from settings import Settings, Filter
-from table import TableWidget
+from settings import Settings, Filter, loadSettings
+from sources import SourceOpener, openSource, sourceOpener
+from table import TableView, PageStatModel, PageStatProxyModel, SelectionSurface, FILE_COLUMN, PAGES_COLUMN
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from functools import partial
 
-from typing import Iterable, List
+from typing import Dict, List, Optional
 
+import argparse
+import cProfile
+import multiprocessing
 import os
+import numpy as np
 import sys
+import time
 
 
 BUILD_VERSION = "2024-10-25"
 MAX_BUTTON_COLS = 4
+CANCEL_POLL_SECONDS = 0.2
+EXPORT_FILTERS = {"csv": "CSV (*.csv)", "jsonl": "JSON Lines (*.jsonl)", "columnar": "Columnar directory (*)"}
 
 
 class SurfaceLabel(QLabel):
     def __init__(self, labelText:str):
         super().__init__("")
         self.labelText = labelText
-        self.surface:int = 0
+        self.surface:float = 0
         self.updateText()
 
-    def setSurface(self, surface:int):
+    def setSurface(self, surface:float):
         self.surface = surface
         self.updateText()
 
@@ -51,10 +71,100 @@ class SurfaceLabel(QLabel):
         clipboard.setText(self.getFormattedSurface())
 
 
+class ParseThread(QThread):
+    # A single file reports page progress, several files are parsed in worker
+    # processes and report file progress.
+    progress = Signal(int, int)
+    fileParsed = Signal(object)
+
+    def __init__(self, paths:List[str], cache:Optional[ResultCache], opener:SourceOpener=openSource,
+                 profilers:Optional[List[cProfile.Profile]]=None, backends:Optional[BackendSelector]=None):
+        super().__init__()
+        self.paths = paths
+        self.cache = cache
+        self.opener = opener
+        self.backends = backends
+        self.profilers = profilers
+
+    def run(self):
+        if self.profilers is None:
+            self.parse()
+            return
+        profiler = cProfile.Profile()
+        self.profilers.append(profiler)
+        profiler.enable()
+        try:
+            self.parse()
+        finally:
+            profiler.disable()
+
+    def parse(self):
+        if len(self.paths) == 1:
+            reader = PdfReader(self.paths[0], self.reportProgress, self.cache, opener=self.opener,
+                               workers=os.cpu_count() or 1, backends=self.backends)
+            if not reader.cancelled:
+                self.fileParsed.emit(FileReport.fromReader(reader))
+            return
+
+        self.progress.emit(0, len(self.paths))
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor() as executor:
+            futures:Dict[Future, str] = {executor.submit(parseFile, path, self.cache, self.opener, 1, self.backends): path for path in self.paths}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, CANCEL_POLL_SECONDS, FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        report = future.result()
+                    except Exception as e:
+                        report = FileReport(futures[future], error=str(e))
+                    self.fileParsed.emit(report)
+                if done:
+                    self.progress.emit(len(self.paths) - len(pending), len(self.paths))
+                if self.isInterruptionRequested():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    return
+
+    def reportProgress(self, parsed:int, total:int) -> bool:
+        self.progress.emit(parsed, total)
+        return not self.isInterruptionRequested()
+
+
+class ExportThread(QThread):
+    # Writes the rows or pages of the documents without blocking the window.
+    failed = Signal(str)
+
+    def __init__(self, reports:List[FileReport], settings:Settings, format:str, path:str, pages:bool):
+        super().__init__()
+        self.reports = reports
+        self.settings = settings
+        self.format = format
+        self.path = path
+        self.pages = pages
+
+    def run(self):
+        try:
+            with openWriter(self.format, self.path, PAGE_COLUMNS + ["error"] if self.pages else CSV_COLUMNS) as writer:
+                (writePages if self.pages else writeRows)(self.reports, Report(self.settings), writer)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
 class MainWindow(QWidget):
-    def __init__(self, settings:Settings):
+    def __init__(self, settings:Settings, profilers:Optional[List[cProfile.Profile]]=None):
         super().__init__()
         self.settings = settings
+        self.profilers = profilers
+        self.cache = openCache(settings)
+        self.opener = sourceOpener(settings)
+        self.backends = backendSelector(settings)
+        self.filterEngine = FilterEngine(settings.filters)
+        self.documents:Dict[str, FileReport] = {}
+        self.parseThread:Optional[ParseThread] = None
+        self.exportThread:Optional[ExportThread] = None
+        self.progressDialog:Optional[QProgressDialog] = None
+        self.openStarted = 0.0
+        self.notices:List[str] = []
         self.initUI()
 
     def translate(self, id:str) -> str:
@@ -65,35 +175,53 @@ class MainWindow(QWidget):
         self.resize(self.settings.width, self.settings.height)
         layout = QVBoxLayout()
         self.setLayout(layout)
+        self.setAcceptDrops(True)
 
+        fileButtonLayout = QHBoxLayout()
         self.file_button = QPushButton(self.translate("open-pdf"))
         self.file_button.clicked.connect(self.openFile)
-        layout.addWidget(self.file_button)
-
-        self.table = TableWidget()
+        fileButtonLayout.addWidget(self.file_button, 1)
+        self.clearButton = QPushButton(self.translate("clear-files"))
+        self.clearButton.clicked.connect(self.clearFiles)
+        self.clearButton.setEnabled(False)
+        fileButtonLayout.addWidget(self.clearButton)
+        self.exportButton = QPushButton(self.translate("export"))
+        exportMenu = QMenu(self.exportButton)
+        exportMenu.addAction(self.translate("export-rows"), partial(self.exportDocuments, False))
+        exportMenu.addAction(self.translate("export-pages"), partial(self.exportDocuments, True))
+        self.exportButton.setMenu(exportMenu)
+        self.exportButton.setEnabled(False)
+        fileButtonLayout.addWidget(self.exportButton)
+        layout.addLayout(fileButtonLayout)
+
+        self.model = PageStatModel(self.settings)
+        self.selectedSurface = SelectionSurface(self.model)
+        self.proxyModel = PageStatProxyModel()
+        self.proxyModel.setSourceModel(self.model)
+
+        self.table = TableView()
+        self.table.setModel(self.proxyModel)
         self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
         self.table.horizontalHeader().setStyleSheet("QHeaderView::section { background-color: silver;}")
-        self.table.itemSelectionChanged.connect(self.calculateBigPagesSurface)
+        self.table.selectionModel().selectionChanged.connect(self.calculateBigPagesSurface)
         self.table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
-
-        self.table.setColumnCount(6)
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.SortOrder.AscendingOrder)
+        self.table.setSortingEnabled(True)
         layout.addWidget(self.table)
 
-        headers = [self.translate("page-count"), self.translate("dimensions"),
-                   self.translate("short"), self.translate("long"),
-                   self.translate("paper-size"), self.translate("pages")]
-        self.table.setHorizontalHeaderLabels(headers)
         self.table.verticalHeader().setVisible(False)
         self.table.setWordWrap(False)
 
-        self.table.setColumnWidth(0, 70)
-        self.table.setColumnWidth(1, 100)
-        self.table.setColumnWidth(2, 45)
+        self.table.setColumnWidth(0, 150)
+        self.table.setColumnWidth(1, 70)
+        self.table.setColumnWidth(2, 100)
         self.table.setColumnWidth(3, 45)
-        self.table.setColumnWidth(4, 70)
+        self.table.setColumnWidth(4, 45)
+        self.table.setColumnWidth(5, 70)
+        self.table.setColumnHidden(FILE_COLUMN, True)
 
         header = self.table.horizontalHeader()
-        header.setSectionResizeMode(5, QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(PAGES_COLUMN, QHeaderView.ResizeMode.Stretch)
 
         self.surfaceLabel = SurfaceLabel(self.translate("surface-text"))
         self.surfaceLabel.setStyleSheet("font-size: 24px;")
@@ -104,13 +232,16 @@ class MainWindow(QWidget):
             filterModeLayout.addWidget(QLabel(self.translate("filter-action")+":"))
             self.filerModeSelect = QRadioButton(self.translate("filter-select-rows"))
             self.filerModeChangeColor = QRadioButton(self.translate("filter-change-bg-color"))
+            self.filerModeHideRows = QRadioButton(self.translate("filter-hide-rows"))
 
             filterModeLayout.addWidget(self.filerModeSelect)
             filterModeLayout.addWidget(self.filerModeChangeColor)
+            filterModeLayout.addWidget(self.filerModeHideRows)
 
             self.filterModeGroup = QButtonGroup()
             self.filterModeGroup.addButton(self.filerModeSelect)
             self.filterModeGroup.addButton(self.filerModeChangeColor)
+            self.filterModeGroup.addButton(self.filerModeHideRows)
             self.filerModeSelect.setChecked(True)
             layout.addLayout(filterModeLayout)
 
@@ -128,97 +259,159 @@ class MainWindow(QWidget):
 
             layout.addLayout(filterButtonLayout)
 
-    def printPages(self, pages:Iterable[int]):
-        if len(pages) == 0:
-            return "-"
-        ordered = sorted(pages)
-        if not self.settings.groupPages:
-            return ",".join([str(p) for p in ordered])
-        ranges:List[str] = []
-        start = ordered[0]
-        prev = ordered[0]
-        for i in range(1, len(ordered)):
-            page = ordered[i]
-            if page - prev > 1:
-                if prev == start:
-                    ranges.append(f"{prev}")
-                else:
-                    ranges.append(f"{start}-{prev}")
-                start = page
-            prev = page
-        if prev == start:
-            ranges.append(f"{prev}")
-        else:
-            ranges.append(f"{start}-{prev}")
-        return ",".join(ranges)
-
     def openFile(self):
+        if self.parseThread is not None:
+            return
         file_dialog = QFileDialog()
-        file_path, _ = file_dialog.getOpenFileName(self, self.translate("open-pdf"), '', 'PDF Files (*.pdf)')
-        if file_path:
-            reader = PdfReader(file_path)
-            stats = sorted(reader.getStats(), key=lambda x: (
-                min(x.dimension.width, x.dimension.height), max(x.dimension.width, x.dimension.height))) 
-
-            self.table.clearContents()
-            self.table.setRowCount(0)
-            for row, stat in enumerate(stats):
-                self.table.insertRow(row)
-                self.table.setItem(row, 0, QTableWidgetItem(str(len(stat.pages))))
-                w = min(stat.dimension.width, stat.dimension.height)
-                h = max(stat.dimension.width, stat.dimension.height)
-                paperSize = self.translate("unknown") if stat.dimension not in self.settings.pageSizes else self.settings.pageSizes[stat.dimension]
-                self.table.setItem(row, 1, QTableWidgetItem(f"{w}x{h} mm"))
-                self.table.setItem(row, 2, QTableWidgetItem(f"{w}"))
-                self.table.setItem(row, 3, QTableWidgetItem(f"{h}"))
-                self.table.setItem(row, 4, QTableWidgetItem(paperSize))
-                self.table.setItem(row, 5, QTableWidgetItem(self.printPages(stat.pages)))
+        file_paths, _ = file_dialog.getOpenFileNames(self, self.translate("open-pdf"), '', 'PDF Files (*.pdf)')
+        self.openFiles(file_paths)
+
+    def openFiles(self, paths:List[str]):
+        if self.parseThread is not None or not paths:
+            return
+        self.file_button.setEnabled(False)
+        self.clearButton.setEnabled(False)
+        self.exportButton.setEnabled(False)
+        self.progressDialog = QProgressDialog(self.translate("loading-pdf"), self.translate("cancel"), 0, 0, self)
+        self.progressDialog.setWindowModality(Qt.WindowModality.WindowModal)
+        self.progressDialog.setMinimumDuration(500)
+        self.progressDialog.setAutoClose(False)
+        self.progressDialog.setAutoReset(False)
+
+        self.openStarted = time.perf_counter()
+        self.parseThread = ParseThread(paths, self.cache, self.opener, self.profilers, self.backends)
+        self.parseThread.progress.connect(self.updateProgress)
+        self.parseThread.fileParsed.connect(self.addDocument)
+        self.parseThread.finished.connect(self.parseFinished)
+        self.progressDialog.canceled.connect(self.parseThread.requestInterruption)
+        self.parseThread.start()
+
+    def dragEnterEvent(self, event:QDragEnterEvent):
+        if self.parseThread is None and any(url.isLocalFile() for url in event.mimeData().urls()):
+            event.acceptProposedAction()
+
+    def dropEvent(self, event:QDropEvent):
+        # Directories are searched for PDF files recursively.
+        paths = [url.toLocalFile() for url in event.mimeData().urls() if url.isLocalFile()]
+        files = collectFiles(paths)
+        if files:
+            event.acceptProposedAction()
+            self.openFiles(files)
+
+    def updateProgress(self, parsed:int, total:int):
+        if self.progressDialog is not None:
+            self.progressDialog.setMaximum(total)
+            self.progressDialog.setValue(parsed)
+
+    def parseFinished(self):
+        self.parseThread.deleteLater()
+        self.parseThread = None
+        self.progressDialog.close()
+        self.progressDialog.deleteLater()
+        self.progressDialog = None
+        self.file_button.setEnabled(True)
+        fill = self.fillTable()
+        total = time.perf_counter() - self.openStarted
+        logEvent("open", files=len(self.documents), ms={"total": round(total * 1000, 3), "fill": round(fill * 1000, 3)})
+        if self.notices:
+            showAlert("\n".join(self.notices))
+            self.notices = []
+
+    def addDocument(self, report:FileReport):
+        if report.metrics is not None:
+            logEvent("parse", file=report.path, error=report.error, backend=report.backend, **report.metrics.asDict())
+        self.notices.extend(f"{os.path.basename(report.path)}: {notice}" for notice in report.notices())
+        # Reopening a file replaces its earlier result.
+        self.documents.pop(report.path, None)
+        self.documents[report.path] = report
+
+    def clearFiles(self):
+        self.documents = {}
+        self.fillTable()
+
+    def exportDocuments(self, pages:bool):
+        # All rows (or pages) of the open documents, not only what the table shows.
+        if self.exportThread is not None or not self.documents:
+            return
+        path, nameFilter = QFileDialog.getSaveFileName(self, self.translate("export-pages" if pages else "export-rows"),
+                                                       '', ";;".join(EXPORT_FILTERS.values()))
+        if not path:
+            return
+        format = next((format for format, text in EXPORT_FILTERS.items() if text == nameFilter), "csv")
+        self.startExport(format, path, pages)
+
+    def startExport(self, format:str, path:str, pages:bool):
+        self.exportButton.setEnabled(False)
+        self.exportThread = ExportThread(list(self.documents.values()), self.settings, format, path, pages)
+        self.exportThread.failed.connect(showAlert)
+        self.exportThread.finished.connect(self.exportFinished)
+        self.exportThread.start()
+
+    def exportFinished(self):
+        self.exportThread.deleteLater()
+        self.exportThread = None
+        self.exportButton.setEnabled(len(self.documents) > 0 and self.parseThread is None)
+
+    # Returns the time spent filling the table in seconds.
+    def fillTable(self) -> float:
+        metrics = ParseMetrics()
+        with metrics.timer("fill"):
+            self.proxyModel.setRowMask(None)
+            self.model.setDocuments(list(self.documents.values()))
+            # The reset cleared the selection without reporting it.
+            self.selectedSurface = SelectionSurface(self.model)
+            self.table.setColumnHidden(FILE_COLUMN, len(self.documents) <= 1)
+            self.clearButton.setEnabled(len(self.documents) > 0)
+            self.exportButton.setEnabled(len(self.documents) > 0 and self.exportThread is None)
+            self.surfaceLabel.setSurface(0)
+        logEvent("fill", files=len(self.documents), rows=self.model.rowCount(), **metrics.asDict())
+        return metrics.times["fill"]
+
+    def closeEvent(self, event:QCloseEvent):
+        if self.parseThread is not None:
+            self.parseThread.requestInterruption()
+            self.parseThread.wait()
+        if self.exportThread is not None:
+            self.exportThread.wait()
+        super().closeEvent(event)
 
     def filterPages(self, filter:Filter):
         self.clearFilter()
-        rowCount = self.table.rowCount()
-        for row in range(rowCount):
-            short = int(self.table.item(row, 2).text())
-            long = int(self.table.item(row, 3).text())
-            if filter.match(short, long):
-                selectionRange = QTableWidgetSelectionRange(row, 0, row, self.table.columnCount() - 1)
-                self.filterAction(selectionRange)
+        mask = self.filterEngine.matchFilter(filter, self.model.table)
+        checkedButton = self.filterModeGroup.checkedButton()
+        if checkedButton == self.filerModeHideRows:
+            self.proxyModel.setRowMask(mask)
+        elif checkedButton == self.filerModeSelect:
+            selection = QItemSelection()
+            lastColumn = self.model.columnCount() - 1
+            for row in np.flatnonzero(mask).tolist():
+                selection.select(self.model.index(row, 0), self.model.index(row, lastColumn))
+            self.table.selectionModel().select(self.proxyModel.mapSelectionFromSource(selection),
+                                               QItemSelectionModel.SelectionFlag.Select)
+        else:
+            self.model.setHighlighted(set(np.flatnonzero(mask).tolist()))
         self.table.setFocus()
 
     def clearFilter(self):
         self.table.clearSelection()
-        rowCount = self.table.rowCount()
-        colCount = self.table.columnCount()
-        for row in range(rowCount):
-            for col in range(colCount):
-                item = self.table.item(row, col)
-                if item:
-                    item.setBackground(QBrush())
-
-    def filterAction(self, selectionRange:QTableWidgetSelectionRange):
-        if self.filterModeGroup.checkedButton() == self.filerModeSelect:
-            self.table.setRangeSelected(selectionRange, True)
-        else:
-            for row in range(selectionRange.topRow(), selectionRange.bottomRow() + 1):
-                for col in range(selectionRange.leftColumn(), selectionRange.rightColumn() + 1):
-                    item = self.table.item(row, col)
-                    if item:
-                        item.setBackground(QBrush(QColor("#abcdd9")))
-
-    def calculateBigPagesSurface(self):
-        selectedRanges = self.table.selectedRanges()
-        selectedRows = set()
-        for selectedRange in selectedRanges:
-            for row in range(selectedRange.topRow(), selectedRange.bottomRow() + 1):
-                selectedRows.add(row)
-        surface = 0
-        for row in selectedRows:
-            count = int(self.table.item(row, 0).text())
-            short = int(self.table.item(row, 2).text())
-            long = int(self.table.item(row, 3).text())
-            surface += count * (short * long)
-
-        self.surfaceLabel.setSurface(surface)
+        self.proxyModel.setRowMask(None)
+        self.model.setHighlighted(set())
+
+    def calculateBigPagesSurface(self, selected:QItemSelection, deselected:QItemSelection):
+        for selectionRange in deselected:
+            self.selectedSurface.change(self.proxyModel.sourceRows(selectionRange.top(), selectionRange.bottom()),
+                                        -selectionRange.width())
+        for selectionRange in selected:
+            self.selectedSurface.change(self.proxyModel.sourceRows(selectionRange.top(), selectionRange.bottom()),
+                                        selectionRange.width())
+        self.surfaceLabel.setSurface(self.selectedSurface.total)
+
+
+def finishStartupProfile(app:QApplication, shown:float):
+    # Runs with the first event loop iteration, once the window is shown.
+    startup.profile.addPhase("first-event", time.perf_counter() - shown)
+    startup.profile.report()
+    app.quit()
 
 
 def showAlert(text:str):
@@ -230,24 +423,37 @@ def showAlert(text:str):
     messageBox.exec()
 
 
-def loadSettings() -> Settings:
-    if getattr(sys, 'frozen', False):
-        scriptPath = sys.executable
-    elif sys.argv[0].endswith('.exe'):
-        scriptPath = sys.argv[0]
-    else:
-        scriptPath = os.path.abspath(__file__)
-    scriptDir = os.path.dirname(scriptPath)
-    filePath = os.path.join(scriptDir, "settings.yaml")
-    return Settings(filePath)
-
-
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    settings = loadSettings()
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="PDF page size reader")
+    parser.add_argument("--stats", action="store_true",
+                        help="log phase timings, counters and table fill times as JSON lines to standard error")
+    parser.add_argument("--profile", metavar="FILE", help="write a cProfile dump of the session to FILE on exit")
+    parser.add_argument(startup.STARTUP_PROFILE_FLAG, action="store_true",
+                        help="print the import time of every module and the time of each startup phase, then exit")
+    args, qtArgs = parser.parse_known_args()
+    if args.stats:
+        enableLogging()
+    profilers:Optional[List[cProfile.Profile]] = None
+    if args.profile:
+        profilers = [cProfile.Profile()]
+        profilers[0].enable()
+
+    with startup.phase("application"):
+        app = QApplication(sys.argv[:1] + qtArgs)
+    with startup.phase("settings"):
+        settings = loadSettings()
     if settings.error is not None:
         showAlert(settings.error)
-    window = MainWindow(settings)
-    window.setWindowTitle(f"PDF page size reader ({BUILD_VERSION})")
-    window.show()
-    sys.exit(app.exec())
+    with startup.phase("window"):
+        window = MainWindow(settings, profilers)
+        window.setWindowTitle(f"PDF page size reader ({BUILD_VERSION})")
+    with startup.phase("show"):
+        window.show()
+    if startup.profile is not None:
+        QTimer.singleShot(0, partial(finishStartupProfile, app, time.perf_counter()))
+    exitCode = app.exec()
+    if profilers is not None:
+        profilers[0].disable()
+        dumpProfile(args.profile, profilers)
+    sys.exit(exitCode)
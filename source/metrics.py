@@ -0,0 +1,88 @@
+from __future__ import annotations
+from contextlib import contextmanager
+
+from typing import Dict, Iterator, List, Optional
+
+import cProfile
+import json
+import logging
+import sys
+import time
+
+
+logger = logging.getLogger("pdf-pages")
+
+# Phases in the order they happen; a parse fills only the ones it goes through.
+PHASES = ["cache", "open", "xref", "page-tree", "boxes", "aggregate", "fill"]
+
+
+class ParseMetrics:
+    # Wall time per phase in seconds and event counters (pages, objects, bytes read...).
+    def __init__(self):
+        self.times:Dict[str, float] = {}
+        self.counters:Dict[str, int] = {}
+
+    @contextmanager
+    def timer(self, phase:str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(phase, time.perf_counter() - start)
+
+    def addTime(self, phase:str, seconds:float):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+    def count(self, name:str, value:int=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other:ParseMetrics):
+        for phase, seconds in other.times.items():
+            self.addTime(phase, seconds)
+        for name, value in other.counters.items():
+            self.count(name, value)
+
+    def total(self) -> float:
+        return sum(self.times.values())
+
+    def asDict(self) -> Dict[str, object]:
+        phases = sorted(self.times, key=lambda x: PHASES.index(x) if x in PHASES else len(PHASES))
+        return {"ms": {phase: round(self.times[phase] * 1000, 3) for phase in phases}, **self.counters}
+
+
+def logEvent(event:str, **fields):
+    # One JSON object per line, so logs can be grepped or loaded with any JSON tool.
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({"event": event, **fields}, ensure_ascii=False))
+
+
+def enableLogging(level:int=logging.INFO):
+    logging.basicConfig(level=level, format="%(message)s", stream=sys.stderr)
+
+
+@contextmanager
+def profiled(path:Optional[str]) -> Iterator[None]:
+    # The dump is a standard pstats file: snakeviz, flameprof or gprof2dot turn it
+    # into flame graphs and call graphs.
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        dumpProfile(path, [profiler])
+
+
+def dumpProfile(path:str, profilers:List[cProfile.Profile]):
+    # cProfile only sees the thread it was enabled in, so threads bring their own
+    # profilers and the results are merged into one dump.
+    import pstats
+    stats = pstats.Stats(profilers[0], stream=sys.stderr)
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(path)
+    print(f"Profile written to {path}", file=sys.stderr)
+    stats.sort_stats("cumulative").print_stats(15)
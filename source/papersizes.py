@@ -0,0 +1,74 @@
+from __future__ import annotations
+from dataclasses import dataclass
+
+from pdf import PageDimension
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class PaperSize:
+    name: str
+    short: int
+    long: int
+    # Largest difference in mm on either side that still matches.
+    tolerance: int = 0
+
+
+@dataclass(frozen=True)
+class PaperSizeMatch:
+    size: PaperSize
+    # Largest difference of the two sides in mm, 0 is an exact match.
+    distance: int
+
+    @property
+    def name(self) -> str:
+        return self.size.name
+
+    @property
+    def confidence(self) -> float:
+        return 1.0 - self.distance / (self.size.tolerance + 1)
+
+
+class PaperSizeIndex:
+    # Sizes are put into square grid buckets over (short, long) that are at
+    # least as wide as any tolerance box, so a lookup only checks the sizes of
+    # a single bucket.
+    def __init__(self, sizes:Iterable[PaperSize]):
+        self.sizes:List[PaperSize] = list(sizes)
+        maxTolerance = max((size.tolerance for size in self.sizes), default=0)
+        self.bucketSize = 2 * maxTolerance + 1
+        self.buckets:Dict[Tuple[int, int], List[PaperSize]] = {}
+        for size in self.sizes:
+            keys = {(self.bucket(short), self.bucket(long))
+                    for short in (size.short - size.tolerance, size.short + size.tolerance)
+                    for long in (size.long - size.tolerance, size.long + size.tolerance)}
+            for key in keys:
+                self.buckets.setdefault(key, []).append(size)
+        self.matches:Dict[Tuple[int, int], Optional[PaperSizeMatch]] = {}
+
+    def bucket(self, side:int) -> int:
+        return side // self.bucketSize
+
+    def classify(self, dimension:PageDimension) -> Optional[PaperSizeMatch]:
+        short, long = min(dimension.width, dimension.height), max(dimension.width, dimension.height)
+        key = (short, long)
+        if key not in self.matches:
+            best:Optional[PaperSizeMatch] = None
+            for size in self.buckets.get((self.bucket(short), self.bucket(long)), ()):
+                distance = max(abs(short - size.short), abs(long - size.long))
+                if distance <= size.tolerance and (best is None or distance < best.distance):
+                    best = PaperSizeMatch(size, distance)
+            self.matches[key] = best
+        return self.matches[key]
+
+    def name(self, dimension:PageDimension, default:str) -> str:
+        match = self.classify(dimension)
+        if match is None:
+            return default
+        if match.distance == 0:
+            return match.name
+        return f"{match.name} (~{match.distance} mm)"
+
+    def __len__(self) -> int:
+        return len(self.sizes)
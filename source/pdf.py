@@ -1,9 +1,33 @@
 from __future__ import annotations
+from array import array
 from dataclasses import dataclass, field
 
-import PyPDF2
+from backends import BACKENDS, BackendSelector, LibraryScanner, Scanner
+from metrics import ParseMetrics, logger
+from scanner import PdfScanner, Box, EncryptedStreamError, ScannerError, TreeEntry
+from sources import ByteSource, SourceOpener, openSource
 
-from typing import List, Dict, Iterable
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TYPE_CHECKING
+
+import bisect
+import heapq
+import itertools
+import math
+import operator
+import time
+
+if TYPE_CHECKING:
+    from cache import ResultCache
+
+
+PROGRESS_INTERVAL = 64
+# Documents with fewer pages are not worth starting worker processes for.
+SHARD_MIN_PAGES = 20000
+MIN_SHARD_PAGES = 2000
+# Bounds the objects a worker holds at once.
+MAX_SHARD_PAGES = 25000
+# Phases that are the work of the parsing backend, summed into its time.
+BACKEND_PHASES = ["xref", "page-tree", "boxes", "shard"]
 
 
 @dataclass(order=True)
@@ -11,48 +35,399 @@ class PageDimension:
     width: int
     height: int
 
+    # Orientation does not matter: 210x297 equals 297x210.
     def __hash__(self) -> int:
-        return hash(frozenset((self.width, self.height)))
+        width, height = self.width, self.height
+        return hash((width, height) if width <= height else (height, width))
+
+    def __eq__(self, other:object) -> bool:
+        if not isinstance(other, PageDimension):
+            return NotImplemented
+        return (self.width == other.width and self.height == other.height) \
+            or (self.width == other.height and self.height == other.width)
+
+
+class PageSet:
+    # Sorted, non-overlapping runs of page numbers: starts[i]..ends[i] inclusive.
+    __slots__ = ("starts", "ends", "count")
+
+    def __init__(self, pages:Iterable[int]=()):
+        self.starts = array("q")
+        self.ends = array("q")
+        self.count = 0
+        for page in pages:
+            self.append(page)
+
+    @classmethod
+    def fromRanges(cls, ranges:Iterable[Tuple[int, int]]) -> PageSet:
+        pageSet = cls()
+        for start, end in ranges:
+            pageSet.addRange(start, end)
+        return pageSet
+
+    def append(self, page:int):
+        ends = self.ends
+        if ends and page == ends[-1] + 1:
+            ends[-1] = page
+            self.count += 1
+        elif not ends or page > ends[-1]:
+            self.starts.append(page)
+            ends.append(page)
+            self.count += 1
+        else:
+            self.addRange(page, page)
+
+    def addRange(self, start:int, end:int):
+        ends = self.ends
+        if ends and start == ends[-1] + 1:
+            ends[-1] = end
+            self.count += end - start + 1
+        elif not ends or start > ends[-1]:
+            self.starts.append(start)
+            ends.append(end)
+            self.count += end - start + 1
+        else:
+            self.update(PageSet.fromSortedRanges([(start, end)]))
 
-    def __eq__(self, other:PageDimension) -> bool:
-        return self.__hash__() == other.__hash__()
+    @classmethod
+    def fromSortedRanges(cls, ranges:Iterable[Tuple[int, int]]) -> PageSet:
+        pageSet = cls()
+        starts, ends = pageSet.starts, pageSet.ends
+        for start, end in ranges:
+            if ends and start <= ends[-1] + 1:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+        pageSet.count = sum(end - start + 1 for start, end in zip(starts, ends))
+        return pageSet
+
+    def update(self, other:PageSet):
+        merged = PageSet.fromSortedRanges(heapq.merge(self.ranges(), other.ranges()))
+        self.starts, self.ends, self.count = merged.starts, merged.ends, merged.count
+
+    def union(self, other:PageSet) -> PageSet:
+        return PageSet.fromSortedRanges(heapq.merge(self.ranges(), other.ranges()))
+
+    def ranges(self) -> Iterator[Tuple[int, int]]:
+        return zip(self.starts, self.ends)
+
+    def first(self) -> int:
+        return self.starts[0] if self.starts else 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[int]:
+        for start, end in self.ranges():
+            yield from range(start, end + 1)
+
+    def __contains__(self, page:int) -> bool:
+        index = bisect.bisect_right(self.starts, page) - 1
+        return index >= 0 and page <= self.ends[index]
+
+    def __eq__(self, other:object) -> bool:
+        if not isinstance(other, PageSet):
+            return NotImplemented
+        return self.starts == other.starts and self.ends == other.ends
+
+    def __repr__(self) -> str:
+        return f"PageSet({formatPages(self)})"
 
 
 @dataclass
 class PageStat:
     dimension: PageDimension
-    pages: List[int] = field(default_factory=list)
+    pages: PageSet = field(default_factory=PageSet)
+    # Surface of the pages in mm² from the unrounded boxes.
+    area: float = 0.0
+
+
+# Called with (parsed pages, total pages); returning False cancels the parse.
+ProgressCallback = Callable[[int, int], bool]
 
 
 class PdfReader:
-    def __init__(self, path:str):
+    def __init__(self, path:str, progress:Optional[ProgressCallback]=None,
+                 cache:Optional[ResultCache]=None, lazy:bool=False, metrics:Optional[ParseMetrics]=None,
+                 opener:SourceOpener=openSource, workers:int=1, backends:Optional[BackendSelector]=None):
         self.path = path
         self.stats:Dict[PageDimension, PageStat] = {}
-        self.parse()
+        self.error:Optional[str] = None
+        self.cancelled = False
+        self.cached = False
+        self.finished = False
+        self.totalPages = 0
+        self.parsedPages = 0
+        # Set when the file had to be recovered; pages that could not be sized
+        # are counted in parsedPages but have no dimension.
+        self.recovered = False
+        self.unsizedPages = PageSet()
+        self.progress = progress
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else ParseMetrics()
+        self.opener = opener
+        # With more than one worker, large documents are split into page tree
+        # shards that are parsed in worker processes.
+        self.workers = workers
+        self.backends = backends if backends is not None else BackendSelector()
+        # The backend that read the pages and the features the xref showed.
+        self.backend:Optional[str] = None
+        self.features:Set[str] = set()
+        if not lazy:
+            self.parse()
 
     def parse(self):
+        for _ in self.iterPages(records=False):
+            pass
+
+    # Yields (page number, dimension) records; stats are updated as pages are read.
+    # Without `records`, sharded parsing only merges the stats of the shards.
+    def iterPages(self, records:bool=True) -> Iterator[Tuple[int, PageDimension]]:
+        metrics = self.metrics
         try:
-            with open(self.path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                num_pages = len(pdf_reader.pages)
-
-                page_sizes = []
-                for page_num in range(num_pages):
-                    page = pdf_reader.pages[page_num]
-                    size = page.cropbox
-                    width = convertPointsToMm(float(size[2]) - float(size[0]))
-                    height = convertPointsToMm(float(size[3]) - float(size[1]))
+            identity = None
+            if self.cache is not None:
+                with metrics.timer("cache"):
+                    identity = self.cache.identify(self.path)
+                    stats = self.cache.get(identity)
+                if stats is not None:
+                    metrics.count("cache-hits")
+                    yield from self.readCached(stats)
+                    return
+
+            with metrics.timer("open"):
+                source = self.opener(self.path)
+            with source:
+                try:
+                    yield from self.readBackends(source, records)
+                finally:
+                    for name, value in source.counters().items():
+                        metrics.count(name, value)
+
+            if identity is not None and self.finished and not self.recovered:
+                self.cache.put(identity, self.stats.values())
+        except Exception as e:
+            self.error = str(e)
+            logger.error("%s: %s", self.path, e)
+        finally:
+            metrics.count("pages", self.parsedPages)
+
+    def readBackends(self, source:ByteSource, records:bool) -> Iterator[Tuple[int, PageDimension]]:
+        # The native scanner reads the xref first: the backend is chosen by the
+        # features of the file, and the page count of the page tree tells when
+        # a library skipped pages it could not read. A backend that fails is
+        # followed by the next one that can read the file; pages already
+        # yielded stay valid and it continues after them.
+        metrics = self.metrics
+        tried:Set[str] = set()
+        errors:List[str] = []
+        probe:Optional[PdfScanner] = None
+        treePages:Optional[int] = None
+        sharded = False
+        start = parseTime(metrics)
+        if "native" in self.backends.order:
+            try:
+                probe = PdfScanner(source, metrics)
+                self.features = probe.features()
+                if BACKENDS["native"].supports(self.features):
+                    treePages = probe.pageCount()
+                    # Shards on worker processes beat any backend on a single core.
+                    sharded = self.workers > 1 and treePages >= SHARD_MIN_PAGES
+            except Exception as e:
+                logger.debug("%s: native scanner failed: %s", self.path, e)
+                metrics.count("fallbacks")
+                tried.add("native")
+                errors.append(f"native: {e}")
+                self.features = {"damaged"}
+                if probe is not None:
+                    probe.close()
+                    probe = None
+            metrics.addTime("backend:native", parseTime(metrics) - start)
+        while True:
+            backend = BACKENDS["native"] if sharded and "native" not in tried else self.backends.next(self.features, tried)
+            if probe is not None and (backend is None or backend.name != "native"):
+                probe.close()
+                probe = None
+            if backend is None:
+                raise ScannerError("; ".join(errors) if errors else
+                                   f"None of the backends {', '.join(self.backends.order)} can read this file "
+                                   f"({', '.join(sorted(self.features)) or 'not damaged'})")
+            tried.add(backend.name)
+            parsedPages = self.parsedPages
+            start = parseTime(metrics)
+            try:
+                scanner = probe if probe is not None else backend.open(source, self.path, metrics)
+                probe = None
+                with scanner:
+                    if isinstance(scanner, LibraryScanner) and treePages is not None and scanner.pageCount() != treePages:
+                        raise ScannerError(f"{scanner.pageCount()} of {treePages} pages could be read")
+                    if backend.recovers:
+                        self.recovered = True
+                    if sharded and backend.name == "native":
+                        yield from self.readShards(scanner, records)
+                    else:
+                        yield from self.readPages(scanner)
+                self.backend = backend.name
+                metrics.count(f"backend:{backend.name}")
+                return
+            except Exception as e:
+                logger.debug("%s: %s backend failed at page %d: %s", self.path, backend.name, self.parsedPages + 1, e)
+                metrics.count("fallbacks")
+                errors.append(f"{backend.name}: {e}")
+                if backend.recovers:
+                    self.recovered = self.parsedPages > parsedPages
+                # Damage is what the native scanner cannot read.
+                if backend.name == "native" and not isinstance(e, EncryptedStreamError):
+                    self.features.add("damaged")
+            finally:
+                metrics.addTime(f"backend:{backend.name}", parseTime(metrics) - start)
+
+    def readShards(self, scanner:PdfScanner, records:bool) -> Iterator[Tuple[int, PageDimension]]:
+        self.totalPages = scanner.pageCount()
+        shardPages = min(MAX_SHARD_PAGES, max(MIN_SHARD_PAGES, math.ceil(self.totalPages / (4 * self.workers))))
+        with self.metrics.timer("page-tree"):
+            shards = scanner.pageTreeShards(shardPages)
+        self.metrics.count("shards", len(shards))
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(min(self.workers, len(shards)))
+        try:
+            futures = [executor.submit(parseShard, self.path, entries, self.opener) for _, entries in shards]
+            # Results are merged in page order, whatever order the workers finish in.
+            for future in futures:
+                shardStats, pageCount, metrics = future.result()
+                first = self.parsedPages
+                for width, height, starts, ends, area in shardStats:
                     dimension = PageDimension(width, height)
                     if dimension not in self.stats:
-                        self.stats[dimension] = PageStat(dimension, [])
-                    self.stats[dimension].pages.append(page_num + 1)
-        except Exception as e:
-            print(e)
+                        self.stats[dimension] = PageStat(dimension)
+                    stat = self.stats[dimension]
+                    stat.area += area
+                    pages = stat.pages
+                    for start, end in zip(starts, ends):
+                        pages.addRange(first + start, first + end)
+                self.parsedPages += pageCount
+                self.metrics.merge(metrics)
+                if records:
+                    yield from sorted((first + page, PageDimension(width, height))
+                                      for width, height, starts, ends, _ in shardStats
+                                      for start, end in zip(starts, ends) for page in range(start, end + 1))
+                if self.progress is not None and not self.progress(self.parsedPages, self.totalPages):
+                    self.cancelled = True
+                    return
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.finished = True
+
+    def readCached(self, stats:Dict[PageDimension, PageStat]) -> Iterator[Tuple[int, PageDimension]]:
+        self.stats = stats
+        self.cached = True
+        self.totalPages = self.parsedPages = sum(len(stat.pages) for stat in stats.values())
+        self.finished = True
+        yield from pageRecords(stats.values())
+
+    def readPages(self, scanner:Scanner) -> Iterator[Tuple[int, PageDimension]]:
+        self.totalPages = scanner.pageCount()
+        # Time spent inside the page tree generator is the walk, the rest of the
+        # loop is aggregation; box resolution is measured by the scanner.
+        timer = time.perf_counter
+        walk = aggregate = 0.0
+        boxTime = getattr(scanner, "boxTime", 0.0)
+        boxes = itertools.islice(scanner.pageBoxes(), self.parsedPages, None)
+        end = object()
+        try:
+            while True:
+                start = timer()
+                box = next(boxes, end)
+                middle = timer()
+                walk += middle - start
+                if box is end:
+                    break
+                if self.progress is not None and self.parsedPages % PROGRESS_INTERVAL == 0:
+                    if not self.progress(self.parsedPages, self.totalPages):
+                        self.cancelled = True
+                        return
+                if box is None:
+                    # Only a recovering scanner yields pages without a box.
+                    self.parsedPages += 1
+                    self.unsizedPages.append(self.parsedPages)
+                    continue
+                width = convertPointsToMm(box[2] - box[0])
+                height = convertPointsToMm(box[3] - box[1])
+                dimension = PageDimension(width, height)
+                self.parsedPages += 1
+                self.addPage(self.parsedPages, dimension, boxArea(box))
+                aggregate += timer() - middle
+                yield self.parsedPages, dimension
+        finally:
+            self.metrics.addTime("page-tree", walk - (getattr(scanner, "boxTime", 0.0) - boxTime))
+            self.metrics.addTime("aggregate", aggregate)
+        self.finished = True
+        if self.progress is not None:
+            self.progress(self.parsedPages, self.totalPages)
+
+    def addPage(self, page:int, dimension:PageDimension, area:float) -> PageStat:
+        if dimension not in self.stats:
+            self.stats[dimension] = PageStat(dimension)
+        stat = self.stats[dimension]
+        stat.pages.append(page)
+        stat.area += area
+        return stat
 
     def getStats(self) -> Iterable[PageStat]:
         return self.stats.values()
 
 
+def parseShard(path:str, entries:List[TreeEntry], opener:SourceOpener=openSource) \
+        -> Tuple[List[Tuple[int, int, array, array, float]], int, ParseMetrics]:
+    # Runs in a worker process, which opens the file itself. Returns the page
+    # ranges and area per dimension with pages numbered from 1 within the shard.
+    metrics = ParseMetrics()
+    stats:Dict[PageDimension, PageStat] = {}
+    page = 0
+    with opener(path) as source, PdfScanner(source, metrics) as scanner:
+        with metrics.timer("shard"):
+            for box in scanner.pageBoxes(entries):
+                page += 1
+                dimension = PageDimension(convertPointsToMm(box[2] - box[0]), convertPointsToMm(box[3] - box[1]))
+                stat = stats.get(dimension)
+                if stat is None:
+                    stat = stats[dimension] = PageStat(dimension)
+                stat.pages.append(page)
+                stat.area += boxArea(box)
+    return [(d.width, d.height, stat.pages.starts, stat.pages.ends, stat.area) for d, stat in stats.items()], page, metrics
+
+
+def pageRecords(stats:Iterable[PageStat], unsizedPages:Optional[PageSet]=None) \
+        -> Iterator[Tuple[int, Optional[PageDimension]]]:
+    # (page number, dimension) in page order, merged lazily from the page sets;
+    # unsized pages have no dimension.
+    runs = [zip(stat.pages, itertools.repeat(stat.dimension)) for stat in stats]
+    if unsizedPages:
+        runs.append(zip(unsizedPages, itertools.repeat(None)))
+    return heapq.merge(*runs, key=operator.itemgetter(0))
+
+
+def parseTime(metrics:ParseMetrics) -> float:
+    return sum(metrics.times.get(phase, 0.0) for phase in BACKEND_PHASES)
+
+
+def formatPages(pages:Iterable[int], groupPages:bool=True) -> str:
+    if not isinstance(pages, PageSet):
+        pages = PageSet(sorted(pages))
+    if len(pages) == 0:
+        return "-"
+    if not groupPages:
+        return ",".join([str(p) for p in pages])
+    return ",".join([f"{start}" if start == end else f"{start}-{end}" for start, end in pages.ranges()])
+
+
 def convertPointsToMm(points:float) -> int:
     mm = round(points * 0.352777778)
-    return mm
\ No newline at end of file
+    return mm
+
+
+def boxArea(box:Box) -> float:
+    # Exact surface in mm², not the product of the rounded sides.
+    return abs((box[2] - box[0]) * (box[3] - box[1])) * (25.4 / 72) ** 2
\ No newline at end of file
@@ -0,0 +1,343 @@
+from __future__ import annotations
+from array import array
+
+from metrics import ParseMetrics, logger
+from scanner import Box, EncryptedStreamError, PdfScanner, Ref, ScannerError, TreeEntry, PAGE_TREE_KEYS, _DictSection, \
+    decodeStream, displayedBox
+from sources import ByteSource
+
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import mmap
+import os
+import re
+
+
+CHUNK_SIZE = 32 * 1024 * 1024
+# Files smaller than this are scanned in the calling process.
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+HEADER_LOOKBEHIND = 40
+KIND_WINDOW = 256
+STREAM_SEARCH_SIZE = 64 * 1024 * 1024
+
+# Object kinds told apart by a look at the start of the object.
+OBJECT = 0
+OBJECT_STREAM = 1
+XREF_STREAM = 2
+CATALOG = 3
+PAGE = 4
+
+_HEADER_BEFORE = re.compile(rb"(?<![0-9])(\d{1,10})[\x00\t\n\f\r ]+(\d{1,5})[\x00\t\n\f\r ]+\Z")
+# What may follow the obj keyword; b"" is the end of the buffer.
+_AFTER_KEYWORD = {b""} | {bytes([c]) for c in b"\x00\t\n\f\r ()<>[]{}/%"}
+_PAGE_TYPE = re.compile(rb"/Type[\x00\t\n\f\r ]*/Page(?![A-Za-z])")
+
+
+class ObjectIndex:
+    # Objects found by scanning: numbers, header offsets and kinds in file
+    # order, plus the offsets of trailer dictionaries.
+    def __init__(self):
+        self.nums = array("q")
+        self.offsets = array("q")
+        self.kinds = bytearray()
+        self.trailers:List[int] = []
+
+    def extend(self, other:ObjectIndex):
+        self.nums.extend(other.nums)
+        self.offsets.extend(other.offsets)
+        self.kinds.extend(other.kinds)
+        self.trailers.extend(other.trailers)
+
+    def __len__(self) -> int:
+        return len(self.nums)
+
+
+def scanBuffer(buf:Union[bytes, mmap.mmap], start:int, end:int, base:int=0) -> ObjectIndex:
+    # Finds "N G obj" headers whose keyword starts in buf[start:end]; offsets are
+    # shifted by `base`. The buffer should reach a little beyond both ends so
+    # that headers and object starts on the chunk boundaries can be read.
+    index = ObjectIndex()
+    find = buf.find
+    headerBefore = _HEADER_BEFORE.search
+    pos = start
+    while True:
+        i = find(b"obj", pos, end)
+        if i < 0:
+            break
+        pos = i + 3
+        if buf[i - 3:i] == b"end" or buf[i + 3:i + 4] not in _AFTER_KEYWORD:
+            continue
+        match = headerBefore(buf, max(0, i - HEADER_LOOKBEHIND), i)
+        if match is None:
+            continue
+        index.nums.append(int(match.group(1)))
+        index.offsets.append(base + match.start())
+        index.kinds.append(objectKind(buf[i + 3:i + 3 + KIND_WINDOW]))
+
+    pos = start
+    while True:
+        i = find(b"trailer", pos, end)
+        if i < 0:
+            break
+        index.trailers.append(base + i)
+        pos = i + 7
+    return index
+
+
+def objectKind(window:bytes) -> int:
+    # Kind of the object that starts the window; what follows its endobj
+    # belongs to the next objects.
+    end = window.find(b"endobj")
+    if end >= 0:
+        window = window[:end]
+    if b"/ObjStm" in window:
+        return OBJECT_STREAM
+    if b"/XRef" in window:
+        return XREF_STREAM
+    if b"/Catalog" in window:
+        return CATALOG
+    if _PAGE_TYPE.search(window):
+        return PAGE
+    return OBJECT
+
+
+def scanFileChunk(path:str, start:int, end:int) -> ObjectIndex:
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as fileMap:
+        return scanBuffer(fileMap, start, end)
+
+
+def chunkRanges(size:int, chunkSize:int=CHUNK_SIZE) -> List[Tuple[int, int]]:
+    return [(start, min(size, start + chunkSize)) for start in range(0, size, chunkSize)]
+
+
+def scanSource(source:ByteSource, path:Optional[str]=None, workers:Optional[int]=None) -> ObjectIndex:
+    # Large files are scanned in chunks by worker processes when the path is
+    # known, otherwise the source is scanned here.
+    workers = workers or os.cpu_count() or 1
+    ranges = chunkRanges(source.size)
+    if path is not None and workers > 1 and source.size >= PARALLEL_MIN_SIZE:
+        from concurrent.futures import ProcessPoolExecutor
+        try:
+            index = ObjectIndex()
+            with ProcessPoolExecutor(min(workers, len(ranges))) as executor:
+                for chunk in executor.map(scanFileChunk, [path] * len(ranges), *zip(*ranges)):
+                    index.extend(chunk)
+            return index
+        except (OSError, RuntimeError) as e:
+            # No process pool here (restricted environment, daemonic worker...).
+            logger.debug("%s: parallel scan failed, scanning in process: %s", path, e)
+
+    if source.buffer is not None:
+        return scanBuffer(source.buffer, 0, source.size)
+    index = ObjectIndex()
+    for start, end in ranges:
+        before = min(start, HEADER_LOOKBEHIND)
+        data = source.read(start - before, end - start + before + KIND_WINDOW + 3)
+        index.extend(scanBuffer(data, before, before + end - start, start - before))
+    return index
+
+
+class RecoveringScanner(PdfScanner):
+    # Rebuilds the object index of a damaged file by scanning it for object
+    # headers. The page tree is walked as far as it can be read; pages that
+    # cannot be sized are yielded as None. Without a usable page tree, the
+    # /Page objects of the file are used in file order.
+    def __init__(self, source:Union[BinaryIO, ByteSource], metrics:Optional[ParseMetrics]=None,
+                 path:Optional[str]=None, workers:Optional[int]=None):
+        self.path = path
+        self.workers = workers
+        self.index = ObjectIndex()
+        # Numbers and kinds of the objects in each readable object stream.
+        self.streamObjects:Dict[int, List[Tuple[int, int]]] = {}
+        super().__init__(source, metrics)
+
+    def loadXref(self):
+        self.index = index = scanSource(self.source, self.path, self.workers)
+        self.metrics.count("recovered-objects", len(index))
+        # Later definitions (incremental updates) replace earlier ones.
+        entries:Dict[int, Tuple[int, int, int]] = {}
+        for num, offset in zip(index.nums, index.offsets):
+            entries[num] = (1, offset, 0)
+        self.sections.append(_DictSection(entries))
+
+        for num, offset, kind in zip(index.nums, index.offsets, index.kinds):
+            if kind == OBJECT_STREAM and entries.get(num) == (1, offset, 0):
+                self.addCompressedEntries(num, entries)
+
+        self.trailer = self.findTrailer()
+        if "/Encrypt" in self.trailer:
+            self.encrypted = True
+            self.metrics.count("encrypted")
+            # The object streams could not be read, the pages in them would be lost.
+            if OBJECT_STREAM in index.kinds:
+                raise EncryptedStreamError("Encrypted document with object streams")
+
+    def addCompressedEntries(self, streamNum:int, entries:Dict[int, Tuple[int, int, int]]):
+        # Objects stored in object streams; direct definitions take precedence.
+        try:
+            stream = self.getObject(streamNum)
+            data = decodeStream(stream)
+            first = stream.dict["/First"]
+            header = data[:first].split()
+            nums = [int(header[i]) for i in range(0, 2 * stream.dict["/N"], 2)]
+            starts = [first + int(header[i]) for i in range(1, 2 * stream.dict["/N"], 2)]
+        except Exception as e:
+            logger.debug("%s: object stream %d is unreadable: %s", self.path, streamNum, e)
+            return
+        self.streamObjects[streamNum] = [(num, objectKind(data[start:min(end, start + KIND_WINDOW)]))
+                                         for num, start, end in zip(nums, starts, starts[1:] + [len(data)])]
+        for i, num in enumerate(nums):
+            entries.setdefault(num, (2, streamNum, i))
+
+    def definedObjects(self) -> Iterator[Tuple[int, int]]:
+        # Numbers and kinds of the objects whose current definition was found,
+        # in file order; objects in object streams come with their stream.
+        entries = self.sections[0].entries
+        for num, offset, kind in zip(self.index.nums, self.index.offsets, self.index.kinds):
+            if entries.get(num) != (1, offset, 0):
+                continue
+            yield num, kind
+            for i, (objectNum, objectKind) in enumerate(self.streamObjects.get(num, [])):
+                if entries.get(objectNum) == (2, num, i):
+                    yield objectNum, objectKind
+
+    def findTrailer(self) -> Dict[str, Any]:
+        # The last trailer or xref stream dictionary with a usable /Root, else
+        # the last catalog object, also in object streams.
+        candidates:List[Tuple[int, Any]] = []
+        for offset in self.index.trailers:
+            candidates.append((offset, lambda offset=offset: self.parseAt(offset + 7)))
+        for num, offset, kind in zip(self.index.nums, self.index.offsets, self.index.kinds):
+            if kind == XREF_STREAM:
+                candidates.append((offset, lambda num=num, offset=offset: self.parseAt(offset, num).dict))
+        for _, parse in sorted(candidates, key=lambda x: x[0], reverse=True):
+            try:
+                trailer = parse()
+                if isinstance(trailer, dict) and "/Pages" in self.resolve(trailer.get("/Root")):
+                    return trailer
+            except Exception:
+                continue
+        catalogs = [num for num, kind in self.definedObjects() if kind == CATALOG]
+        return {"/Root": Ref(catalogs[-1], 0)} if catalogs else {}
+
+    def readStreamData(self, streamDict:Dict[str, Any], offset:int) -> bytes:
+        try:
+            return super().readStreamData(streamDict, offset)
+        except Exception:
+            # Broken /Length: the data ends at the next endstream.
+            data = self.read(offset, STREAM_SEARCH_SIZE)
+            end = data.find(b"endstream")
+            if end < 0:
+                raise ScannerError("Stream without endstream")
+            return data[:end].rstrip(b"\r\n")
+
+    def pageCount(self) -> int:
+        try:
+            return super().pageCount()
+        except Exception:
+            return 0
+
+    def pageBoxes(self) -> Iterator[Optional[Box]]:
+        try:
+            root = self.pagesRoot()
+        except Exception as e:
+            logger.debug("%s: page tree is unreadable: %s", self.path, e)
+            root = None
+        yielded = False
+        if root is not None:
+            for box in self.treeBoxes(root):
+                yielded = True
+                yield box
+        if not yielded:
+            for box in self.orphanBoxes():
+                yielded = True
+                yield box
+        if not yielded:
+            raise ScannerError("No pages could be recovered")
+
+    def treeBoxes(self, root:Any) -> Iterator[Optional[Box]]:
+        visited:Set[int] = set()
+        stack:List[TreeEntry] = [(root, None, None, None)]
+        while stack:
+            ref, mediaBox, cropBox, rotate = stack.pop()
+            if isinstance(ref, Ref):
+                if ref.num in visited:
+                    continue
+                visited.add(ref.num)
+            try:
+                node = self.getObject(ref.num, PAGE_TREE_KEYS) if isinstance(ref, Ref) else ref
+            except Exception:
+                node = None
+            if not isinstance(node, dict):
+                # Page or subtree, it cannot be told; counted as one page.
+                yield None
+                continue
+            mediaBox = self.tryBox(node, "/MediaBox", mediaBox)
+            cropBox = self.tryBox(node, "/CropBox", cropBox)
+            rotate = node.get("/Rotate", rotate)
+
+            if node.get("/Type") == "/Pages" or "/Kids" in node:
+                try:
+                    kids = self.resolve(node.get("/Kids"))
+                except Exception:
+                    kids = None
+                if not isinstance(kids, list):
+                    try:
+                        count = self.resolve(node.get("/Count"))
+                    except Exception:
+                        count = None
+                    for _ in range(count if isinstance(count, int) and count > 0 else 1):
+                        yield None
+                    continue
+                for kid in reversed(kids):
+                    stack.append((kid, mediaBox, cropBox, rotate))
+            else:
+                yield self.shownBox(cropBox if cropBox is not None else mediaBox, rotate, node.get("/UserUnit"))
+
+    def orphanBoxes(self) -> Iterator[Optional[Box]]:
+        for num, kind in self.definedObjects():
+            if kind == PAGE:
+                yield self.inheritedBox(num)
+
+    def inheritedBox(self, num:int) -> Optional[Box]:
+        # Boxes of a page found outside the page tree, looked up along /Parent.
+        mediaBox:Optional[Box] = None
+        cropBox:Optional[Box] = None
+        rotate:Any = None
+        userUnit:Any = None
+        visited:Set[int] = set()
+        ref:Any = Ref(num, 0)
+        while isinstance(ref, Ref) and ref.num not in visited and (mediaBox is None or cropBox is None or rotate is None):
+            visited.add(ref.num)
+            try:
+                node = self.getObject(ref.num, PAGE_TREE_KEYS)
+            except Exception:
+                break
+            if not isinstance(node, dict):
+                break
+            if mediaBox is None:
+                mediaBox = self.tryBox(node, "/MediaBox", None)
+            if cropBox is None:
+                cropBox = self.tryBox(node, "/CropBox", None)
+            if rotate is None:
+                rotate = node.get("/Rotate")
+            if ref.num == num:
+                userUnit = node.get("/UserUnit")
+            ref = node.get("/Parent")
+        return self.shownBox(cropBox if cropBox is not None else mediaBox, rotate, userUnit)
+
+    def shownBox(self, box:Optional[Box], rotate:Any, userUnit:Any) -> Optional[Box]:
+        if box is None or (rotate is None and userUnit is None):
+            return box
+        try:
+            return displayedBox(box, self.resolve(rotate), self.resolve(userUnit))
+        except Exception:
+            return box
+
+    def tryBox(self, node:Dict[str, Any], key:str, inherited:Optional[Box]) -> Optional[Box]:
+        if key not in node:
+            return inherited
+        try:
+            return self.resolveBox(node[key])
+        except Exception:
+            return inherited
@@ -0,0 +1,772 @@
+from __future__ import annotations
+
+from metrics import ParseMetrics
+from sources import ByteSource, fileSource
+
+import mmap
+import re
+import time
+import zlib
+
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+
+WINDOW_SIZE = 4096
+OBJECT_WINDOW_SIZE = 1024
+# Windows kept when the file is not mapped: the page tree walk alternates
+# between the regions of the /Pages nodes and of the pages.
+OBJECT_WINDOWS = 8
+TAIL_SIZE = 1024
+XREF_ENTRY_SIZE = 20
+# Xref table rows read at once when the file is not mapped.
+XREF_CHUNK_ENTRIES = 256
+PAGE_TREE_KEYS = {"/Type", "/Kids", "/Parent", "/MediaBox", "/CropBox", "/Rotate", "/UserUnit"}
+SHARD_KEYS = PAGE_TREE_KEYS | {"/Count"}
+
+_WHITESPACE = b"\x00\t\n\f\r "
+
+_TOKEN = re.compile(rb"""[\x00\t\n\f\r ]*(?:%[^\r\n]*[\x00\t\n\f\r ]*)*(?:
+    (?P<ref>(\d+)[\x00\t\n\f\r ]+(\d+)[\x00\t\n\f\r ]+R)(?![^\x00\t\n\f\r ()<>\[\]{}/%])
+    |(?P<number>[+-]?(?:\d+\.?\d*|\.\d+))
+    |/(?P<name>[^\x00\t\n\f\r ()<>\[\]{}/%]*)
+    |(?P<open><<|\[)
+    |(?P<close>>>|\])
+    |<(?P<hex>[^<>]*)>
+    |(?P<string>\()
+    |(?P<keyword>[^\x00\t\n\f\r ()<>\[\]{}/%]+)
+    )""", re.VERBOSE)
+_STRUCTURE = re.compile(rb"<<|>>|<[^<>]*>|[\[\](]|%[^\r\n]*")
+_SKIP = re.compile(rb"(?:[\x00\t\n\f\r ]+|%[^\r\n]*)*")
+_OBJECT_HEADER = re.compile(rb"[\x00\t\n\f\r ]*(\d+)[\x00\t\n\f\r ]+(\d+)[\x00\t\n\f\r ]+obj")
+_XREF_SUBSECTION = re.compile(rb"[\x00\t\n\f\r ]*(\d+)[ \t]+(\d+)[ \t]*(?:\r\n|\r|\n)")
+_XREF_ENTRY = re.compile(rb"\d{10} \d{5} [fn](?: \r| \n|\r\n)")
+_XREF_TRAILER = re.compile(rb"[\x00\t\n\f\r ]*trailer")
+_NAME_ESCAPE = re.compile(rb"#([0-9A-Fa-f]{2})")
+_STRING_ESCAPES = {ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t",
+                   ord("b"): b"\b", ord("f"): b"\f"}
+
+
+class ScannerError(Exception):
+    pass
+
+
+class EncryptedStreamError(ScannerError):
+    # Object streams of encrypted files are encrypted; the page tree objects
+    # stored in them cannot be read without decrypting.
+    pass
+
+
+class _NeedMore(Exception):
+    pass
+
+
+class Ref(NamedTuple):
+    num: int
+    gen: int
+
+
+class Stream(NamedTuple):
+    dict: Dict[str, Any]
+    data: Union[bytes, memoryview]
+
+
+Box = Tuple[float, float, float, float]
+# A page tree node with what it inherits: (node or reference, /MediaBox, /CropBox, /Rotate).
+TreeEntry = Tuple[Any, Optional[Box], Optional[Box], Any]
+
+
+class _Parser:
+    def __init__(self, buf:bytes, pos:int=0, complete:bool=True):
+        self.buf = buf
+        self.pos = pos
+        self.complete = complete
+
+    def need(self, pos:int):
+        if pos >= len(self.buf):
+            if not self.complete:
+                raise _NeedMore()
+            raise ScannerError("Unexpected end of data")
+
+    def tokenEnd(self, end:int):
+        if end >= len(self.buf) and not self.complete:
+            raise _NeedMore()
+
+    def skip(self):
+        self.pos = _SKIP.match(self.buf, self.pos).end()
+        self.tokenEnd(self.pos)
+
+    def parseObject(self, keep:Optional[Set[str]]=None) -> Any:
+        # With `keep`, values of other keys in the outermost dictionary are
+        # skipped without being built.
+        buf = self.buf
+        limit = len(buf) + 1 if self.complete else len(buf)
+        tokenMatch = _TOKEN.match
+        stack:List[Tuple[bytes, List[Any]]] = []
+        dropValue = False
+        while True:
+            match = tokenMatch(buf, self.pos)
+            if match is None:
+                self.need(_SKIP.match(buf, self.pos).end())
+                raise ScannerError(f"Unexpected data at {self.pos}")
+            self.pos = match.end()
+            if self.pos >= limit:
+                raise _NeedMore()
+            kind = match.lastgroup
+            if dropValue:
+                dropValue = False
+                if kind == "open":
+                    self.skipContainer()
+                elif kind == "string":
+                    self.pos = match.start(kind)
+                    self.parseString()
+                elif kind == "close":
+                    raise ScannerError("Dictionary has odd number of items")
+                continue
+            if kind == "name":
+                name = match.group(kind)
+                if b"#" in name:
+                    name = _NAME_ESCAPE.sub(lambda m: bytes((int(m.group(1), 16),)), bytes(name))
+                value = "/" + name.decode("latin-1")
+            elif kind == "number":
+                text = match.group(kind)
+                value = float(text) if b"." in text else int(text)
+            elif kind == "ref":
+                value = Ref(int(match.group(2)), int(match.group(3)))
+            elif kind == "open":
+                stack.append((match.group(kind), []))
+                continue
+            elif kind == "close":
+                if not stack or (stack[-1][0] == b"[") != (match.group(kind) == b"]"):
+                    raise ScannerError(f"Unbalanced {bytes(match.group(kind))!r}")
+                opener, items = stack.pop()
+                if opener == b"[":
+                    value = items
+                else:
+                    if len(items) % 2:
+                        raise ScannerError("Dictionary has odd number of items")
+                    value = dict(zip(items[::2], items[1::2]))
+            elif kind == "hex":
+                digits = bytes(match.group(kind)).translate(None, _WHITESPACE)
+                if len(digits) % 2:
+                    digits += b"0"
+                value = bytes.fromhex(digits.decode("latin-1"))
+            elif kind == "string":
+                self.pos = match.start(kind)
+                value = self.parseString()
+            else:
+                keyword = match.group(kind)
+                if keyword == b"true":
+                    value = True
+                elif keyword == b"false":
+                    value = False
+                elif keyword == b"null":
+                    value = None
+                else:
+                    raise ScannerError(f"Unexpected token {bytes(keyword[:20])!r}")
+            if not stack:
+                return value
+            items = stack[-1][1]
+            if keep is not None and len(stack) == 1 and stack[0][0] == b"<<" \
+                    and len(items) % 2 == 0 and value not in keep:
+                dropValue = True
+                continue
+            items.append(value)
+
+    def skipContainer(self):
+        buf = self.buf
+        depth = 1
+        while depth:
+            match = _STRUCTURE.search(buf, self.pos)
+            if match is None:
+                self.need(len(buf))
+            self.tokenEnd(match.end())
+            token = match.group()
+            self.pos = match.end()
+            if token == b"<<" or token == b"[":
+                depth += 1
+            elif token == b">>" or token == b"]":
+                depth -= 1
+            elif token == b"(":
+                self.pos = match.start()
+                self.parseString()
+
+    def parseString(self) -> bytes:
+        buf = self.buf
+        pos = self.pos + 1
+        depth = 1
+        result = bytearray()
+        while True:
+            self.need(pos)
+            c = buf[pos]
+            if c == 0x5C:  # backslash
+                self.need(pos + 1)
+                e = buf[pos + 1]
+                if e in _STRING_ESCAPES:
+                    result += _STRING_ESCAPES[e]
+                    pos += 2
+                elif 0x30 <= e <= 0x37:
+                    self.tokenEnd(pos + 4)
+                    end = pos + 1
+                    while end < pos + 4 and end < len(buf) and 0x30 <= buf[end] <= 0x37:
+                        end += 1
+                    result.append(int(bytes(buf[pos + 1:end]), 8) & 0xFF)
+                    pos = end
+                elif e == 0x0D:
+                    pos += 3 if pos + 2 < len(buf) and buf[pos + 2] == 0x0A else 2
+                elif e == 0x0A:
+                    pos += 2
+                else:
+                    result.append(e)
+                    pos += 2
+                continue
+            if c == 0x28:
+                depth += 1
+            elif c == 0x29:
+                depth -= 1
+                if depth == 0:
+                    self.pos = pos + 1
+                    return bytes(result)
+            result.append(c)
+            pos += 1
+
+
+class _TableSection:
+    def __init__(self, scanner:PdfScanner, subsections:List[Tuple[int, int, int]]):
+        self.scanner = scanner
+        self.subsections = subsections
+        self.chunks:Dict[Tuple[int, int], bytes] = {}
+
+    def get(self, num:int) -> Optional[Tuple[int, int, int]]:
+        for start, count, offset in self.subsections:
+            if start <= num < start + count:
+                entry = self.entry(offset, num - start, count)
+                if not _XREF_ENTRY.match(entry):
+                    raise ScannerError(f"Malformed xref entry for object {num}")
+                if entry[17:18] == b"n":
+                    return (1, int(entry[0:10]), int(entry[11:16]))
+        return None
+
+    def entry(self, offset:int, index:int, count:int) -> bytes:
+        if self.scanner.map is not None:
+            return self.scanner.read(offset + index * XREF_ENTRY_SIZE, XREF_ENTRY_SIZE)
+        # Other sources read the rows in chunks, most of them are needed.
+        chunk = index // XREF_CHUNK_ENTRIES
+        data = self.chunks.get((offset, chunk))
+        if data is None:
+            first = chunk * XREF_CHUNK_ENTRIES
+            data = self.scanner.read(offset + first * XREF_ENTRY_SIZE,
+                                     min(XREF_CHUNK_ENTRIES, count - first) * XREF_ENTRY_SIZE)
+            self.chunks[(offset, chunk)] = data
+        pos = index % XREF_CHUNK_ENTRIES * XREF_ENTRY_SIZE
+        return data[pos:pos + XREF_ENTRY_SIZE]
+
+
+class _StreamSection:
+    def __init__(self, data:bytes, widths:List[int], subsections:List[Tuple[int, int, int]]):
+        self.data = data
+        self.widths = widths
+        self.rowSize = sum(widths)
+        self.subsections = subsections
+
+    def get(self, num:int) -> Optional[Tuple[int, int, int]]:
+        for start, count, row in self.subsections:
+            if start <= num < start + count:
+                pos = (row + num - start) * self.rowSize
+                fields = []
+                for width in self.widths:
+                    fields.append(int.from_bytes(self.data[pos:pos + width], "big"))
+                    pos += width
+                kind = fields[0] if self.widths[0] > 0 else 1
+                if kind in (1, 2):
+                    return (kind, fields[1], fields[2])
+        return None
+
+    def hasCompressed(self) -> bool:
+        # Whether any entry is in an object stream (type 2).
+        width = self.widths[0]
+        end = len(self.data) // self.rowSize * self.rowSize
+        if width == 0:
+            return False
+        if width == 1:
+            return 2 in self.data[0:end:self.rowSize]
+        return any(int.from_bytes(self.data[pos:pos + width], "big") == 2 for pos in range(0, end, self.rowSize))
+
+
+class _DictSection:
+    def __init__(self, entries:Dict[int, Tuple[int, int, int]]):
+        self.entries = entries
+
+    def get(self, num:int) -> Optional[Tuple[int, int, int]]:
+        return self.entries.get(num)
+
+
+class PdfScanner:
+    # Reads from a byte source; a plain file is wrapped (and mapped when possible)
+    # and closed with the scanner, a given source stays open.
+    def __init__(self, source:Union[BinaryIO, ByteSource], metrics:Optional[ParseMetrics]=None):
+        self.ownsSource = not isinstance(source, ByteSource)
+        self.source = fileSource(source) if self.ownsSource else source
+        self.metrics = metrics if metrics is not None else ParseMetrics()
+        # Mapped files are parsed in place, other sources through windowed reads.
+        self.map = self.source.buffer
+        self.size = self.source.size
+        self.sections:List[Union[_TableSection, _StreamSection, _DictSection]] = []
+        self.xref:Dict[int, Optional[Tuple[int, int, int]]] = {}
+        self.trailer:Dict[str, Any] = {}
+        self.objects:Dict[int, Any] = {}
+        self.objectStreams:Dict[int, Tuple[bytes, List[int], int]] = {}
+        # Offsets and data of the last objects read from a source that is not
+        # mapped, newest first; the objects that follow them are parsed from them too.
+        self.windows:List[Tuple[int, bytes]] = []
+        # Strings and streams of encrypted files are encrypted, but numbers,
+        # names, references and the xref streams are not: the page boxes are
+        # read as in any other file.
+        self.encrypted = False
+        self.bytesRead = 0
+        self.objectsResolved = 0
+        self.boxTime = 0.0
+        with self.metrics.timer("xref"):
+            self.loadXref()
+
+    def __enter__(self) -> PdfScanner:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.objects.clear()
+        self.objectStreams.clear()
+        self.windows.clear()
+        self.map = None
+        if self.ownsSource:
+            self.source.close()
+        self.flushMetrics()
+
+    def flushMetrics(self):
+        # Hot paths count into plain attributes, they are moved to the metrics here.
+        self.metrics.count("bytes-read", self.bytesRead)
+        self.metrics.count("objects-resolved", self.objectsResolved)
+        self.metrics.addTime("boxes", self.boxTime)
+        self.bytesRead = self.objectsResolved = 0
+        self.boxTime = 0.0
+
+    def read(self, offset:int, length:int) -> bytes:
+        if self.map is not None:
+            data = self.map[offset:offset + length]
+        else:
+            data = self.source.read(offset, length)
+        self.bytesRead += len(data)
+        return data
+
+    def view(self, offset:int, length:int) -> Union[bytes, memoryview]:
+        # Zero-copy slice when the file is mapped.
+        if self.map is not None:
+            data = memoryview(self.map)[offset:offset + length]
+            self.bytesRead += len(data)
+            return data
+        return self.read(offset, length)
+
+    def parseAt(self, offset:int, num:Optional[int]=None, keep:Optional[Set[str]]=None) -> Any:
+        if self.map is not None:
+            # The whole file is addressable, objects are parsed in place.
+            return self.parseBuffer(self.map, offset, offset, True, num, keep)
+        for start, buf in self.windows:
+            if start <= offset < start + len(buf):
+                try:
+                    return self.parseBuffer(buf, offset - start, offset, start + len(buf) >= self.size, num, keep)
+                except (_NeedMore, ScannerError):
+                    # Cut off by the end of the window, possibly in the object header.
+                    break
+        window = OBJECT_WINDOW_SIZE
+        while True:
+            buf = self.readWindow(offset, window)
+            try:
+                return self.parseBuffer(buf, 0, offset, offset + len(buf) >= self.size, num, keep)
+            except _NeedMore:
+                window *= 4
+
+    def readWindow(self, offset:int, length:int) -> bytes:
+        # An object just before a kept window (objects written in reverse
+        # order) only needs the gap read, the window is extended downwards.
+        for i, (start, buf) in enumerate(self.windows):
+            if offset < start <= offset + length:
+                buf = self.read(offset, start - offset) + buf[:length]
+                del self.windows[i]
+                break
+        else:
+            buf = self.read(offset, length)
+        self.windows.insert(0, (offset, buf))
+        del self.windows[OBJECT_WINDOWS:]
+        return buf
+
+    def parseBuffer(self, buf:Union[bytes, mmap.mmap], pos:int, offset:int, complete:bool,
+                    num:Optional[int], keep:Optional[Set[str]]) -> Any:
+        parser = _Parser(buf, pos, complete)
+        if num is not None:
+            match = _OBJECT_HEADER.match(buf, pos)
+            if not match or (num >= 0 and int(match.group(1)) != num):
+                raise ScannerError(f"Object {num} not found at offset {offset}")
+            parser.pos = match.end()
+        value = parser.parseObject(keep)
+        if buf is self.map:
+            self.bytesRead += parser.pos - pos
+        if isinstance(value, dict):
+            parser.skip()
+            if buf[parser.pos:parser.pos + 6] == b"stream":
+                return Stream(value, self.readStreamData(value, offset + parser.pos - pos + 6))
+        return value
+
+    def readStreamData(self, streamDict:Dict[str, Any], offset:int) -> bytes:
+        eol = self.read(offset, 2)
+        if eol.startswith(b"\r\n"):
+            offset += 2
+        elif eol[:1] in (b"\n", b"\r"):
+            offset += 1
+        length = self.resolve(streamDict.get("/Length"))
+        if not isinstance(length, int) or length < 0:
+            raise ScannerError("Invalid stream length")
+        data = self.view(offset, length)
+        if len(data) != length:
+            raise ScannerError("Truncated stream")
+        return data
+
+    def loadXref(self):
+        tail = self.read(max(0, self.size - TAIL_SIZE), TAIL_SIZE)
+        index = tail.rfind(b"startxref")
+        if index < 0:
+            raise ScannerError("startxref not found")
+        match = re.match(rb"startxref[\x00\t\n\f\r ]+(\d+)", tail[index:])
+        if not match:
+            raise ScannerError("Malformed startxref")
+
+        offset:Optional[int] = int(match.group(1))
+        visited:Set[int] = set()
+        while offset is not None:
+            if offset in visited or offset >= self.size:
+                raise ScannerError(f"Invalid xref offset {offset}")
+            visited.add(offset)
+            if self.read(offset, 4) == b"xref":
+                trailer = self.readXrefTable(offset)
+                if "/XRefStm" in trailer:
+                    self.readXrefStream(trailer["/XRefStm"])
+            else:
+                trailer = self.readXrefStream(offset)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            offset = trailer.get("/Prev")
+
+        if "/Root" not in self.trailer:
+            raise ScannerError("Trailer has no /Root")
+        if "/Encrypt" in self.trailer:
+            self.encrypted = True
+            self.metrics.count("encrypted")
+
+    def features(self) -> Set[str]:
+        # What the xref tells about the file; the parsing backend is chosen by it.
+        features = {"encrypted"} if self.encrypted else set()
+        for section in self.sections:
+            if isinstance(section, _StreamSection):
+                features.add("xref-streams")
+                if section.hasCompressed():
+                    features.add("object-streams")
+        return features
+
+    def readXrefTable(self, offset:int) -> Dict[str, Any]:
+        # Classic tables have fixed 20 byte entries, so only the subsection
+        # headers are read here and entries are looked up on demand.
+        subsections:List[Tuple[int, int, int]] = []
+        pos = offset + 4
+        while True:
+            buf = self.read(pos, 64)
+            match = _XREF_TRAILER.match(buf)
+            if match:
+                pos += match.end()
+                break
+            match = _XREF_SUBSECTION.match(buf)
+            if not match or not _XREF_ENTRY.match(buf, match.end()) and int(match.group(2)) > 0:
+                return self.readXrefTableEntries(offset)
+            start, count = int(match.group(1)), int(match.group(2))
+            subsections.append((start, count, pos + match.end()))
+            pos += match.end() + count * XREF_ENTRY_SIZE
+
+        self.sections.append(_TableSection(self, subsections))
+        trailer = self.parseAt(pos)
+        if not isinstance(trailer, dict):
+            raise ScannerError("Malformed trailer")
+        return trailer
+
+    def readXrefTableEntries(self, offset:int) -> Dict[str, Any]:
+        window = WINDOW_SIZE
+        while True:
+            buf = self.read(offset, window)
+            end = buf.find(b"trailer")
+            if end >= 0:
+                break
+            if offset + len(buf) >= self.size:
+                raise ScannerError("xref trailer not found")
+            window *= 4
+
+        entries:Dict[int, Tuple[int, int, int]] = {}
+        tokens = buf[4:end].split()
+        i = 0
+        while i + 1 < len(tokens):
+            start = int(tokens[i])
+            count = int(tokens[i + 1])
+            i += 2
+            for num in range(start, start + count):
+                if tokens[i + 2] == b"n":
+                    entries[num] = (1, int(tokens[i]), int(tokens[i + 1]))
+                i += 3
+
+        self.sections.append(_DictSection(entries))
+        trailer = self.parseAt(offset + end + 7)
+        if not isinstance(trailer, dict):
+            raise ScannerError("Malformed trailer")
+        return trailer
+
+    def readXrefStream(self, offset:int) -> Dict[str, Any]:
+        stream = self.parseAt(offset, -1)
+        if not isinstance(stream, Stream) or stream.dict.get("/Type") != "/XRef":
+            raise ScannerError(f"No xref stream at offset {offset}")
+        widths = stream.dict["/W"]
+        index = stream.dict.get("/Index", [0, stream.dict["/Size"]])
+        data = decodeStream(stream)
+        subsections:List[Tuple[int, int, int]] = []
+        row = 0
+        for i in range(0, len(index), 2):
+            subsections.append((index[i], index[i + 1], row))
+            row += index[i + 1]
+        if len(data) < row * sum(widths):
+            raise ScannerError("Truncated xref stream")
+        self.sections.append(_StreamSection(data, widths, subsections))
+        return stream.dict
+
+    def lookup(self, num:int) -> Optional[Tuple[int, int, int]]:
+        if num not in self.xref:
+            entry = None
+            for section in self.sections:
+                entry = section.get(num)
+                if entry is not None:
+                    break
+            self.xref[num] = entry
+        return self.xref[num]
+
+    def getObject(self, num:int, keep:Optional[Set[str]]=None) -> Any:
+        if num in self.objects:
+            return self.objects[num]
+        entry = self.lookup(num)
+        self.objectsResolved += 1
+        if entry is None:
+            value = None
+        elif entry[0] == 1:
+            value = self.parseAt(entry[1], num, keep)
+        else:
+            value = self.getCompressedObject(entry[1], entry[2], keep)
+        if keep is None:
+            self.objects[num] = value
+        return value
+
+    def getCompressedObject(self, streamNum:int, index:int, keep:Optional[Set[str]]=None) -> Any:
+        if streamNum not in self.objectStreams:
+            if self.encrypted:
+                raise EncryptedStreamError(f"Object stream {streamNum} is encrypted")
+            stream = self.getObject(streamNum)
+            if not isinstance(stream, Stream):
+                raise ScannerError(f"Object {streamNum} is not an object stream")
+            data = decodeStream(stream)
+            first = stream.dict["/First"]
+            header = data[:first].split()
+            offsets = [int(header[i]) for i in range(1, 2 * stream.dict["/N"], 2)]
+            self.objectStreams[streamNum] = (data, offsets, first)
+        data, offsets, first = self.objectStreams[streamNum]
+        if index >= len(offsets):
+            raise ScannerError(f"Object stream {streamNum} has no index {index}")
+        return _Parser(data, first + offsets[index]).parseObject(keep)
+
+    def resolve(self, value:Any) -> Any:
+        while isinstance(value, Ref):
+            value = self.getObject(value.num)
+        return value
+
+    def resolveBox(self, value:Any) -> Optional[Box]:
+        start = time.perf_counter()
+        value = self.resolve(value)
+        if value is None:
+            box = None
+        elif not isinstance(value, list) or len(value) != 4:
+            raise ScannerError("Malformed page box")
+        else:
+            box = tuple(float(self.resolve(v)) for v in value)
+        self.boxTime += time.perf_counter() - start
+        return box
+
+    def pagesRoot(self) -> Any:
+        catalog = self.resolve(self.trailer["/Root"])
+        if not isinstance(catalog, dict) or "/Pages" not in catalog:
+            raise ScannerError("Catalog has no /Pages")
+        return catalog["/Pages"]
+
+    def pageCount(self) -> int:
+        root = self.resolve(self.pagesRoot())
+        count = self.resolve(root.get("/Count")) if isinstance(root, dict) else None
+        return count if isinstance(count, int) else 0
+
+    # Boxes of the pages under `roots` (default: the whole page tree) in page order.
+    def pageBoxes(self, roots:Optional[List[TreeEntry]]=None) -> Iterator[Box]:
+        visited:Set[int] = set()
+        stack:List[TreeEntry] = list(reversed(roots)) if roots is not None else [(self.pagesRoot(), None, None, None)]
+        while stack:
+            ref, mediaBox, cropBox, rotate = stack.pop()
+            if isinstance(ref, Ref):
+                if ref.num in visited:
+                    raise ScannerError("Cycle in page tree")
+                visited.add(ref.num)
+            node = self.getObject(ref.num, PAGE_TREE_KEYS) if isinstance(ref, Ref) else ref
+            if not isinstance(node, dict):
+                raise ScannerError("Malformed page tree node")
+            if "/MediaBox" in node:
+                mediaBox = self.resolveBox(node["/MediaBox"])
+            if "/CropBox" in node:
+                cropBox = self.resolveBox(node["/CropBox"])
+            if "/Rotate" in node:
+                rotate = node["/Rotate"]
+
+            if node.get("/Type") == "/Pages" or "/Kids" in node:
+                kids = self.resolve(node.get("/Kids"))
+                if not isinstance(kids, list):
+                    raise ScannerError("Malformed /Kids")
+                for kid in reversed(kids):
+                    stack.append((kid, mediaBox, cropBox, rotate))
+            else:
+                box = cropBox if cropBox is not None else mediaBox
+                if box is None:
+                    raise ScannerError("Page has no /MediaBox")
+                if rotate is not None or "/UserUnit" in node:
+                    box = displayedBox(box, self.resolve(rotate), self.resolve(node.get("/UserUnit")))
+                yield box
+
+    def pageTreeShards(self, maxPages:int) -> List[Tuple[int, List[TreeEntry]]]:
+        # Splits the page tree into runs of consecutive subtrees of about
+        # `maxPages` pages, using /Count of the intermediate nodes. Only nodes
+        # that are too big are opened; kids of a node whose /Count equals the
+        # number of its kids are pages and are not read at all. Returns the
+        # estimated page count and the entries of each shard in page order.
+        units:List[Tuple[int, TreeEntry]] = []
+        stack:List[TreeEntry] = [(self.pagesRoot(), None, None, None)]
+        visited:Set[int] = set()
+        while stack:
+            ref, mediaBox, cropBox, rotate = stack.pop()
+            if isinstance(ref, Ref):
+                if ref.num in visited:
+                    raise ScannerError("Cycle in page tree")
+                visited.add(ref.num)
+            node = self.getObject(ref.num, SHARD_KEYS) if isinstance(ref, Ref) else ref
+            if not isinstance(node, dict):
+                raise ScannerError("Malformed page tree node")
+            count = self.resolve(node.get("/Count"))
+            isTree = node.get("/Type") == "/Pages" or "/Kids" in node
+            if not isTree or not isinstance(count, int) or count <= maxPages:
+                units.append((count if isTree and isinstance(count, int) else 1, (ref, mediaBox, cropBox, rotate)))
+                continue
+            if "/MediaBox" in node:
+                mediaBox = self.resolveBox(node["/MediaBox"])
+            if "/CropBox" in node:
+                cropBox = self.resolveBox(node["/CropBox"])
+            if "/Rotate" in node:
+                rotate = node["/Rotate"]
+            kids = self.resolve(node.get("/Kids"))
+            if not isinstance(kids, list):
+                raise ScannerError("Malformed /Kids")
+            if count == len(kids):
+                units.extend((1, (kid, mediaBox, cropBox, rotate)) for kid in kids)
+            else:
+                stack.extend((kid, mediaBox, cropBox, rotate) for kid in reversed(kids))
+
+        shards:List[Tuple[int, List[TreeEntry]]] = []
+        pages = 0
+        entries:List[TreeEntry] = []
+        for count, entry in units:
+            if entries and pages + count > maxPages:
+                shards.append((pages, entries))
+                pages, entries = 0, []
+            pages += count
+            entries.append(entry)
+        if entries:
+            shards.append((pages, entries))
+        return shards
+
+
+def displayedBox(box:Box, rotate:Any, userUnit:Any) -> Box:
+    # The box as the page is shown: scaled to points by /UserUnit, with the
+    # sides swapped when /Rotate turns it by 90 or 270 degrees.
+    unit = float(userUnit) if isinstance(userUnit, (int, float)) and userUnit > 0 else 1.0
+    x0, y0, x1, y1 = (v * unit for v in box)
+    if isinstance(rotate, int) and rotate % 180 == 90:
+        return (y0, x0, y1, x1)
+    return (x0, y0, x1, y1)
+
+
+def decodeStream(stream:Stream) -> bytes:
+    filters = stream.dict.get("/Filter")
+    params = stream.dict.get("/DecodeParms")
+    if filters is None:
+        return bytes(stream.data)
+    if not isinstance(filters, list):
+        filters = [filters]
+        params = [params]
+    elif not isinstance(params, list):
+        params = [params] * len(filters)
+
+    data = stream.data
+    for name, param in zip(filters, params):
+        if name != "/FlateDecode":
+            raise ScannerError(f"Unsupported filter {name}")
+        data = zlib.decompressobj().decompress(data)
+        if isinstance(param, dict) and param.get("/Predictor", 1) > 1:
+            data = applyPredictor(data, param)
+    return data
+
+
+def applyPredictor(data:bytes, params:Dict[str, Any]) -> bytes:
+    predictor = params.get("/Predictor", 1)
+    if predictor < 10:
+        raise ScannerError(f"Unsupported predictor {predictor}")
+    colors = params.get("/Colors", 1)
+    bits = params.get("/BitsPerComponent", 8)
+    columns = params.get("/Columns", 1)
+    bpp = max(1, colors * bits // 8)
+    rowSize = (columns * colors * bits + 7) // 8
+
+    result = bytearray()
+    previous = bytearray(rowSize)
+    for start in range(0, len(data) - rowSize, rowSize + 1):
+        kind = data[start]
+        row = bytearray(data[start + 1:start + 1 + rowSize])
+        if kind == 1:
+            for i in range(bpp, rowSize):
+                row[i] = (row[i] + row[i - bpp]) & 0xFF
+        elif kind == 2:
+            for i in range(rowSize):
+                row[i] = (row[i] + previous[i]) & 0xFF
+        elif kind == 3:
+            for i in range(rowSize):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+        elif kind == 4:
+            for i in range(rowSize):
+                left = row[i - bpp] if i >= bpp else 0
+                upLeft = previous[i - bpp] if i >= bpp else 0
+                p = left + previous[i] - upLeft
+                pa, pb, pc = abs(p - left), abs(p - previous[i]), abs(p - upLeft)
+                if pa <= pb and pa <= pc:
+                    row[i] = (row[i] + left) & 0xFF
+                elif pb <= pc:
+                    row[i] = (row[i] + previous[i]) & 0xFF
+                else:
+                    row[i] = (row[i] + upLeft) & 0xFF
+        elif kind != 0:
+            raise ScannerError(f"Unsupported PNG filter {kind}")
+        result += row
+        previous = row
+    return bytes(result)
@@ -0,0 +1,330 @@
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import replace
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from backends import backendSelector
+from batch import Report, parseFile
+from cache import ResultCache, openCache
+from metrics import logger
+from settings import Settings, loadSettings
+from sources import sourceOpener
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class HttpError(Exception):
+    def __init__(self, status:HTTPStatus, message:Optional[str]=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method:str, target:str, headers:Dict[str, str]):
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.headers = headers
+
+    @property
+    def keepAlive(self) -> bool:
+        return self.headers.get("connection", "").lower() != "close"
+
+
+class AnalysisServer:
+    # A minimal HTTP/1.1 front end on asyncio streams; parsing runs on a
+    # process pool and at most `maxConcurrent` files are parsed at a time.
+    def __init__(self, settings:Settings, cache:Optional[ResultCache], workers:Optional[int]=None,
+                 maxConcurrent:Optional[int]=None, maxQueue:int=64, timeout:float=60,
+                 maxUpload:int=512 * 1024 * 1024, allowPaths:bool=False):
+        self.settings = settings
+        self.cache = cache
+        self.opener = sourceOpener(settings)
+        self.backends = backendSelector(settings)
+        # Forked workers would inherit the open client sockets and keep the
+        # connections alive after the server closes them.
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.maxConcurrent = maxConcurrent or workers or os.cpu_count() or 1
+        self.slots = asyncio.Semaphore(self.maxConcurrent)
+        self.maxQueue = maxQueue
+        self.timeout = timeout
+        self.maxUpload = maxUpload
+        self.allowPaths = allowPaths
+        self.waiting = 0
+        self.running = 0
+        self.served = 0
+
+    async def handleConnection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self.readRequest(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                try:
+                    status, body = await self.handle(request, reader)
+                except HttpError as e:
+                    status, body = e.status, {"error": str(e)}
+                    # The body of a rejected request may not have been read.
+                    request.headers["connection"] = "close"
+                except Exception as e:
+                    # A broken worker pool, or a bug: the client still gets an answer.
+                    logger.exception("%s %s failed", request.method, request.path)
+                    status, body = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e) or type(e).__name__}
+                    request.headers["connection"] = "close"
+                await self.writeResponse(writer, status, body, request.keepAlive)
+                if not request.keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def readRequest(self, reader:asyncio.StreamReader) -> Optional[Request]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise
+            return None
+        except asyncio.LimitOverrunError:
+            raise ConnectionError("Request header too large")
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3:
+            raise ConnectionError("Malformed request line")
+        headers:Dict[str, str] = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return Request(parts[0], parts[1], headers)
+
+    async def writeResponse(self, writer:asyncio.StreamWriter, status:HTTPStatus, body:object, keepAlive:bool):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                     f"Content-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(data)}\r\n"
+                     f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n".encode("latin-1") + data)
+        await writer.drain()
+
+    async def handle(self, request:Request, reader:asyncio.StreamReader) -> Tuple[HTTPStatus, object]:
+        if request.path == "/health":
+            return HTTPStatus.OK, {"status": "ok", "running": self.running, "waiting": self.waiting,
+                                   "served": self.served, "max-concurrent": self.maxConcurrent}
+        if request.path != "/analyze":
+            raise HttpError(HTTPStatus.NOT_FOUND)
+
+        if request.method == "GET":
+            path = request.query.get("path")
+            if not self.allowPaths:
+                raise HttpError(HTTPStatus.FORBIDDEN, "Local paths are disabled, start the server with --allow-paths")
+            if path is None or not os.path.isfile(path):
+                raise HttpError(HTTPStatus.NOT_FOUND, f"File not found: {path}")
+            with self.queued():
+                await self.acquireSlot()
+            return HTTPStatus.OK, await self.analyze(path, path, self.cache)
+
+        if request.method == "POST":
+            with self.queued():
+                path = await self.receiveBody(request, reader)
+                try:
+                    await self.acquireSlot()
+                except BaseException:
+                    removeFile(path)
+                    raise
+            try:
+                return HTTPStatus.OK, await self.analyze(path, request.query.get("name", "upload.pdf"), None)
+            finally:
+                removeFile(path)
+
+        raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED)
+
+    @contextmanager
+    def queued(self) -> Iterator[None]:
+        # A request waits from its admission, while its upload is received,
+        # until it gets a worker slot.
+        if self.waiting >= self.maxQueue:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many requests")
+        self.waiting += 1
+        try:
+            yield
+        finally:
+            self.waiting -= 1
+
+    async def acquireSlot(self):
+        # In a task of its own, so that a slot acquired as the timeout fires or
+        # the request is cancelled is given back instead of lost.
+        task = asyncio.ensure_future(self.slots.acquire())
+        try:
+            done, _ = await asyncio.wait([task], timeout=self.timeout)
+        except BaseException:
+            self.abandon(task)
+            raise
+        if not done:
+            self.abandon(task)
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "Timed out waiting for a worker")
+
+    def abandon(self, task:asyncio.Future):
+        def release(task:asyncio.Future):
+            if not task.cancelled() and task.exception() is None:
+                self.slots.release()
+        task.add_done_callback(release)
+        task.cancel()
+
+    async def receiveBody(self, request:Request, reader:asyncio.StreamReader) -> str:
+        # The upload is streamed to a temporary file that the worker maps.
+        chunked = request.headers.get("transfer-encoding", "").lower() == "chunked"
+        if not chunked and "content-length" not in request.headers:
+            raise HttpError(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = 0 if chunked else int(request.headers["content-length"])
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if length > self.maxUpload:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+        file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+        try:
+            with file:
+                received = 0
+                if chunked:
+                    while True:
+                        try:
+                            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                        except ValueError:
+                            raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid chunk size")
+                        received += size
+                        if received > self.maxUpload:
+                            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                        if size == 0:
+                            await reader.readuntil(b"\r\n")
+                            break
+                        await self.copy(reader, file, size)
+                        await reader.readexactly(2)
+                else:
+                    await self.copy(reader, file, length)
+        except BaseException:
+            removeFile(file.name)
+            raise
+        return file.name
+
+    async def copy(self, reader:asyncio.StreamReader, file, length:int):
+        while length > 0:
+            chunk = await reader.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", length)
+            file.write(chunk)
+            length -= len(chunk)
+
+    async def analyze(self, path:str, name:str, cache:Optional[ResultCache]) -> Dict[str, object]:
+        # Called with a worker slot acquired.
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(self.executor, parseFile, path, cache, self.opener, 1, self.backends)
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is freed when the worker is done, even if the request gave
+        # up on it: a running parse cannot be stopped.
+        future.add_done_callback(lambda _: self.slots.release())
+        self.running += 1
+        try:
+            fileReport = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(HTTPStatus.GATEWAY_TIMEOUT, "Parsing timed out")
+        finally:
+            self.running -= 1
+
+        self.served += 1
+        # Errors name the file as the client knows it, not the upload's temp file.
+        error = None if fileReport.error is None else fileReport.error.replace(path, name)
+        if error is not None and not fileReport.stats:
+            raise HttpError(HTTPStatus.UNPROCESSABLE_ENTITY, f"{name}: {error}")
+        report = Report(self.settings)
+        report.add(replace(fileReport, path=name, error=error))
+        return report.files[0]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def removeFile(path:str):
+    try:
+        os.remove(path)
+    except OSError:
+        # Still open by a worker that timed out (Windows).
+        pass
+
+
+async def serve(server:AnalysisServer, host:str, port:int):
+    listener = await asyncio.start_server(server.handleConnection, host, port, limit=MAX_HEADER_SIZE)
+    addresses = ", ".join(str(socket.getsockname()) for socket in listener.sockets)
+    print(f"Listening on {addresses}", file=sys.stderr)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="HTTP service returning the page sizes of PDF files as JSON")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--max-concurrent", type=int, default=None,
+                        help="files parsed at the same time (default: number of workers)")
+    parser.add_argument("--max-queue", type=int, default=64,
+                        help="requests waiting for a worker (uploads from the start of their body) "
+                             "before new ones are rejected with 503")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a worker and for parsing")
+    parser.add_argument("--max-upload-mb", type=float, default=512)
+    parser.add_argument("--allow-paths", action="store_true", help="allow GET /analyze?path=<local file>")
+    parser.add_argument("--settings", help="path of settings.yaml")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the result cache for local paths")
+    args = parser.parse_args(argv)
+
+    settings = Settings(args.settings) if args.settings else loadSettings()
+    if settings.error is not None:
+        print(settings.error, file=sys.stderr)
+        return 2
+
+    async def run():
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass
+        server = AnalysisServer(settings, None if args.no_cache else openCache(settings), args.workers,
+                                args.max_concurrent, args.max_queue, args.timeout,
+                                int(args.max_upload_mb * 1024 * 1024), args.allow_paths)
+        try:
+            await serve(server, args.host, args.port)
+        finally:
+            server.close()
+
+    try:
+        asyncio.run(run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,16 @@
+from backends import BACKENDS, RANKING_FILE
+from papersizes import PaperSize, PaperSizeIndex
 from pdf import PageDimension
+from sources import BLOCK_SIZE, READ_MODES
 
 from typing import Dict, Optional, Tuple, List
 
+import marshal
 import os
 import sys
-import yaml
+
+
+SETTINGS_CACHE_VERSION = 1
 
 
 class Rule:
@@ -60,65 +66,157 @@ class Settings:
     width: int = 1024
     height: int = 400
     pageSizes: Dict[PageDimension, str]
+    paperSizes: PaperSizeIndex
+    paperSizeTolerance:int = 0
     groupPages:bool = True
+    cache:bool = True
+    cacheSize:int = 64
+    readMode:str = "mmap"
+    blockSize:int = BLOCK_SIZE
+    blockCacheSize:int = 4 * 1024 * 1024
+    # Parsing backends in order; empty for the measured or default order.
+    backends:List[str] = []
     error:Optional[str] = None
     filters:List[Filter] = []
     dictionary:Dictionary = Dictionary("default")
 
     def __init__(self, path:str):
         self.pageSizes = {}
+        self.tolerances:Dict[PageDimension, int] = {}
         self.bigPages = []
+        self.backendRanking = os.path.join(os.path.dirname(path), RANKING_FILE)
         self.parse(path)
+        self.paperSizes = PaperSizeIndex(
+            PaperSize(name, min(d.width, d.height), max(d.width, d.height), self.tolerances.get(d, self.paperSizeTolerance))
+            for d, name in self.pageSizes.items())
 
     def parse(self, path:str):
         if not os.path.exists(path):
             return
         try:
-            with open(path, "r", encoding="utf-8") as file:
-                data = yaml.load(file, Loader=yaml.Loader)
-                if "dimensions" in data:
-                    for dimension in data["dimensions"]:
-                        d = PageDimension(int(dimension["size"]["width"]), int(dimension["size"]["height"]))
-                        if d in self.pageSizes:
-                            self.error = f"Same dimension ({d.width}x{d.height}) present multiple times: {self.pageSizes[d]} and {dimension['name']}"
+            data = readSettingsData(path)
+            if "dimensions" in data:
+                for dimension in data["dimensions"]:
+                    d = PageDimension(int(dimension["size"]["width"]), int(dimension["size"]["height"]))
+                    if d in self.pageSizes:
+                        self.error = f"Same dimension ({d.width}x{d.height}) present multiple times: {self.pageSizes[d]} and {dimension['name']}"
+                        return
+                    self.pageSizes[d] = dimension["name"]
+                    if "tolerance" in dimension:
+                        self.tolerances[d] = int(dimension["tolerance"])
+            if "configuration" in data:
+                config = data["configuration"]
+                if "window-size" in config:
+                    windowSize = config["window-size"]
+                    if "width" in windowSize:
+                        self.width = int(windowSize["width"])
+                    if "height" in windowSize:
+                        self.height = int(windowSize["height"])
+                if "paper-size-tolerance" in config:
+                    self.paperSizeTolerance = int(config["paper-size-tolerance"])
+                if "group-pages" in config:
+                    self.groupPages = bool(config["group-pages"])
+                if "result-cache" in config:
+                    resultCache = config["result-cache"]
+                    if "enabled" in resultCache:
+                        self.cache = bool(resultCache["enabled"])
+                    if "max-size-mb" in resultCache:
+                        self.cacheSize = int(resultCache["max-size-mb"])
+                if "file-access" in config:
+                    fileAccess = config["file-access"]
+                    if "mode" in fileAccess:
+                        if fileAccess["mode"] not in READ_MODES:
+                            self.error = f"Unknown file-access mode {fileAccess['mode']}, expected one of {', '.join(READ_MODES)}"
+                            return
+                        self.readMode = fileAccess["mode"]
+                    if "block-size-kb" in fileAccess:
+                        self.blockSize = int(fileAccess["block-size-kb"]) * 1024
+                    if "block-cache-mb" in fileAccess:
+                        self.blockCacheSize = int(fileAccess["block-cache-mb"]) * 1024 * 1024
+                if "parsing" in config and "backends" in config["parsing"]:
+                    backends = config["parsing"]["backends"]
+                    if backends != "auto":
+                        names = backends if isinstance(backends, list) else str(backends).split(",")
+                        self.backends = [name.strip() for name in names]
+                        unknown = [name for name in self.backends if name not in BACKENDS]
+                        if unknown:
+                            self.error = f"Unknown parsing backend {', '.join(unknown)}, expected auto or some of {', '.join(BACKENDS)}"
                             return
-                        self.pageSizes[d] = dimension["name"]
-                if "configuration" in data:
-                    config = data["configuration"]
-                    if "window-size" in config:
-                        windowSize = config["window-size"]
-                        if "width" in windowSize:
-                            self.width = int(windowSize["width"])
-                        if "height" in windowSize:
-                            self.height = int(windowSize["height"])
-                    if "group-pages" in config:
-                        self.groupPages = bool(config["group-pages"])
-                if "filters" in data and data["filters"] is not None:
-                    for filter in data["filters"]:
-                        text = filter["text"]
-                        rules:List[Rule] = []
-                        for ruleData in filter["rules"]:
-                            rules.append(Rule(
-                                ruleData.get("min-short-side", None),
-                                ruleData.get("max-short-side", None),
-                                ruleData.get("min-long-side", None),
-                                ruleData.get("max-long-side", None)
-                            ))
-
-                        self.filters.append(Filter(text, rules))
-                language = "EN"
-                if "language" in data:
-                    language = data["language"]
-                if "dictionaries" in data:
-                    for dictionary in data["dictionaries"]:
-                        name = dictionary["name"]
-                        if name != language:
-                            continue
-                        d = Dictionary(name)
-                        for word in dictionary["words"]:
-                            d.addWord(word["id"], word["value"])
-                        self.dictionary = d
-                        break
+                        if set(self.backends) == {"recovery"}:
+                            self.error = "The recovery parsing backend only reads damaged files, add native or a library backend"
+                            return
+            if "filters" in data and data["filters"] is not None:
+                for filter in data["filters"]:
+                    text = filter["text"]
+                    rules:List[Rule] = []
+                    for ruleData in filter["rules"]:
+                        rules.append(Rule(
+                            ruleData.get("min-short-side", None),
+                            ruleData.get("max-short-side", None),
+                            ruleData.get("min-long-side", None),
+                            ruleData.get("max-long-side", None)
+                        ))
+
+                    self.filters.append(Filter(text, rules))
+            language = "EN"
+            if "language" in data:
+                language = data["language"]
+            if "dictionaries" in data:
+                for dictionary in data["dictionaries"]:
+                    name = dictionary["name"]
+                    if name != language:
+                        continue
+                    d = Dictionary(name)
+                    for word in dictionary["words"]:
+                        d.addWord(word["id"], word["value"])
+                    self.dictionary = d
+                    break
 
         except Exception as e:
             self.error = f"settings.yaml cannot be opened:\n{e}"
+
+
+def readSettingsData(path:str) -> Dict:
+    # The parsed YAML is kept in <path>.cache while the file is unchanged: yaml
+    # is slow to import and to parse, and this runs on every start.
+    info = os.stat(path)
+    key = (SETTINGS_CACHE_VERSION, info.st_size, info.st_mtime_ns)
+    cachePath = path + ".cache"
+    try:
+        with open(cachePath, "rb") as file:
+            cachedKey, data = marshal.load(file)
+        if tuple(cachedKey) == key:
+            return data
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    import yaml
+    with open(path, "r", encoding="utf-8") as file:
+        data = yaml.load(file, Loader=getattr(yaml, "CLoader", yaml.Loader))
+    try:
+        temporaryPath = f"{cachePath}.{os.getpid()}"
+        with open(temporaryPath, "wb") as file:
+            marshal.dump((key, data), file)
+        os.replace(temporaryPath, cachePath)
+    except (OSError, ValueError):
+        # Read-only installation, or values marshal cannot store: no cache.
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+    return data
+
+
+def getScriptDir() -> str:
+    if getattr(sys, 'frozen', False):
+        scriptPath = sys.executable
+    elif sys.argv[0].endswith('.exe'):
+        scriptPath = sys.argv[0]
+    else:
+        scriptPath = os.path.abspath(__file__)
+    return os.path.dirname(scriptPath)
+
+
+def loadSettings() -> Settings:
+    filePath = os.path.join(getScriptDir(), "settings.yaml")
+    return Settings(filePath)
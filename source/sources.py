@@ -0,0 +1,262 @@
+from __future__ import annotations
+from collections import OrderedDict
+from functools import partial
+
+from typing import BinaryIO, Callable, Dict, List, Optional, Union, TYPE_CHECKING
+
+import io
+import mmap
+import time
+
+if TYPE_CHECKING:
+    from settings import Settings
+
+
+BLOCK_SIZE = 4 * 1024
+CACHE_BLOCKS = 1024
+MAX_READ_AHEAD_BLOCKS = 32
+READ_MODES = ["mmap", "file", "blocks"]
+
+
+class ByteSource:
+    # Random access to the bytes of one file. `transferred` and `requests` count
+    # what was fetched from the underlying storage.
+    buffer:Optional[mmap.mmap] = None
+
+    def __init__(self, size:int):
+        self.size = size
+        self.transferred = 0
+        self.requests = 0
+
+    def __enter__(self) -> ByteSource:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, offset:int, length:int) -> bytes:
+        raise NotImplementedError()
+
+    def view(self, offset:int, length:int) -> Union[bytes, memoryview]:
+        return self.read(offset, length)
+
+    def close(self):
+        pass
+
+    def counters(self) -> Dict[str, int]:
+        return {"bytes-transferred": self.transferred, "read-requests": self.requests}
+
+
+class FileSource(ByteSource):
+    def __init__(self, file:BinaryIO, owned:bool=False):
+        file.seek(0, 2)
+        super().__init__(file.tell())
+        self.file = file
+        self.owned = owned
+
+    def read(self, offset:int, length:int) -> bytes:
+        self.file.seek(offset)
+        data = self.file.read(length)
+        self.transferred += len(data)
+        self.requests += 1
+        return data
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+
+class MappedSource(ByteSource):
+    # The scanner parses `buffer` in place; page faults are not visible here, so
+    # no transfer counters are reported.
+    def __init__(self, file:BinaryIO, fileMap:mmap.mmap, owned:bool=False):
+        super().__init__(len(fileMap))
+        self.file = file
+        self.buffer = fileMap
+        self.owned = owned
+
+    def read(self, offset:int, length:int) -> bytes:
+        return self.buffer[offset:offset + length]
+
+    def view(self, offset:int, length:int) -> memoryview:
+        return memoryview(self.buffer)[offset:offset + length]
+
+    def close(self):
+        try:
+            self.buffer.close()
+        except BufferError:
+            # Stream views are still referenced, the map is released with them.
+            pass
+        if self.owned:
+            self.file.close()
+
+    def counters(self) -> Dict[str, int]:
+        return {}
+
+
+class ThrottledSource(ByteSource):
+    # Stand-in for a network share in tests and benchmarks: every request waits
+    # `latency` seconds plus the transfer time at `bandwidth` bytes per second.
+    def __init__(self, inner:ByteSource, latency:float=0.002, bandwidth:float=0):
+        super().__init__(inner.size)
+        self.inner = inner
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def read(self, offset:int, length:int) -> bytes:
+        data = self.inner.read(offset, length)
+        delay = self.latency + (len(data) / self.bandwidth if self.bandwidth > 0 else 0)
+        if delay > 0:
+            time.sleep(delay)
+        self.transferred += len(data)
+        self.requests += 1
+        return data
+
+    def close(self):
+        self.inner.close()
+
+
+class BlockCache(ByteSource):
+    # Reads go through aligned blocks kept in an LRU cache. Adjacent missing
+    # blocks are fetched with one request. A miss right after a run of cached
+    # blocks reads ahead as many blocks as the run has (up to `maxReadAhead`),
+    # so scattered page objects cost one block each and densely packed ones
+    # few requests, even when reads of other regions come in between.
+    def __init__(self, inner:ByteSource, blockSize:int=BLOCK_SIZE, maxBlocks:int=CACHE_BLOCKS,
+                 maxReadAhead:int=MAX_READ_AHEAD_BLOCKS):
+        super().__init__(inner.size)
+        self.inner = inner
+        self.blockSize = blockSize
+        self.maxBlocks = max(1, maxBlocks)
+        self.maxReadAhead = maxReadAhead
+        self.blocks:OrderedDict[int, bytes] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, offset:int, length:int) -> bytes:
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b""
+        blockSize = self.blockSize
+        first, last = offset // blockSize, (end - 1) // blockSize
+        blocks = self.blocks
+        parts:List[bytes] = []
+        index = first
+        while index <= last:
+            block = blocks.get(index)
+            if block is not None:
+                blocks.move_to_end(index)
+                self.hits += 1
+                parts.append(block)
+                index += 1
+                continue
+            runEnd = index
+            while runEnd < last and runEnd + 1 not in blocks:
+                runEnd += 1
+            fetchEnd = runEnd
+            if runEnd == last:
+                readAhead = 0
+                while readAhead < self.maxReadAhead and index - readAhead - 1 in blocks:
+                    readAhead += 1
+                fetchEnd = min(runEnd + readAhead, (self.size - 1) // blockSize)
+            self.fetch(index, fetchEnd)
+            parts.extend(blocks[i] for i in range(index, runEnd + 1))
+            index = runEnd + 1
+        # Evicted only now, a single large read may need more blocks than fit.
+        while len(blocks) > self.maxBlocks:
+            blocks.popitem(last=False)
+        data = parts[0] if len(parts) == 1 else b"".join(parts)
+        start = offset - first * blockSize
+        return data[start:start + end - offset]
+
+    def fetch(self, first:int, last:int):
+        blockSize = self.blockSize
+        data = self.inner.read(first * blockSize, (last - first + 1) * blockSize)
+        self.misses += last - first + 1
+        for i in range(first, last + 1):
+            self.blocks[i] = data[(i - first) * blockSize:(i - first + 1) * blockSize]
+
+    def close(self):
+        self.blocks.clear()
+        self.inner.close()
+
+    def counters(self) -> Dict[str, int]:
+        return {**self.inner.counters(), "block-hits": self.hits, "block-misses": self.misses}
+
+
+class SourceStream(io.RawIOBase):
+    # File object over a source, for readers that need one (PyPDF2).
+    def __init__(self, source:ByteSource):
+        super().__init__()
+        self.source = source
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.source.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        data = self.source.read(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def mapFile(file:BinaryIO) -> Optional[mmap.mmap]:
+    # Falls back to seek/read for in-memory and empty files.
+    try:
+        fileMap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if hasattr(fileMap, "madvise") and hasattr(mmap, "MADV_RANDOM"):
+        # Only the tail and the page tree objects are touched, read-ahead would
+        # pull in the page content in between.
+        fileMap.madvise(mmap.MADV_RANDOM)
+    return fileMap
+
+
+def fileSource(file:BinaryIO, owned:bool=False) -> ByteSource:
+    fileMap = mapFile(file)
+    if fileMap is not None:
+        return MappedSource(file, fileMap, owned)
+    return FileSource(file, owned)
+
+
+def openSource(path:str, mode:str="mmap", blockSize:int=BLOCK_SIZE, cacheBlocks:int=CACHE_BLOCKS,
+               latency:float=0, bandwidth:float=0) -> ByteSource:
+    # "mmap" maps the file, "file" reads the requested ranges uncached and "blocks"
+    # reads through a block cache, which suits network shares best. `latency` and
+    # `bandwidth` throttle the reads to simulate a share.
+    if mode not in READ_MODES:
+        raise ValueError(f"Unknown read mode {mode}")
+    throttled = latency > 0 or bandwidth > 0
+    if mode == "mmap" and not throttled:
+        return fileSource(open(path, 'rb'), True)
+    source:ByteSource = FileSource(open(path, 'rb', buffering=0), True)
+    if throttled:
+        source = ThrottledSource(source, latency, bandwidth)
+    if mode == "blocks":
+        source = BlockCache(source, blockSize, cacheBlocks)
+    return source
+
+
+# Opens the byte source of a path; must be picklable to be sent to worker processes.
+SourceOpener = Callable[[str], ByteSource]
+
+
+def sourceOpener(settings:Settings) -> SourceOpener:
+    return partial(openSource, mode=settings.readMode, blockSize=settings.blockSize,
+                   cacheBlocks=max(1, settings.blockCacheSize // settings.blockSize))
@@ -0,0 +1,140 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from importlib.abc import Loader, MetaPathFinder
+from importlib.machinery import ModuleSpec
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence, TextIO, Tuple
+
+import sys
+import time
+
+
+# Imported first by gui.py, so that with this flag the imports of all other
+# modules are timed. Only the standard library is used here.
+STARTUP_PROFILE_FLAG = "--startup-profile"
+REPORT_MODULES = 25
+
+
+class TimedLoader(Loader):
+    # Delegates to the real loader and times module creation and execution;
+    # extension modules are initialised in create_module.
+    def __init__(self, timer:ImportTimer, name:str, loader:Loader):
+        self.timer = timer
+        self.name = name
+        self.loader = loader
+
+    def __getattr__(self, name:str) -> Any:
+        return getattr(self.loader, name)
+
+    def create_module(self, spec:ModuleSpec) -> Any:
+        with self.timer.measure(self.name):
+            return self.loader.create_module(spec)
+
+    def exec_module(self, module:Any):
+        with self.timer.measure(self.name):
+            self.loader.exec_module(module)
+
+
+class ImportTimer(MetaPathFinder):
+    # Inclusive and own time of every module loaded while installed; own time
+    # excludes the modules it imports.
+    def __init__(self):
+        self.modules:Dict[str, List[float]] = {}
+        self.children:List[float] = []
+        # Time of the imports that were not nested in another timed import.
+        self.total = 0.0
+        self.finding = False
+
+    def find_spec(self, name:str, path:Optional[Sequence[str]], target:Any=None) -> Optional[ModuleSpec]:
+        if self.finding:
+            return None
+        self.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(name, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self.finding = False
+        if spec.loader is not None and not isinstance(spec.loader, TimedLoader):
+            spec.loader = TimedLoader(self, name, spec.loader)
+        return spec
+
+    @contextmanager
+    def measure(self, name:str) -> Iterator[None]:
+        self.children.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self.children.pop()
+            if self.children:
+                self.children[-1] += elapsed
+            else:
+                self.total += elapsed
+            times = self.modules.setdefault(name, [0.0, 0.0])
+            times[0] += elapsed
+            times[1] += elapsed - children
+
+
+class StartupProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imports = ImportTimer()
+        self.phases:List[Tuple[str, float]] = []
+
+    def install(self):
+        sys.meta_path.insert(0, self.imports)
+
+    def uninstall(self):
+        if self.imports in sys.meta_path:
+            sys.meta_path.remove(self.imports)
+
+    @contextmanager
+    def phase(self, name:str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addPhase(name, time.perf_counter() - start)
+
+    def addPhase(self, name:str, seconds:float):
+        self.phases.append((name, seconds))
+
+    def report(self, output:TextIO=sys.stderr):
+        total = time.perf_counter() - self.started
+        modules = sorted(self.imports.modules.items(), key=lambda item: item[1][1], reverse=True)
+        print(f"Startup {total * 1000:.1f} ms, {len(modules)} modules imported in "
+              f"{self.imports.total * 1000:.1f} ms", file=output)
+        print(f"{'phase':<40} {'ms':>10}", file=output)
+        for name, seconds in self.phases:
+            print(f"{name:<40} {seconds * 1000:>10.1f}", file=output)
+        print(f"\n{'module':<40} {'own ms':>10} {'total ms':>10}", file=output)
+        for name, (inclusive, own) in modules[:REPORT_MODULES]:
+            print(f"{name:<40} {own * 1000:>10.1f} {inclusive * 1000:>10.1f}", file=output)
+
+
+profile:Optional[StartupProfile] = None
+
+
+def startProfile() -> Optional[StartupProfile]:
+    # Starts timing imports when the flag is on the command line.
+    global profile
+    if profile is None and STARTUP_PROFILE_FLAG in sys.argv:
+        profile = StartupProfile()
+        profile.install()
+    return profile
+
+
+@contextmanager
+def phase(name:str) -> Iterator[None]:
+    if profile is None:
+        yield
+        return
+    with profile.phase(name):
+        yield
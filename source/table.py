@@ -1,8 +1,252 @@
-from PySide6.QtWidgets import QApplication, QTableWidget
-from PySide6.QtGui import QKeyEvent, QKeySequence
+from PySide6.QtWidgets import QApplication, QTableView
+from PySide6.QtGui import QKeyEvent, QKeySequence, QBrush, QColor, QFont
+from PySide6.QtCore import (Qt, QAbstractTableModel, QModelIndex, QPersistentModelIndex,
+                            QSortFilterProxyModel)
 
+import numpy as np
 
-class TableWidget(QTableWidget):
+from batch import FileReport
+from filters import DimensionTable
+from pdf import PageDimension, PageStat, formatPages
+from settings import Settings
+
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import math
+import os
+
+
+SORT_ROLE = Qt.ItemDataRole.UserRole
+HIGHLIGHT_COLOR = QColor("#abcdd9")
+
+FILE_COLUMN = 0
+COUNT_COLUMN = 1
+DIMENSIONS_COLUMN = 2
+SHORT_COLUMN = 3
+LONG_COLUMN = 4
+PAPER_SIZE_COLUMN = 5
+PAGES_COLUMN = 6
+HEADERS = ["file", "page-count", "dimensions", "short", "long", "paper-size", "pages"]
+
+# Document index of the rows that sum a dimension over all documents.
+COMBINED = -1
+
+ModelIndex = Union[QModelIndex, QPersistentModelIndex]
+
+
+class PageStatRow:
+    __slots__ = ("stat", "count", "short", "long", "paperSize", "pagesText", "document", "fileName")
+
+    def __init__(self, stat:PageStat, paperSize:str, document:int, fileName:str, count:Optional[int]=None):
+        self.stat = stat
+        self.document = document
+        self.fileName = fileName
+        self.count = len(stat.pages) if count is None else count
+        self.short = min(stat.dimension.width, stat.dimension.height)
+        self.long = max(stat.dimension.width, stat.dimension.height)
+        self.paperSize = paperSize
+        self.pagesText:Optional[str] = None
+
+
+class PageStatModel(QAbstractTableModel):
+    def __init__(self, settings:Settings):
+        super().__init__()
+        self.settings = settings
+        self.rows:List[PageStatRow] = []
+        self.table = DimensionTable([])
+        self.fileRows:Dict[PageDimension, List[int]] = {}
+        self.highlighted:Set[int] = set()
+        self.highlightBrush = QBrush(HIGHLIGHT_COLOR)
+        self.combinedFont = QFont()
+        self.combinedFont.setBold(True)
+
+    def translate(self, id:str) -> str:
+        return self.settings.dictionary.getWord(id)
+
+    def setStats(self, stats:List[PageStat]):
+        self.setDocuments([FileReport("", stats)])
+
+    def setDocuments(self, documents:List[FileReport]):
+        # One row per document and dimension, with more than one document
+        # also one combined row per dimension.
+        unknown = self.translate("unknown")
+        paperSizes:Dict[PageDimension, str] = {}
+        combined:Dict[PageDimension, int] = {}
+        areas:Dict[PageDimension, float] = {}
+        rows:List[PageStatRow] = []
+        for index, document in enumerate(documents):
+            fileName = os.path.basename(document.path)
+            for stat in document.stats:
+                if stat.dimension not in paperSizes:
+                    paperSizes[stat.dimension] = self.settings.paperSizes.name(stat.dimension, unknown)
+                row = PageStatRow(stat, paperSizes[stat.dimension], index, fileName)
+                combined[stat.dimension] = combined.get(stat.dimension, 0) + row.count
+                areas[stat.dimension] = areas.get(stat.dimension, 0.0) + stat.area
+                rows.append(row)
+        if len(documents) > 1:
+            allFiles = self.translate("all-files")
+            for dimension, count in combined.items():
+                rows.append(PageStatRow(PageStat(dimension, area=areas[dimension]), paperSizes[dimension],
+                                        COMBINED, allFiles, count))
+        rows.sort(key=lambda row: (row.short, row.long, row.document))
+
+        self.beginResetModel()
+        self.rows = rows
+        self.table = DimensionTable((row.short, row.long, row.count, row.stat.area) for row in rows)
+        self.fileRows = {}
+        for index, row in enumerate(rows):
+            if row.document != COMBINED:
+                self.fileRows.setdefault(row.stat.dimension, []).append(index)
+        self.highlighted = set()
+        self.endResetModel()
+
+    def row(self, row:int) -> PageStatRow:
+        return self.rows[row]
+
+    def rowCount(self, parent:ModelIndex=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent:ModelIndex=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section:int, orientation:Qt.Orientation, role:int=Qt.ItemDataRole.DisplayRole) -> Any:
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.translate(HEADERS[section])
+        return None
+
+    def data(self, index:ModelIndex, role:int=Qt.ItemDataRole.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.displayText(row, column)
+        if role == SORT_ROLE:
+            if column == FILE_COLUMN:
+                return "" if row.document == COMBINED else row.fileName
+            if column == COUNT_COLUMN:
+                return row.count
+            if column == DIMENSIONS_COLUMN:
+                return row.short * 100000 + row.long
+            if column == SHORT_COLUMN:
+                return row.short
+            if column == LONG_COLUMN:
+                return row.long
+            if column == PAPER_SIZE_COLUMN:
+                return row.paperSize
+            return row.stat.pages.first()
+        if role == Qt.ItemDataRole.BackgroundRole and index.row() in self.highlighted:
+            return self.highlightBrush
+        if role == Qt.ItemDataRole.FontRole and row.document == COMBINED:
+            return self.combinedFont
+        return None
+
+    def displayText(self, row:PageStatRow, column:int) -> str:
+        if column == FILE_COLUMN:
+            return row.fileName
+        if column == COUNT_COLUMN:
+            return str(row.count)
+        if column == DIMENSIONS_COLUMN:
+            return f"{row.short}x{row.long} mm"
+        if column == SHORT_COLUMN:
+            return str(row.short)
+        if column == LONG_COLUMN:
+            return str(row.long)
+        if column == PAPER_SIZE_COLUMN:
+            return row.paperSize
+        if row.document == COMBINED:
+            return ""
+        if row.pagesText is None:
+            row.pagesText = formatPages(row.stat.pages, self.settings.groupPages)
+        return row.pagesText
+
+    def surface(self, rows:Iterable[int]) -> float:
+        # Combined rows stand for the document rows of their dimension, so a
+        # document is counted once even if both kinds of rows are selected.
+        selected:Set[int] = set()
+        for row in rows:
+            if self.rows[row].document == COMBINED:
+                selected.update(self.fileRows[self.rows[row].stat.dimension])
+            else:
+                selected.add(row)
+        return math.fsum(self.rows[row].stat.area for row in selected)
+
+    def setHighlighted(self, rows:Set[int]):
+        changed = self.highlighted | rows
+        self.highlighted = set(rows)
+        if changed:
+            self.dataChanged.emit(self.index(min(changed), 0),
+                                  self.index(max(changed), self.columnCount() - 1),
+                                  [Qt.ItemDataRole.BackgroundRole])
+
+
+class SelectionSurface:
+    # Exact surface of the selected rows of a model, updated from the ranges
+    # that selectionChanged reports instead of recomputed from the selection.
+    # A row is selected while any of its cells is; document rows count once,
+    # whether selected themselves or through the combined row of their dimension.
+    def __init__(self, model:PageStatModel):
+        rows = model.rows
+        self.areas = np.array([row.stat.area for row in rows], dtype=np.float64)
+        self.combined = np.array([row.document == COMBINED for row in rows], dtype=bool)
+        self.fileRows = {index: np.array(model.fileRows[row.stat.dimension], dtype=np.int64)
+                         for index, row in enumerate(rows) if row.document == COMBINED}
+        self.cells = np.zeros(len(rows), dtype=np.int64)
+        # Number of selected rows (own and combined) covering each document row.
+        self.coverage = np.zeros(len(rows), dtype=np.int64)
+        self.total = 0.0
+
+    def change(self, rows:np.ndarray, cells:int):
+        # `cells` cells of each of the source rows were selected, or deselected
+        # when negative.
+        wasSelected = self.cells[rows] > 0
+        self.cells[rows] += cells
+        toggled = rows[wasSelected != (self.cells[rows] > 0)]
+        if len(toggled) == 0:
+            return
+        combined = self.combined[toggled]
+        covered = toggled[~combined]
+        if combined.any():
+            covered = np.concatenate([covered, *(self.fileRows[row] for row in toggled[combined].tolist())])
+        covered, counts = np.unique(covered, return_counts=True)
+        wasCovered = self.coverage[covered] > 0
+        self.coverage[covered] += counts if cells > 0 else -counts
+        changed = covered[wasCovered != (self.coverage[covered] > 0)]
+        area = math.fsum(self.areas[changed])
+        self.total += area if cells > 0 else -area
+        if not self.coverage.any():
+            # No rounding residue once everything is deselected.
+            self.total = 0.0
+
+
+class PageStatProxyModel(QSortFilterProxyModel):
+    def __init__(self):
+        super().__init__()
+        self.rowMask:Optional[np.ndarray] = None
+        # Source row of each proxy row, built when needed after sorting or filtering.
+        self.sourceRowMap:Optional[np.ndarray] = None
+        self.setSortRole(SORT_ROLE)
+        for signal in (self.layoutChanged, self.modelReset, self.rowsInserted, self.rowsRemoved):
+            signal.connect(self.clearSourceRowMap)
+
+    def clearSourceRowMap(self):
+        self.sourceRowMap = None
+
+    def sourceRows(self, top:int, bottom:int) -> np.ndarray:
+        if self.sourceRowMap is None:
+            self.sourceRowMap = np.array([self.mapToSource(self.index(row, 0)).row() for row in range(self.rowCount())],
+                                         dtype=np.int64)
+        return self.sourceRowMap[top:bottom + 1]
+
+    def setRowMask(self, rowMask:Optional[np.ndarray]):
+        self.rowMask = rowMask
+        self.invalidateRowsFilter()
+
+    def filterAcceptsRow(self, sourceRow:int, sourceParent:ModelIndex) -> bool:
+        return self.rowMask is None or bool(self.rowMask[sourceRow])
+
+
+class TableView(QTableView):
     def keyPressEvent(self, event:QKeyEvent):
         if event.matches(QKeySequence.StandardKey.Copy) and self.hasFocus():
             self.copyToClipboard()
@@ -16,23 +260,16 @@ class TableWidget(QTableWidget):
         if not selectedIndexes:
             return
 
-        selectedCells = {}
+        model = self.model()
+        selectedCells:Dict[Tuple[int, int], str] = {}
         for index in selectedIndexes:
-            row = index.row()
-            col = index.column()
-            cellValue = str(self.item(row, col).text())
-            selectedCells[(row, col)] = cellValue
-
-        clipboardData = ""
-        maxRow = max([row for row, _ in selectedCells.keys()])
-        maxCol = max([col for _, col in selectedCells.keys()])
-        minRow = min([row for row, _ in selectedCells.keys()])
-        minCol = min([col for _, col in selectedCells.keys()])
-        for row in range(minRow, maxRow + 1):
-            for col in range(minCol, maxCol + 1):
-                cellValue = selectedCells.get((row, col), "")
-                clipboardData += cellValue + ("\t" if col < maxCol else "")
-            clipboardData += "\n"
+            selectedCells[(index.row(), index.column())] = model.data(index)
+
+        rows = [row for row, _ in selectedCells.keys()]
+        cols = [col for _, col in selectedCells.keys()]
+        lines:List[str] = []
+        for row in range(min(rows), max(rows) + 1):
+            lines.append("\t".join(selectedCells.get((row, col), "") for col in range(min(cols), max(cols) + 1)))
 
         clipboard = QApplication.clipboard()
-        clipboard.setText(clipboardData.strip())
+        clipboard.setText("\n".join(lines).strip())
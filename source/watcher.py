@@ -0,0 +1,351 @@
+from __future__ import annotations
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+from backends import BackendSelector, backendSelector
+from batch import CSV_COLUMNS, FileReport, Report, parseFile
+from cache import ResultCache, encodeStats, openCache
+from settings import Settings, loadSettings
+from sources import SourceOpener, openSource, sourceOpener
+
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+import argparse
+import csv
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import sqlite3
+import struct
+import sys
+import time
+
+
+SETTLE_SECONDS = 2.0
+POLL_SECONDS = 1.0
+LOOP_SECONDS = 0.2
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+IN_EVENT = struct.Struct("iIII")
+
+# (size, mtime in ns) of a file
+FileState = Tuple[int, int]
+
+
+def ignoreInterrupt():
+    # Workers are stopped by the watcher, not by the Ctrl+C of the terminal.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def isPdf(path:str) -> bool:
+    return path.lower().endswith(".pdf")
+
+
+def scanFolder(folder:str) -> Dict[str, FileState]:
+    files:Dict[str, FileState] = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            if isPdf(name):
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (info.st_size, info.st_mtime_ns)
+    return files
+
+
+class InotifySource:
+    # Linux only, talks to libc directly so no extra package is needed.
+    def __init__(self, folder:str):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches:Dict[int, str] = {}
+        for root, _, _ in os.walk(folder):
+            self.addWatch(root)
+
+    def addWatch(self, path:str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.watches[wd] = path
+
+    def poll(self, timeout:float) -> Tuple[Set[str], List[str]]:
+        # Returns the changed PDF files and the directories that have to be
+        # scanned again (new directories, or everything after an overflow).
+        paths:Set[str] = set()
+        rescan:List[str] = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return paths, rescan
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = IN_EVENT.unpack_from(data, pos)
+                name = os.fsdecode(data[pos + IN_EVENT.size:pos + IN_EVENT.size + length].rstrip(b"\0"))
+                pos += IN_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    rescan.extend(set(self.watches.values()))
+                    continue
+                if wd not in self.watches:
+                    continue
+                path = os.path.join(self.watches[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        for root, _, _ in os.walk(path):
+                            self.addWatch(root)
+                        rescan.append(path)
+                elif isPdf(name):
+                    paths.add(path)
+        return paths, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingSource:
+    def __init__(self, folder:str, interval:float=POLL_SECONDS):
+        self.folder = folder
+        self.interval = interval
+        self.files = scanFolder(folder)
+        self.nextScan = time.monotonic() + interval
+
+    def poll(self, timeout:float) -> Tuple[Set[str], List[str]]:
+        now = time.monotonic()
+        if now < self.nextScan:
+            time.sleep(min(timeout, self.nextScan - now))
+            return set(), []
+        files = scanFolder(self.folder)
+        changed = {path for path, state in files.items() if self.files.get(path) != state}
+        self.files = files
+        self.nextScan = time.monotonic() + self.interval
+        return changed, []
+
+    def close(self):
+        pass
+
+
+class WatchState:
+    # Processed files survive restarts, unchanged files are not parsed again.
+    def __init__(self, path:str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS processed (
+                                         path TEXT PRIMARY KEY,
+                                         size INTEGER NOT NULL,
+                                         mtime INTEGER NOT NULL,
+                                         processed REAL NOT NULL,
+                                         pages INTEGER NOT NULL,
+                                         error TEXT,
+                                         data BLOB NOT NULL)""")
+        self.files:Dict[str, FileState] = {path: (size, mtime) for path, size, mtime in
+                                           self.connection.execute("SELECT path, size, mtime FROM processed")}
+
+    def isProcessed(self, path:str, state:FileState) -> bool:
+        return self.files.get(path) == state
+
+    def record(self, path:str, state:FileState, report:FileReport):
+        pages = sum(len(stat.pages) for stat in report.stats)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (path, state[0], state[1], time.time(), pages, report.error,
+                                     encodeStats(report.stats)))
+        self.files[path] = state
+
+    def close(self):
+        self.connection.close()
+
+
+class ReportWriter:
+    # Appends rows to a CSV file, the header is written for new files only.
+    def __init__(self, path:str, settings:Settings):
+        self.report = Report(settings)
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "a", encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.file, CSV_COLUMNS, extrasaction="ignore", lineterminator="\n")
+        if not exists:
+            self.writer.writeheader()
+
+    def write(self, fileReport:FileReport):
+        self.writer.writerows(self.report.rows(fileReport))
+        self.writer.writerows(self.report.noticeRows(fileReport))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class HotFolderWatcher:
+    def __init__(self, folder:str, state:WatchState, output:ReportWriter, cache:Optional[ResultCache],
+                 workers:Optional[int]=None, settle:float=SETTLE_SECONDS, polling:bool=False,
+                 pollInterval:float=POLL_SECONDS, opener:SourceOpener=openSource,
+                 backends:Optional[BackendSelector]=None):
+        self.folder = os.path.abspath(folder)
+        self.state = state
+        self.output = output
+        self.cache = cache
+        self.opener = opener
+        self.backends = backends
+        self.workers = workers or os.cpu_count() or 1
+        # At most this many files are submitted at once, the rest wait in the
+        # ready queue as plain paths.
+        self.maxInFlight = 2 * self.workers
+        self.settle = settle
+        self.polling = polling
+        self.pollInterval = pollInterval
+        # path -> (state, time the state was first seen)
+        self.candidates:Dict[str, Tuple[FileState, float]] = {}
+        self.ready:Deque[Tuple[str, FileState]] = deque()
+        self.queued:Set[str] = set()
+        self.inFlight:Dict[Future, Tuple[str, FileState]] = {}
+        self.stopped = False
+
+    def openSource(self):
+        if not self.polling:
+            try:
+                return InotifySource(self.folder)
+            except OSError as e:
+                print(f"inotify is not available ({e}), polling every {self.pollInterval} s", file=sys.stderr)
+        return PollingSource(self.folder, self.pollInterval)
+
+    def stop(self, *args):
+        self.stopped = True
+
+    def addCandidates(self, paths:Set[str]):
+        now = time.monotonic()
+        for path in paths:
+            # Repeated events of a file only restart its settle time, the
+            # last seen state is kept.
+            lastState = self.candidates[path][0] if path in self.candidates else (-1, -1)
+            self.candidates[path] = (lastState, now)
+
+    def rescan(self, folder:str):
+        self.addCandidates(set(scanFolder(folder)))
+
+    def checkCandidates(self):
+        now = time.monotonic()
+        busy = {path for path, _ in self.inFlight.values()}
+        for path, (lastState, since) in list(self.candidates.items()):
+            try:
+                info = os.stat(path)
+            except OSError:
+                del self.candidates[path]
+                continue
+            state = (info.st_size, info.st_mtime_ns)
+            if state != lastState:
+                self.candidates[path] = (state, now)
+            elif now - since >= self.settle and path not in busy and path not in self.queued:
+                del self.candidates[path]
+                if not self.state.isProcessed(path, state):
+                    self.ready.append((path, state))
+                    self.queued.add(path)
+
+    def submit(self, executor:ProcessPoolExecutor):
+        while self.ready and len(self.inFlight) < self.maxInFlight:
+            path, state = self.ready.popleft()
+            self.queued.discard(path)
+            self.inFlight[executor.submit(parseFile, path, self.cache, self.opener, 1, self.backends)] = (path, state)
+
+    def collect(self, timeout:float):
+        if not self.inFlight:
+            return
+        done, _ = wait(list(self.inFlight), timeout, FIRST_COMPLETED)
+        for future in done:
+            path, state = self.inFlight.pop(future)
+            try:
+                report = future.result()
+            except Exception as e:
+                report = FileReport(path, error=str(e))
+            # The report is written first: after a crash a file may be reported
+            # twice, but never lost.
+            self.output.write(report)
+            self.state.record(path, state, report)
+            pages = sum(len(stat.pages) for stat in report.stats)
+            print(f"{path}: {pages} page(s)" + "".join(f", {notice}" for notice in report.notices()), file=sys.stderr)
+
+    def idle(self) -> bool:
+        return not self.candidates and not self.ready and not self.inFlight
+
+    def run(self, once:bool=False):
+        # With `once`, files already in the folder are processed and the
+        # watcher returns when there is nothing left to do.
+        source = self.openSource()
+        try:
+            self.rescan(self.folder)
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=ignoreInterrupt) as executor:
+                while not self.stopped:
+                    paths, folders = source.poll(0 if self.inFlight else LOOP_SECONDS)
+                    self.addCandidates(paths)
+                    for folder in folders:
+                        self.rescan(folder)
+                    self.checkCandidates()
+                    self.submit(executor)
+                    self.collect(LOOP_SECONDS if self.inFlight else 0)
+                    if once and self.idle():
+                        break
+                # Files being parsed are finished, queued ones are picked up
+                # again after a restart.
+                while self.inFlight:
+                    self.collect(None)
+        finally:
+            source.close()
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Watch a folder and report the page sizes of new or changed PDF files")
+    parser.add_argument("folder")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--report", default="watch-report.csv", help="CSV file the results are appended to")
+    parser.add_argument("--state", default="watch-state.sqlite", help="database of the processed files")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                        help="seconds a file has to stay unchanged before it is parsed")
+    parser.add_argument("--polling", action="store_true", help="poll the folder instead of using inotify")
+    parser.add_argument("--poll-interval", type=float, default=POLL_SECONDS)
+    parser.add_argument("--once", action="store_true", help="process the current files and exit")
+    parser.add_argument("--settings", help="path of settings.yaml")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the result cache")
+    args = parser.parse_args(argv)
+
+    settings = Settings(args.settings) if args.settings else loadSettings()
+    if settings.error is not None:
+        print(settings.error, file=sys.stderr)
+        return 2
+    if not os.path.isdir(args.folder):
+        print(f"{args.folder} is not a directory", file=sys.stderr)
+        return 1
+
+    state = WatchState(args.state)
+    output = ReportWriter(args.report, settings)
+    watcher = HotFolderWatcher(args.folder, state, output, None if args.no_cache else openCache(settings),
+                               args.workers, args.settle, args.polling, args.poll_interval, sourceOpener(settings),
+                               backendSelector(settings))
+    signal.signal(signal.SIGINT, watcher.stop)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    try:
+        watcher.run(args.once)
+    finally:
+        output.close()
+        state.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+from generate import CorpusSpec, convertPointsToMm, createCorpusPdf
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(TEST_DIR, "..", "source")
+CORPUS_DIR = os.path.join(TEST_DIR, "corpus")
+BASELINE_PATH = os.path.join(TEST_DIR, "benchmark-baseline.json")
+RANKING_PATH = os.path.join(SOURCE_DIR, "backend-ranking.json")
+MB = 1024 * 1024
+
+CASES:Dict[str, CorpusSpec] = {
+    "classic-2k": CorpusSpec(),
+    "inherited-2k": CorpusSpec(inherited=True),
+    "xref-streams-2k": CorpusSpec(xrefStreams=True),
+    "object-streams-2k": CorpusSpec(objectStreams=True),
+    "incremental-2k": CorpusSpec(incrementalUpdates=5),
+    "sizes-10k": CorpusSpec(pages=10000, sizes=500),
+    "inherited-50k": CorpusSpec(pages=50000, sizes=50, inherited=True, objectStreams=True),
+    "large-file": CorpusSpec(pages=500, fileSize=200 * MB),
+    # Read by the recovery scanner, all pages should still be found.
+    "damaged-catalog-2k": CorpusSpec(inherited=True, damage="catalog"),
+    "truncated-object-streams-2k": CorpusSpec(objectStreams=True, damage="truncated"),
+    # Sizes as shown: rotated by an inherited /Rotate, scaled by /UserUnit.
+    "rotated-2k": CorpusSpec(inherited=True, rotated=True),
+    "rotated-50k": CorpusSpec(pages=50000, sizes=50, inherited=True, rotated=True),
+    # Generating and reading (with PyPDF2) the encrypted cases needs pycryptodome.
+    "encrypted-2k": CorpusSpec(encrypted=True),
+    "encrypted-xref-streams-2k": CorpusSpec(xrefStreams=True, encrypted=True),
+    "encrypted-object-streams-2k": CorpusSpec(objectStreams=True, encrypted=True),
+    "encrypted-inherited-50k": CorpusSpec(pages=50000, sizes=50, inherited=True, xrefStreams=True, encrypted=True),
+}
+DEFAULT_CASES = [name for name, spec in CASES.items() if not spec.encrypted]
+TARGETS = ["reader", "gui", "share", "shards"]
+# Not run by default: PdfReader with only this parsing backend. --save-ranking
+# stores their speed for the automatic backend order.
+BACKEND_TARGETS = ["native", "pikepdf", "pypdf", "pypdf2"]
+# Simulated network share for the "share" target: block reads with this much latency per request.
+SHARE_LATENCY = 0.002
+
+
+def corpusFile(name:str, spec:CorpusSpec) -> Tuple[str, str]:
+    # Returns the path and the digest of the expected page sizes. Files are
+    # regenerated when the spec of the case changes.
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    path = os.path.join(CORPUS_DIR, f"{name}.pdf")
+    specPath = os.path.join(CORPUS_DIR, f"{name}.json")
+    if os.path.exists(path) and os.path.exists(specPath):
+        with open(specPath, encoding="utf-8") as file:
+            stored = json.load(file)
+            if stored.get("spec") == asdict(spec):
+                return path, stored["sizes"]
+    print(f"Generating {path}", file=sys.stderr)
+    dimensions = createCorpusPdf(path, spec)
+    sizes = sizesDigest((convertPointsToMm(d.width), convertPointsToMm(d.height)) for d in dimensions)
+    with open(specPath, "w", encoding="utf-8") as file:
+        json.dump({"spec": asdict(spec), "sizes": sizes}, file)
+    return path, sizes
+
+
+def sizesDigest(sizes:Iterable[Optional[Tuple[int, int]]]) -> str:
+    # Page sizes in mm in page order, unsized pages as "-". Like in the
+    # reports, a size is in the orientation of the first page that has it.
+    digest = hashlib.sha1()
+    shown:Dict[Tuple[int, int], Tuple[int, int]] = {}
+    for size in sizes:
+        if size is None:
+            digest.update(b"-;")
+            continue
+        size = shown.setdefault((min(size), max(size)), size)
+        digest.update(b"%dx%d;" % size)
+    return digest.hexdigest()
+
+
+def peakRss() -> Optional[float]:
+    # ru_maxrss survives exec on Linux and would include the parent process,
+    # VmHWM is reset for the new process image.
+    try:
+        with open("/proc/self/status", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+
+def measure(path:str, target:str, repeat:int) -> Dict[str, object]:
+    # Runs in a fresh process so that the peak RSS belongs to this case only.
+    sys.path.insert(0, SOURCE_DIR)
+    from backends import BACKENDS, BackendSelector
+    from pdf import PdfReader, pageRecords
+    from sources import openSource
+
+    if target in BACKEND_TARGETS and not BACKENDS[target].available():
+        return {"pages": 0, "error": f"{target} is not installed", "seconds": float("inf"), "peak-rss-mb": None,
+                "sizes": None}
+    backends = BackendSelector([target]) if target in BACKEND_TARGETS else None
+    opener = partial(openSource, mode="blocks", latency=SHARE_LATENCY) if target == "share" else openSource
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        reader = PdfReader(path, opener=opener, workers=(os.cpu_count() or 1) if target == "shards" else 1,
+                           backends=backends)
+        elapsed = time.perf_counter() - start
+        if target == "gui":
+            elapsed = measureFill(reader)
+        best = min(best, elapsed)
+    transferred = reader.metrics.counters.get("bytes-transferred")
+    sizes = sizesDigest(None if dimension is None else (dimension.width, dimension.height)
+                        for _, dimension in pageRecords(reader.stats.values(), reader.unsizedPages))
+    return {"pages": reader.parsedPages, "error": reader.error, "seconds": best, "peak-rss-mb": peakRss(), "sizes": sizes,
+            "transferred-mb": None if transferred is None else transferred / MB}
+
+
+def measureFill(reader) -> float:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtWidgets import QApplication
+    from batch import FileReport
+    from gui import MainWindow
+    from settings import loadSettings
+
+    app = QApplication.instance() or QApplication([])
+    settings = loadSettings()
+    settings.cache = False
+    window = MainWindow(settings)
+    window.show()
+    app.processEvents()
+    start = time.perf_counter()
+    window.addDocument(FileReport(reader.path, list(reader.getStats()), reader.error))
+    window.fillTable()
+    app.processEvents()
+    elapsed = time.perf_counter() - start
+    window.close()
+    window.deleteLater()
+    app.processEvents()
+    return elapsed
+
+
+def runCase(path:str, target:str, repeat:int) -> Dict[str, object]:
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(measure, path, target, repeat).result()
+
+
+def compare(result:Dict[str, object], baseline:Optional[Dict[str, object]], tolerance:float) -> List[str]:
+    if baseline is None:
+        return []
+    regressions = []
+    for key in ["seconds", "peak-rss-mb"]:
+        if result.get(key) is not None and baseline.get(key):
+            ratio = result[key] / baseline[key]
+            if ratio > 1 + tolerance:
+                regressions.append(f"{key} {ratio:.2f}x")
+    return regressions
+
+
+def saveRanking(results:Dict[str, Dict[str, object]], cases:List[str], path:str):
+    # Geometric mean of the pages/s of each backend over the cases that all
+    # measured backends read.
+    backends = [target for target in BACKEND_TARGETS if any(key.endswith("/" + target) for key in results)]
+    common = [name for name in cases if all(results.get(f"{name}/{backend}", {}).get("error") is None
+                                            for backend in backends)]
+    if not backends or not common:
+        print("No case was read by every backend, the ranking is not saved", file=sys.stderr)
+        return
+    speeds = {backend: math.exp(sum(math.log(results[f"{name}/{backend}"]["pages"]
+                                             / results[f"{name}/{backend}"]["seconds"]) for name in common) / len(common))
+              for backend in backends}
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"pages-per-second": speeds, "cases": common}, file, indent=2)
+    print(f"Backend ranking saved to {path}: " + ", ".join(f"{backend} {speeds[backend]:.0f} pages/s"
+                                                            for backend in sorted(speeds, key=speeds.get, reverse=True)))
+
+
+def formatRow(columns:List[str]) -> str:
+    widths = [20, 7, 8, 10, 12, 10, 10]
+    return "  ".join(column.ljust(width) for column, width in zip(columns, widths)) + "  " + " ".join(columns[len(widths):])
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark PdfReader and the GUI fill path on a generated corpus")
+    parser.add_argument("--cases", default=",".join(DEFAULT_CASES),
+                        help=f"comma separated case names (default: all but the encrypted ones): {', '.join(CASES)}")
+    parser.add_argument("--targets", default=",".join(TARGETS),
+                        help=f"comma separated: {', '.join(TARGETS + BACKEND_TARGETS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--save-ranking", nargs="?", const=RANKING_PATH, metavar="PATH",
+                        help="store the pages/s of the backend targets as the automatic backend order "
+                             "(default: backend-ranking.json next to settings.yaml)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    baseline:Dict[str, Dict[str, object]] = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    results:Dict[str, Dict[str, object]] = {}
+    failed = False
+    print(formatRow(["case", "target", "pages", "seconds", "pages/s", "peak MiB", "read MiB", "baseline"]))
+    for name in args.cases.split(","):
+        path, sizes = corpusFile(name, CASES[name])
+        for target in args.targets.split(","):
+            key = f"{name}/{target}"
+            result = runCase(path, target, args.repeat)
+            results[key] = result
+            regressions = compare(result, baseline.get(key), args.tolerance)
+            status = "no baseline" if key not in baseline else "ok"
+            if result["error"] is not None or result["pages"] != CASES[name].pages:
+                status = f"FAILED: {result['error'] or 'page count mismatch'}"
+            elif result["sizes"] != sizes:
+                status = "FAILED: page size mismatch"
+            elif regressions:
+                status = "REGRESSION: " + ", ".join(regressions)
+            failed |= status.startswith(("FAILED", "REGRESSION"))
+            rss = result["peak-rss-mb"]
+            transferred = result.get("transferred-mb")
+            print(formatRow([name, target, str(result["pages"]), f"{result['seconds']:.4f}",
+                             f"{result['pages'] / result['seconds']:.0f}", "-" if rss is None else f"{rss:.1f}",
+                             "-" if transferred is None else f"{transferred:.2f}", status]))
+
+    if args.save_ranking:
+        saveRanking(results, args.cases.split(","), args.save_ranking)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,19 @@
-from PyPDF2 import PdfWriter, PageObject, PaperSize
+from PyPDF2 import PaperSize
 from PyPDF2.papersizes import Dimensions
 
 from reportlab.pdfgen import canvas
 
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import argparse
+import hashlib
 import random
+import zlib
+
 
-from typing import Dict
+PAGE_TREE_FANOUT = 32
+OBJECT_STREAM_SIZE = 100
 
 def convertPointsToMm(points:float) -> int:
     mm = round(points * 0.352777778)
@@ -50,8 +58,6 @@ def rotate(dimension:Dimensions, orientation:str) -> Dimensions:
 
 orientations = ['portrait', 'landscape']
 
-pdfWriter = PdfWriter()
-
 def createRandomPdf(filename:str, numPages:int):
     c = canvas.Canvas(filename)
     pages = []
@@ -105,4 +111,336 @@ def createRandomPdf(filename:str, numPages:int):
 
     c.save()
 
-createRandomPdf('output.pdf', 2000)
+
+@dataclass
+class CorpusSpec:
+    pages: int = 2000
+    # Number of distinct page sizes, standard sizes are used first.
+    sizes: int = 20
+    # Page boxes are set on intermediate /Pages nodes instead of every page.
+    inherited: bool = False
+    objectStreams: bool = False
+    xrefStreams: bool = False
+    incrementalUpdates: int = 0
+    # Approximate file size in bytes, padded with page content streams.
+    fileSize: int = 0
+    seed: int = 0
+    # AES-256 encrypted with an owner password only, as supplier files often are.
+    encrypted: bool = False
+    # "catalog": the catalog object is overwritten with null, "truncated": the
+    # file ends before its last xref section. Both are read by recovery.
+    damage: str = ""
+    # /Rotate 90 on the root /Pages node, inherited by most pages; some pages
+    # override it with /Rotate 270, others with /Rotate 0 /UserUnit 2.
+    rotated: bool = False
+
+
+def genSizePool(count:int) -> List[Dimensions]:
+    pool:List[Dimensions] = []
+    for dimension in pageSizes.values():
+        for orientation in orientations:
+            if rotate(dimension, orientation) not in pool:
+                pool.append(rotate(dimension, orientation))
+    while len(pool) < count:
+        dimension = Dimensions(convertMmToPoints(random.randint(10, 120) * 10),
+                               convertMmToPoints(random.randint(10, 120) * 10))
+        if dimension not in pool:
+            pool.append(dimension)
+    return pool[:count]
+
+
+def genPageDimensions(numPages:int, numSizes:int) -> List[Dimensions]:
+    pool = genSizePool(numSizes)
+    runs = [(dimension, 1) for dimension in pool[:numPages]]
+    remainingPageCount = numPages - len(runs)
+    while remainingPageCount > 0:
+        count = min(random.randint(1, 15), remainingPageCount)
+        runs.append((random.choice(pool), count))
+        remainingPageCount -= count
+    random.shuffle(runs)
+    return [dimension for dimension, count in runs for _ in range(count)]
+
+
+def genPageKeys(numPages:int, rotated:bool) -> List[bytes]:
+    # Keys written into every page object besides its boxes.
+    if not rotated:
+        return [b""] * numPages
+    return [random.choices([b"", b" /Rotate 270", b" /Rotate 0 /UserUnit 2"], [8, 1, 1])[0] for _ in range(numPages)]
+
+
+def displayedDimension(dimension:Dimensions, keys:bytes, rotated:bool) -> Dimensions:
+    # The size a reader reports for a page written with these keys.
+    if b"/UserUnit 2" in keys:
+        return Dimensions(dimension.width * 2, dimension.height * 2)
+    if rotated and b"/Rotate 0" not in keys:
+        return Dimensions(dimension.height, dimension.width)
+    return dimension
+
+
+def formatBox(dimension:Dimensions) -> bytes:
+    return f"[0 0 {dimension.width:g} {dimension.height:g}]".encode("ascii")
+
+
+class Aes256Encryption:
+    # Standard security handler revision 6 (AES-256) with an empty user
+    # password. Needs pycryptodome, which PyPDF2 also needs to read the files.
+    # Has its own random generator, so the pages are the same as without encryption.
+    def __init__(self, seed:int=0, ownerPassword:bytes=b"owner", permissions:int=-3904):
+        from Crypto.Cipher import AES
+        from Crypto.Util.Padding import pad
+        self.aes = AES
+        self.pad = pad
+        self.random = random.Random(seed)
+        self.key = self.random.randbytes(32)
+        self.permissions = permissions
+        userSalts = self.random.randbytes(16)
+        ownerSalts = self.random.randbytes(16)
+        self.u = self.hash(b"", userSalts[:8], b"") + userSalts
+        self.ue = AES.new(self.hash(b"", userSalts[8:], b""), AES.MODE_CBC, bytes(16)).encrypt(self.key)
+        self.o = self.hash(ownerPassword, ownerSalts[:8], self.u) + ownerSalts
+        self.oe = AES.new(self.hash(ownerPassword, ownerSalts[8:], self.u), AES.MODE_CBC, bytes(16)).encrypt(self.key)
+        perms = permissions.to_bytes(4, "little", signed=True) + b"\xff\xff\xff\xffTadb" + self.random.randbytes(4)
+        self.perms = AES.new(self.key, AES.MODE_ECB).encrypt(perms)
+        self.id = self.random.randbytes(16)
+
+    def hash(self, password:bytes, salt:bytes, userKey:bytes) -> bytes:
+        # Algorithm 2.B of ISO 32000-2.
+        key = hashlib.sha256(password + salt + userKey).digest()
+        round = 0
+        while True:
+            round += 1
+            data = (password + key + userKey) * 64
+            encrypted = self.aes.new(key[:16], self.aes.MODE_CBC, key[16:32]).encrypt(data)
+            key = [hashlib.sha256, hashlib.sha384, hashlib.sha512][sum(encrypted[:16]) % 3](encrypted).digest()
+            if round >= 64 and encrypted[-1] <= round - 32:
+                return key[:32]
+
+    def dictionary(self) -> bytes:
+        return (b"<< /Filter /Standard /V 5 /R 6 /Length 256 /P %d "
+                b"/CF << /StdCF << /AuthEvent /DocOpen /CFM /AESV3 /Length 32 >> >> /StmF /StdCF /StrF /StdCF "
+                b"/U <%s> /UE <%s> /O <%s> /OE <%s> /Perms <%s> >>"
+                % (self.permissions, self.u.hex().encode(), self.ue.hex().encode(), self.o.hex().encode(),
+                   self.oe.hex().encode(), self.perms.hex().encode()))
+
+    def encrypt(self, data:bytes) -> bytes:
+        iv = self.random.randbytes(16)
+        return iv + self.aes.new(self.key, self.aes.MODE_CBC, iv).encrypt(self.pad(data, 16))
+
+
+class RawPdfWriter:
+    # Writes objects directly so that the page tree layout, object streams and
+    # xref sections can be chosen freely.
+    def __init__(self, file:BinaryIO, objectStreams:bool, xrefStreams:bool,
+                 encryption:Optional[Aes256Encryption]=None):
+        self.file = file
+        self.objectStreams = objectStreams
+        self.xrefStreams = xrefStreams or objectStreams
+        self.encryption = encryption
+        self.size = 1
+        self.entries:Dict[int, Tuple[int, int, int]] = {}
+        self.pending:List[Tuple[int, bytes]] = []
+        self.lastXref:Optional[int] = None
+        self.file.write(b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n" if encryption is None else b"%PDF-2.0\n%\xe2\xe3\xcf\xd3\n")
+        # Written before the other objects and never into an object stream.
+        self.trailerKeys = b""
+        if encryption is not None:
+            num = self.reserve()
+            self.entries[num] = (1, self.file.tell(), 0)
+            self.file.write(b"%d 0 obj\n%s\nendobj\n" % (num, encryption.dictionary()))
+            self.trailerKeys = b" /Encrypt %d 0 R /ID [<%s> <%s>]" % (num, encryption.id.hex().encode(),
+                                                                      encryption.id.hex().encode())
+
+    def reserve(self) -> int:
+        self.size += 1
+        return self.size - 1
+
+    def writeObject(self, num:int, body:bytes):
+        if self.objectStreams:
+            self.pending.append((num, body))
+            if len(self.pending) >= OBJECT_STREAM_SIZE:
+                self.flushObjectStream()
+            return
+        self.entries[num] = (1, self.file.tell(), 0)
+        self.file.write(b"%d 0 obj\n%s\nendobj\n" % (num, body))
+
+    def writeStream(self, num:int, dictBody:bytes, data:bytes, encrypt:bool=True):
+        # Xref streams are not encrypted.
+        if encrypt and self.encryption is not None:
+            data = self.encryption.encrypt(data)
+        self.entries[num] = (1, self.file.tell(), 0)
+        self.file.write(b"%d 0 obj\n<< %s /Length %d >>\nstream\n" % (num, dictBody, len(data)))
+        self.file.write(data)
+        self.file.write(b"\nendstream\nendobj\n")
+
+    def flushObjectStream(self):
+        if not self.pending:
+            return
+        num = self.reserve()
+        header = b" ".join(b"%d %d" % (objectNum, offset) for objectNum, offset in self.objectOffsets())
+        body = b"\n".join(objectBody for _, objectBody in self.pending)
+        data = zlib.compress(header + b"\n" + body)
+        for index, (objectNum, _) in enumerate(self.pending):
+            self.entries[objectNum] = (2, num, index)
+        self.writeStream(num, b"/Type /ObjStm /N %d /First %d /Filter /FlateDecode" % (len(self.pending), len(header) + 1),
+                         data)
+        self.pending = []
+
+    def objectOffsets(self) -> List[Tuple[int, int]]:
+        offsets = []
+        offset = 0
+        for num, body in self.pending:
+            offsets.append((num, offset))
+            offset += len(body) + 1
+        return offsets
+
+    def writeXref(self, root:int):
+        # Every call starts a new section that covers the objects written since
+        # the previous one, so repeated calls produce incremental updates.
+        self.flushObjectStream()
+        prev = b"" if self.lastXref is None else b" /Prev %d" % self.lastXref
+        if self.xrefStreams:
+            num = self.reserve()
+            offset = self.file.tell()
+            self.entries[num] = (1, offset, 0)
+            nums = sorted(self.entries) if self.lastXref is not None else list(range(self.size))
+            rows = b"".join(bytes((self.entries.get(n, (0, 0, 0))[0],))
+                            + self.entries.get(n, (0, 0, 0))[1].to_bytes(4, "big")
+                            + self.entries.get(n, (0, 0, 0))[2].to_bytes(2, "big") for n in nums)
+            index = b" ".join(b"%d 1" % n for n in nums) if self.lastXref is not None else b"0 %d" % self.size
+            self.writeStream(num, b"/Type /XRef /Size %d /Root %d 0 R /W [1 4 2] /Index [%s] /Filter /FlateDecode%s%s"
+                             % (self.size, root, index, prev, self.trailerKeys), zlib.compress(rows), False)
+        else:
+            offset = self.file.tell()
+            self.file.write(b"xref\n")
+            if self.lastXref is None:
+                self.file.write(b"0 %d\n0000000000 65535 f \n" % self.size)
+                for n in range(1, self.size):
+                    self.file.write(b"%010d %05d n \n" % (self.entries[n][1], self.entries[n][2]))
+            else:
+                for n in sorted(self.entries):
+                    self.file.write(b"%d 1\n%010d %05d n \n" % (n, self.entries[n][1], self.entries[n][2]))
+            self.file.write(b"trailer\n<< /Size %d /Root %d 0 R%s%s >>\n" % (self.size, root, prev, self.trailerKeys))
+        self.file.write(b"startxref\n%d\n%%%%EOF\n" % offset)
+        self.lastXref = offset
+        self.entries = {}
+
+
+def writePageTree(writer:RawPdfWriter, dimensions:List[Dimensions], inherited:bool, contentSize:int,
+                  pageKeys:Optional[List[bytes]]=None, rootKeys:bytes=b"") -> Tuple[int, List[int], Dict[int, int]]:
+    # Returns the catalog, the page object numbers and the parent of every node.
+    catalog = writer.reserve()
+    groups:List[Tuple[Optional[Dimensions], List[int]]] = []
+    pageNums = [writer.reserve() for _ in dimensions]
+    start = 0
+    while start < len(dimensions):
+        end = start + 1
+        while end < len(dimensions) and end - start < PAGE_TREE_FANOUT \
+                and (not inherited or dimensions[end] == dimensions[start]):
+            end += 1
+        groups.append((dimensions[start] if inherited else None, pageNums[start:end]))
+        start = end
+
+    # Nodes are (number, box, kids, page count), built bottom-up.
+    level = [(writer.reserve(), box, kids, len(kids)) for box, kids in groups]
+    nodes = list(level)
+    while len(level) > 1:
+        level = [(writer.reserve(), None, [node[0] for node in level[i:i + PAGE_TREE_FANOUT]],
+                  sum(node[3] for node in level[i:i + PAGE_TREE_FANOUT]))
+                 for i in range(0, len(level), PAGE_TREE_FANOUT)]
+        nodes.extend(level)
+    root = level[0][0]
+
+    parents:Dict[int, int] = {}
+    for num, _, kids, _ in nodes:
+        for kid in kids:
+            parents[kid] = num
+    writer.writeObject(catalog, b"<< /Type /Catalog /Pages %d 0 R >>" % root)
+    for num, box, kids, count in reversed(nodes):
+        parent = rootKeys if num == root else b" /Parent %d 0 R" % parents[num]
+        mediaBox = b"" if box is None else b" /MediaBox " + formatBox(box)
+        writer.writeObject(num, b"<< /Type /Pages%s /Kids [%s] /Count %d%s >>"
+                           % (parent, b" ".join(b"%d 0 R" % kid for kid in kids), count, mediaBox))
+
+    content = random.randbytes(contentSize) if contentSize > 0 else b""
+    for num, dimension, keys in zip(pageNums, dimensions, pageKeys or [b""] * len(dimensions)):
+        mediaBox = b"" if inherited else b" /MediaBox " + formatBox(dimension)
+        contents = b""
+        if content:
+            contentNum = writer.reserve()
+            writer.writeStream(contentNum, b"", content)
+            contents = b" /Contents %d 0 R" % contentNum
+        writer.writeObject(num, b"<< /Type /Page /Parent %d 0 R%s%s%s >>" % (parents[num], mediaBox, keys, contents))
+    return catalog, pageNums, parents
+
+
+def createCorpusPdf(filename:str, spec:CorpusSpec) -> List[Dimensions]:
+    # Returns the expected size of every page, as it is shown.
+    random.seed(spec.seed)
+    dimensions = genPageDimensions(spec.pages, spec.sizes)
+    pool = genSizePool(spec.sizes)
+    pageKeys = genPageKeys(spec.pages, spec.rotated)
+    contentSize = spec.fileSize // spec.pages if spec.pages > 0 else 0
+    with open(filename, 'wb') as file:
+        writer = RawPdfWriter(file, spec.objectStreams, spec.xrefStreams,
+                              Aes256Encryption(spec.seed) if spec.encrypted else None)
+        catalog, pageNums, parents = writePageTree(writer, dimensions, spec.inherited, contentSize, pageKeys,
+                                                   b" /Rotate 90" if spec.rotated else b"")
+        writer.writeXref(catalog)
+        for _ in range(spec.incrementalUpdates):
+            # Each update resizes a few pages by rewriting their page objects.
+            for index in random.sample(range(spec.pages), max(1, spec.pages // 100)):
+                dimensions[index] = random.choice(pool)
+                writer.writeObject(pageNums[index], b"<< /Type /Page /Parent %d 0 R /MediaBox %s%s >>"
+                                   % (parents[pageNums[index]], formatBox(dimensions[index]), pageKeys[index]))
+            writer.writeXref(catalog)
+    if spec.damage:
+        damageFile(filename, spec.damage, catalog, writer.lastXref)
+    return [displayedDimension(dimension, keys, spec.rotated) for dimension, keys in zip(dimensions, pageKeys)]
+
+
+def damageFile(filename:str, damage:str, catalog:int, lastXref:int):
+    with open(filename, 'r+b') as file:
+        if damage == "truncated":
+            file.truncate(lastXref)
+            return
+        if damage != "catalog":
+            raise ValueError(f"Unknown damage {damage}")
+        # Same length, so that the xref offsets stay valid.
+        data = file.read()
+        start = data.index(b"\n%d 0 obj\n" % catalog) + len(b"\n%d 0 obj\n" % catalog)
+        end = data.index(b"\nendobj", start)
+        file.seek(start)
+        file.write(b"null".ljust(end - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate test PDF files")
+    parser.add_argument("output", nargs="?", default="output.pdf")
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--sizes", type=int, default=20, help="number of distinct page sizes")
+    parser.add_argument("--inherited", action="store_true", help="inherit page boxes from /Pages nodes")
+    parser.add_argument("--object-streams", action="store_true")
+    parser.add_argument("--xref-streams", action="store_true")
+    parser.add_argument("--updates", type=int, default=0, help="number of incremental updates")
+    parser.add_argument("--file-size", type=float, default=0, help="approximate file size in MB")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--encrypt", action="store_true",
+                        help="AES-256 encrypt with an owner password and an empty user password (needs pycryptodome)")
+    parser.add_argument("--reportlab", action="store_true",
+                        help="render real pages with reportlab (only --pages is used)")
+    parser.add_argument("--damage", choices=["catalog", "truncated"],
+                        help="overwrite the catalog, or cut the file before its last xref section")
+    parser.add_argument("--rotate", action="store_true",
+                        help="inherit /Rotate 90 from the page tree, with per-page /Rotate and /UserUnit overrides")
+    args = parser.parse_args()
+
+    if args.reportlab:
+        createRandomPdf(args.output, args.pages)
+        return
+    createCorpusPdf(args.output, CorpusSpec(args.pages, args.sizes, args.inherited, args.object_streams,
+                                            args.xref_streams, args.updates, int(args.file_size * 1024 * 1024),
+                                            args.seed, args.encrypt, args.damage or "", args.rotate))
+
+
+if __name__ == '__main__':
+    main()
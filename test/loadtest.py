@@ -0,0 +1,86 @@
+from typing import List, Optional, Tuple
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+
+async def request(host:str, port:int, method:str, target:str, body:bytes=b"") -> Tuple[int, bytes]:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"{method} {target} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n"
+                     f"Content-Type: application/pdf\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        return status, await reader.read()
+    finally:
+        writer.close()
+
+
+async def client(host:str, port:int, method:str, target:str, body:bytes, count:int,
+                 latencies:List[float], statuses:List[int]):
+    for _ in range(count):
+        start = time.perf_counter()
+        status, _ = await request(host, port, method, target, body)
+        latencies.append(time.perf_counter() - start)
+        statuses.append(status)
+
+
+def percentile(values:List[float], fraction:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(args:argparse.Namespace) -> int:
+    if args.path:
+        method, body = "GET", b""
+        target = "/analyze?" + urllib.parse.urlencode({"path": os.path.abspath(args.file)})
+    else:
+        method, target = "POST", "/analyze?" + urllib.parse.urlencode({"name": os.path.basename(args.file)})
+        with open(args.file, "rb") as file:
+            body = file.read()
+
+    status, data = await request(args.host, args.port, method, target, body)
+    if status != 200:
+        print(f"Warm-up request failed with {status}: {data.decode('utf-8', 'replace')}", file=sys.stderr)
+        return 1
+    pages = json.loads(data)["page-count"]
+
+    latencies:List[float] = []
+    statuses:List[int] = []
+    perClient = [args.requests // args.concurrency + (1 if i < args.requests % args.concurrency else 0)
+                 for i in range(args.concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(args.host, args.port, method, target, body, count, latencies, statuses)
+                           for count in perClient))
+    elapsed = time.perf_counter() - start
+
+    ok = statuses.count(200)
+    print(f"{len(statuses)} requests, {args.concurrency} concurrent, {len(body) / 1024:.0f} KiB upload, {pages} pages")
+    print(f"{ok} ok, {len(statuses) - ok} failed ({', '.join(sorted({str(s) for s in statuses if s != 200})) or '-'})")
+    print(f"throughput {len(statuses) / elapsed:.1f} req/s, {ok * pages / elapsed:.0f} pages/s")
+    print(f"latency p50 {percentile(latencies, 0.50) * 1000:.1f} ms, p95 {percentile(latencies, 0.95) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+    return 0 if ok == len(statuses) else 1
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Load test a running source/server.py instance")
+    parser.add_argument("file", help="PDF file to send")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--path", action="store_true",
+                        help="send the local path instead of uploading (server needs --allow-paths)")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())